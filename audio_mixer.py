@@ -0,0 +1,671 @@
+# audio_mixer.py
+"""
+Clock-driven audio mixing for the server (used by server.py; client.py
+numbers its frames with pack_audio, mixes for itself in SFU mode, and
+buffers the mix it gets back in a PlayoutBuffer).
+
+Every client sends one audio frame per CHUNK samples while it hears speech
+(VoiceDetector; nothing at all while muted or quiet), numbered by time so
+the gaps show:
+
+    +------+-----------------+------------+---------------------------+
+    | AUD: | sequence number | flags      | Opus or raw 16-bit PCM    |
+    | 4 B  | 4 bytes (big-e) | 1 byte     | rest                      |
+    +------+-----------------+------------+---------------------------+
+
+The flags byte is the sender's own measure of how loud the frame is, as in
+RFC 6464 (low 7 bits: 0 to 127 dB below full scale, 127 = silence), with
+the top bit set when the payload is Opus. It lets the server pick the
+loudest speakers without decoding anything.
+
+Frames are decoded on arrival and go into that sender's JitterBuffer, keyed
+by sequence number, so packets that arrive late, early or out of order
+still come out in order. The mixer thread ticks on the monotonic clock once
+per frame duration and takes exactly one frame from every buffer that is
+playing:
+
+  - a buffer starts playing once it holds `target` frames (the jitter it
+    can absorb), and goes back to filling up when it runs dry (underrun;
+    a sender that stopped talking runs dry the same way, and is simply
+    left out of the mix until it sends again)
+  - a frame that is missing while later ones are already buffered is lost:
+    the previous frame is repeated at half volume in its place
+  - frames older than the one being played are too late and dropped
+  - a buffer holding more than `max_frames` (a burst, or a sender whose
+    clock runs fast) is cut back to `target` by dropping its oldest frames
+    (overrun)
+  - a sender whose numbers jump by more than RESYNC_FRAMES either way
+    (it restarted, or paused) is followed to its new numbers
+
+Only the MIX_MAX_SPEAKERS loudest senders of a tick are mixed (levels are
+measured on the decoded frames, smoothed like the SFU's), which keeps a
+tick's cost bounded however many talk at once, and the mix is labelled
+with the loudest one. Who is in the mix goes to every client as
+CMD:SPEAKERS (ActiveSpeakers) so they can highlight them.
+
+Every listener gets a mix-minus: everyone who spoke in the tick except
+themselves, so nobody hears their own voice come back. All of them come
+from one (senders, samples) array: the column sum once, then that total
+minus each sender's own row, which is O(senders) per tick rather than
+O(senders^2) for mixing each listener separately.
+
+In SFU (selective forwarding) mode the server does none of the above:
+SpeakerSelector keeps the SFU_MAX_SPEAKERS loudest senders by their
+flags byte, and their datagrams are relayed untouched to every other
+listener as AUS:<nickname>:<sequence number><flags><payload>. Each client
+decodes the speakers it is sent and mixes them itself, with its own
+AudioMixer clocked by its speaker.
+
+Mixes go back to listeners who can decode Opus as Opus (AUO:<label>:<seq><flags><packet>),
+to the rest as raw PCM (AUD:<label>:<seq><flags><pcm>), see CMD:CAPS audio=,
+numbered by mixer tick. An Opus encoder keeps state between frames, so
+MixEncoders holds one per talker (for their mix-minus) and one shared by
+every listener who is only listening: they all hear the same mix, encoded
+once per tick. The encoders add in-band FEC, so a client whose
+PlayoutBuffer is missing a packet can rebuild it from the next one.
+"""
+import collections
+import struct
+import threading
+import numpy as np
+
+SEQUENCE = struct.Struct('!I')
+TARGET_FRAMES = 3 # Frames buffered before a sender is played (60 ms of 20 ms frames)
+MAX_FRAMES = 10 # More than this and the oldest are dropped
+CONCEAL_GAIN = 0.5 # Volume of the repeated frame that stands in for a lost one
+RESYNC_FRAMES = 50 # A jump in sequence numbers this big is a restart or a pause, not loss
+HEADER = struct.Struct('!IB') # Sequence number, flags
+OPUS_FLAG = 0x80
+SILENT_LEVEL = 127 # -127 dBov, the quietest level the flags byte can hold
+
+# --- SFU speaker selection ---
+SFU_MAX_SPEAKERS = 3 # Loudest senders forwarded at a time
+SPEAKING_LEVEL = 50 # Quieter than -50 dBov (smoothed) is not speech
+SWITCH_MARGIN = 6 # dB a sender must be louder than the quietest speaker to take its place
+LEVEL_ATTACK = 0.5 # Smoothing of the level: follows a louder frame quickly...
+LEVEL_RELEASE = 0.05 # ...and a quieter one slowly, so a speaker keeps the slot between words
+SPEAKER_TIMEOUT = 0.5 # Seconds without a packet before a speaker's slot is freed
+
+# --- Active speakers (mix mode) ---
+MIX_MAX_SPEAKERS = 4 # Loudest senders mixed per tick; the rest are left out
+SPEAKER_EVENT_INTERVAL = 0.25 # Seconds between CMD:SPEAKERS updates at most
+
+# --- Voice activity detection (client side: silence isn't sent at all) ---
+VAD_THRESHOLD = SPEAKING_LEVEL # Quieter than this (-dBov) is never speech
+VAD_MARGIN = 12 # dB above the noise floor a frame must be to count as speech
+VAD_HANGOVER = 12 # Frames still sent after speech stops (240 ms)
+NOISE_FLOOR_RISE = 0.05 # dB per frame the noise floor may climb
+
+# --- Client playout buffer (the mix coming back) ---
+PLAYOUT_MIN_FRAMES = 2 # Never buffer less than this (40 ms)...
+PLAYOUT_MAX_FRAMES = 12 # ...nor more (240 ms), however bad the jitter
+JITTER_MULTIPLE = 3 # Buffer this many times the measured jitter, on top of one frame
+PLAYOUT_GROW_INTERVAL = 5 # Frames between concealing one to grow a buffer the jitter outgrew (100 ms)
+PLAYOUT_SHRINK_INTERVAL = 50 # Frames between skipping one to shrink an oversized buffer (1 s)
+PLAYOUT_DRY_FRAMES = 1 # Frames concealed when the buffer is empty before it counts as run dry
+
+
+def frame_levels(frames):
+    """Level of each row of a (senders, samples) int16 array in dB below full scale, 0 to SILENT_LEVEL."""
+    samples = frames.astype(np.float32)
+    rms = np.sqrt(np.mean(samples * samples, axis=-1)) / 32768.0
+    with np.errstate(divide='ignore'):
+        return np.clip(np.round(-20 * np.log10(rms)), 0, SILENT_LEVEL)
+
+
+def audio_level(pcm):
+    """Level of 16-bit PCM in dB below full scale, 0 (loudest) to SILENT_LEVEL."""
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    if not samples.size:
+        return SILENT_LEVEL
+    return int(frame_levels(samples))
+
+
+class Resampler:
+    """
+    Converts a continuous 16-bit mono stream from one sample rate to
+    another, one block at a time, by linear interpolation. The last input
+    sample and the fractional read position carry over between blocks, so
+    block edges don't click; output blocks vary by a sample either way.
+    Used where a sound card can't run at the pipeline's RATE.
+    """
+    def __init__(self, from_rate, to_rate):
+        self.step = from_rate / to_rate # Input samples per output sample
+        self.position = 0.0 # Of the next output sample; 0 = the last sample of the previous block
+        self.previous = 0.0
+
+    def process(self, samples):
+        """int16 array at from_rate -> int16 array at to_rate."""
+        if not len(samples):
+            return np.zeros(0, dtype=np.int16)
+        source = np.concatenate(([self.previous], samples.astype(np.float32)))
+        end = len(source) - 1
+        count = int((end - self.position) // self.step) + 1 if self.position <= end else 0
+        positions = self.position + np.arange(count) * self.step
+        out = np.interp(positions, np.arange(len(source)), source)
+        self.position += count * self.step - end
+        self.previous = source[-1]
+        return np.round(out).astype(np.int16)
+
+
+class SampleRing:
+    """
+    Audio blocks passed between a thread and a PyAudio callback without
+    locks: one side appends to a deque and the other pops from it, both
+    atomic, so neither ever waits for the other. When `max_blocks` are
+    queued the oldest is dropped, which bounds the delay. Each block carries
+    the monotonic time it was produced, for latency measurements.
+    """
+    def __init__(self, max_blocks):
+        self.blocks = collections.deque(maxlen=max_blocks)
+        self.partial = None # Consumer side: the rest of a block take() has started on
+        self.dropped = 0 # Producer side
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def put(self, samples, stamp):
+        if len(self.blocks) == self.blocks.maxlen:
+            self.dropped += 1
+        self.blocks.append((samples, stamp))
+
+    def get(self):
+        """The oldest whole block as (samples, stamp), or None."""
+        try:
+            return self.blocks.popleft()
+        except IndexError:
+            return None
+
+    def take(self, count):
+        """
+        Exactly `count` samples for an output callback, padded with silence
+        if not enough are queued. Returns (int16 array, stamp of the first
+        block started on, or None, samples that were missing).
+        """
+        out = np.zeros(count, dtype=np.int16)
+        filled, first = 0, None
+        while filled < count:
+            if self.partial is None:
+                self.partial = self.get()
+                if self.partial is None:
+                    break
+                if first is None:
+                    first = self.partial[1]
+            samples, stamp = self.partial
+            n = min(count - filled, len(samples))
+            out[filled:filled + n] = samples[:n]
+            filled += n
+            self.partial = (samples[n:], stamp) if n < len(samples) else None
+        return out, first, count - filled
+
+
+class LatencyMeter:
+    """Mean and worst of a stream of delays, since the last take()."""
+    def __init__(self):
+        self.total = self.worst = 0.0
+        self.count = 0
+
+    def add(self, seconds):
+        self.total += seconds
+        self.worst = max(self.worst, seconds)
+        self.count += 1
+
+    def take(self):
+        """(mean ms, worst ms, samples), then resets; None if nothing was measured."""
+        if not self.count:
+            return None
+        result = (1000 * self.total / self.count, 1000 * self.worst, self.count)
+        self.total = self.worst = 0.0
+        self.count = 0
+        return result
+
+
+class VoiceDetector:
+    """
+    Client-side voice activity detection on frame levels (audio_level).
+    A frame is speech if it is louder than VAD_THRESHOLD and VAD_MARGIN dB
+    above the noise floor, which follows quieter frames at once and louder
+    ones by NOISE_FLOOR_RISE dB per frame (so a fan or hum is learned, but
+    a sentence isn't). Frames keep counting as speech for VAD_HANGOVER
+    frames after the last speech frame, so word endings and short pauses
+    go out with the rest.
+    """
+    def __init__(self, threshold=VAD_THRESHOLD, margin=VAD_MARGIN, hangover=VAD_HANGOVER):
+        self.threshold = SILENT_LEVEL - threshold # As loudness: dB above SILENT_LEVEL, higher = louder
+        self.margin = margin
+        self.hangover = hangover
+        self.noise = None
+        self.remaining = 0 # Hangover frames left
+
+    def is_speech(self, level):
+        loud = SILENT_LEVEL - level
+        if self.noise is None or loud < self.noise:
+            self.noise = loud
+        else:
+            self.noise = min(loud, self.noise + NOISE_FLOOR_RISE)
+        if loud >= self.threshold and loud >= self.noise + self.margin:
+            self.remaining = self.hangover
+            return True
+        if self.remaining:
+            self.remaining -= 1
+            return True
+        return False
+
+
+def pack_audio(seq, payload, level=SILENT_LEVEL, opus=False, prefix=b'AUD:'):
+    """An AUD: datagram (client -> server), or with another prefix, such as a mix's AUO:<label>: (server -> client)."""
+    flags = (OPUS_FLAG if opus else 0) | min(level, SILENT_LEVEL)
+    return prefix + HEADER.pack(seq & 0xFFFFFFFF, flags) + payload
+
+
+def unpack_audio(data, offset=4):
+    """
+    AUD: datagram (or the part of an AUS:, AUO: or mix AUD: one after its
+    label, from `offset`) -> (sequence number, level, is Opus, payload), or
+    None if it is too short.
+    """
+    if len(data) < offset + HEADER.size:
+        return None
+    seq, flags = HEADER.unpack_from(data, offset)
+    return seq, flags & SILENT_LEVEL, bool(flags & OPUS_FLAG), data[offset + HEADER.size:]
+
+
+class JitterBuffer:
+    """One sender's frames waiting to be mixed, in sequence order."""
+    def __init__(self, target=TARGET_FRAMES, max_frames=MAX_FRAMES):
+        self.target = target
+        self.max_frames = max_frames
+        self.frames = {} # seq -> int16 samples
+        self.arrivals = {} # seq -> when it was received, if the caller said
+        self.arrival = None # Of the frame pop() last returned, None if concealed or not known
+        self.playing = False
+        self.next_seq = None # Next frame to play once playing
+        self.last = None # Last frame played, for concealment
+        self.stats = dict.fromkeys(('received', 'played', 'late', 'lost', 'underruns', 'overruns'), 0)
+
+    def push(self, seq, samples, arrival=None):
+        if self.next_seq is not None and seq < self.next_seq:
+            if self.next_seq - seq <= RESYNC_FRAMES:
+                self.stats['late'] += 1
+                return
+            self.frames.clear() # The sender started counting again
+            self.arrivals.clear()
+            self.playing, self.next_seq = False, None
+        if seq in self.frames:
+            return # Duplicate
+        self.frames[seq] = samples
+        if arrival is not None:
+            self.arrivals[seq] = arrival
+        self.stats['received'] += 1
+        if len(self.frames) > self.max_frames:
+            self.stats['overruns'] += 1
+            for old in sorted(self.frames)[:len(self.frames) - self.target]:
+                del self.frames[old]
+                self.arrivals.pop(old, None)
+            if self.playing:
+                self.next_seq = min(self.frames)
+
+    def pop(self):
+        """The frame for this tick, or None if the sender is silent for it."""
+        self.arrival = None
+        if not self.playing:
+            if len(self.frames) < self.target:
+                return None
+            self.playing = True
+            self.next_seq = min(self.frames)
+        samples = self.frames.pop(self.next_seq, None)
+        if samples is None and self.frames and min(self.frames) - self.next_seq > RESYNC_FRAMES:
+            self.next_seq = min(self.frames) # The sender skipped ahead
+            samples = self.frames.pop(self.next_seq)
+        self.arrival = self.arrivals.pop(self.next_seq, None)
+        self.next_seq += 1
+        if samples is not None:
+            self.stats['played'] += 1
+            self.last = samples
+            return samples
+        if not self.frames: # Ran dry: wait for `target` frames again
+            self.stats['underruns'] += 1
+            self.playing = False
+            self.last = None
+            return None
+        self.stats['lost'] += 1 # A hole with later frames behind it
+        if self.last is None:
+            return None
+        concealed = (self.last * CONCEAL_GAIN).astype(np.int16)
+        self.last = None # Repeat once, then silence until real audio
+        return concealed
+
+    def take_stats(self):
+        """The counters since the last call, then resets them."""
+        stats = self.stats
+        self.stats = dict.fromkeys(stats, 0)
+        return stats
+
+
+class PlayoutBuffer:
+    """
+    Client side: the mix's packets waiting to be played, in sequence order.
+    How many frames it holds back adapts to the network: interarrival
+    jitter is measured as in RFC 3550 (the change in transit time between
+    consecutive packets, smoothed over 16), and the target is one frame
+    plus JITTER_MULTIPLE times that, between `min_frames` and `max_frames`.
+    A talk spurt starts playing once `target` frames are in. While playing,
+    the buffer grows by concealing a frame instead of playing the next one
+    (at most every PLAYOUT_GROW_INTERVAL frames) while it holds less than
+    it needs, and shrinks by skipping one (at most every
+    PLAYOUT_SHRINK_INTERVAL) while it holds more. A lost frame is
+    concealed, and so are PLAYOUT_DRY_FRAMES frames after the buffer runs
+    out, in case the next packet is only late; after that it waits for
+    `target` frames again.
+
+    Packets are kept as they arrived, not decoded, so the caller can decode
+    them in order and rebuild a lost one from the FEC data in the packet
+    after it. push() is called by the receive thread, pop() by the playout
+    thread.
+    """
+    def __init__(self, frame_duration, min_frames=PLAYOUT_MIN_FRAMES, max_frames=PLAYOUT_MAX_FRAMES):
+        self.frame_duration = frame_duration
+        self.min_frames = min_frames
+        self.max_frames = max_frames
+        self.target = min_frames
+        self.lock = threading.Lock()
+        self.packets = {} # seq -> packet
+        self.playing = False
+        self.next_seq = None # Next frame to play once playing
+        self.jitter = 0.0 # Seconds
+        self.transit = None # Arrival time minus send time (seq * frame_duration) of the last packet
+        self.last_seq = None
+        self.since_shrink = self.since_grow = 0
+        self.dry = 0 # Frames in a row concealed with nothing buffered
+        self.stats = dict.fromkeys(('received', 'played', 'late', 'lost', 'underruns', 'overruns', 'stretched', 'skipped'), 0)
+
+    def push(self, seq, packet, arrival):
+        """Queues one packet, `arrival` being when it was received (monotonic seconds)."""
+        with self.lock:
+            transit = arrival - seq * self.frame_duration
+            if self.transit is not None and abs(seq - self.last_seq) <= RESYNC_FRAMES:
+                self.jitter += (abs(transit - self.transit) - self.jitter) / 16
+                wanted = 1 + int(np.ceil(JITTER_MULTIPLE * self.jitter / self.frame_duration))
+                self.target = min(max(wanted, self.min_frames), self.max_frames)
+            self.transit, self.last_seq = transit, seq
+
+            if self.next_seq is not None and seq < self.next_seq:
+                if self.next_seq - seq <= RESYNC_FRAMES:
+                    self.stats['late'] += 1
+                    return
+                self.packets.clear() # The server started counting again
+                self.playing, self.next_seq = False, None
+            if seq in self.packets:
+                return # Duplicate
+            self.packets[seq] = packet
+            self.stats['received'] += 1
+            if len(self.packets) > self.max_frames:
+                self.stats['overruns'] += 1
+                for old in sorted(self.packets)[:len(self.packets) - self.target]:
+                    del self.packets[old]
+                if self.playing:
+                    self.next_seq = min(self.packets)
+
+    def pop(self):
+        """
+        What to play for this frame: (packet, None), or (None, the next
+        packet or None) when the frame was lost and has to be concealed, or
+        None when there is nothing to play (not started, or ran dry).
+        """
+        with self.lock:
+            if not self.playing:
+                if len(self.packets) < self.target:
+                    return None
+                self.playing = True
+                self.next_seq = min(self.packets)
+                self.since_shrink = 0
+            self.since_shrink += 1
+            self.since_grow += 1
+            if self.packets and len(self.packets) < self.target - 1 and self.since_grow >= PLAYOUT_GROW_INTERVAL:
+                # Less buffered than the jitter needs: conceal one frame while it fills up
+                self.stats['stretched'] += 1
+                self.since_grow = 0
+                return None, None
+            if len(self.packets) > self.target + 1 and self.since_shrink >= PLAYOUT_SHRINK_INTERVAL:
+                # More buffered than the jitter needs: play one frame less
+                self.stats['skipped'] += 1
+                self.packets.pop(self.next_seq, None)
+                self.next_seq += 1
+                self.since_shrink = 0
+            packet = self.packets.pop(self.next_seq, None)
+            if packet is None and self.packets and min(self.packets) - self.next_seq > RESYNC_FRAMES:
+                self.next_seq = min(self.packets) # The server skipped ahead
+                packet = self.packets.pop(self.next_seq)
+            self.next_seq += 1
+            if packet is not None:
+                self.stats['played'] += 1
+                self.dry = 0
+                return packet, None
+            if not self.packets:
+                self.dry += 1
+                if self.dry > PLAYOUT_DRY_FRAMES: # Ran dry: wait for `target` frames again
+                    self.stats['underruns'] += 1
+                    self.playing = False
+                    return None
+            self.stats['lost'] += 1 # A hole, maybe with later packets behind it
+            return None, self.packets.get(self.next_seq)
+
+    def take_stats(self):
+        """The counters since the last call, then resets them; plus the current target and jitter."""
+        with self.lock:
+            stats = self.stats
+            self.stats = dict.fromkeys(stats, 0)
+            return stats, self.target, self.jitter
+
+
+class AudioMixer:
+    """
+    A jitter buffer per sender, and one mix per tick. push() is called by
+    the UDP receiver thread, tick() by the mixer thread.
+    """
+    def __init__(self, frame_samples, target=TARGET_FRAMES, max_frames=MAX_FRAMES, max_speakers=MIX_MAX_SPEAKERS):
+        self.frame_samples = frame_samples
+        self.target = target
+        self.max_frames = max_frames
+        self.max_speakers = max_speakers
+        self.lock = threading.Lock()
+        self.buffers = {} # sender -> JitterBuffer
+        self.active = {} # The buffers holding or playing frames: senders who send nothing cost nothing
+        self.loudness = {} # sender -> smoothed dB above SILENT_LEVEL, for picking the loudest
+
+    def push(self, sender, seq, pcm, arrival=None):
+        """
+        Queues one decoded frame (16-bit PCM bytes), received at `arrival`
+        (monotonic seconds) if the caller measures latency; returns False if
+        it has the wrong size.
+        """
+        if len(pcm) != self.frame_samples * 2:
+            return False
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        with self.lock:
+            buffer = self.buffers.get(sender)
+            if buffer is None:
+                buffer = self.buffers[sender] = JitterBuffer(self.target, self.max_frames)
+            buffer.push(seq, samples, arrival)
+            self.active[sender] = buffer
+        return True
+
+    def remove(self, sender):
+        with self.lock:
+            self.buffers.pop(sender, None)
+            self.active.pop(sender, None)
+            self.loudness.pop(sender, None)
+
+    def tick(self):
+        """
+        Takes this tick's frame from every playing sender and mixes the
+        `max_speakers` loudest of them (by level smoothed over the last
+        ticks, as SpeakerSelector does). Returns a Mix, or None when nobody
+        is playing. A sender who went quiet (stopped sending) plays out what
+        is buffered, then drops out until they send again.
+        """
+        senders, rows, arrivals = [], [], []
+        with self.lock:
+            for sender, buffer in list(self.active.items()):
+                samples = buffer.pop()
+                if samples is not None:
+                    senders.append(sender)
+                    rows.append(samples)
+                    arrivals.append(buffer.arrival)
+                elif not buffer.playing and not buffer.frames:
+                    del self.active[sender]
+                    self.loudness.pop(sender, None)
+            if not senders:
+                return None
+            frames = np.stack(rows)
+            smoothed = []
+            for sender, level in zip(senders, frame_levels(frames)):
+                loud = SILENT_LEVEL - level
+                previous = self.loudness.get(sender, 0.0)
+                alpha = LEVEL_ATTACK if loud > previous else LEVEL_RELEASE
+                smoothed.append(previous + alpha * (loud - previous))
+                self.loudness[sender] = smoothed[-1]
+        # Loudest first: the mix is labelled with the loudest speaker a listener hears
+        order = np.argsort(smoothed)[::-1][:self.max_speakers]
+        arrival = min((arrivals[i] for i in order if arrivals[i] is not None), default=None)
+        return Mix([senders[i] for i in order], frames[order], arrival)
+
+    def take_stats(self):
+        """{sender: counters} for senders that had any traffic since the last call, then resets them."""
+        with self.lock:
+            stats = {sender: buffer.take_stats() for sender, buffer in self.buffers.items()}
+        return {sender: counts for sender, counts in stats.items() if any(counts.values())}
+
+
+class Mix:
+    """
+    One tick's audio. `senders[i]` spoke `frames[i]`, loudest first;
+    for_listener() gives the PCM each listener should hear (averaged, as
+    the mix always was). `arrival` is when the oldest of the frames was
+    received, if known.
+    """
+    def __init__(self, senders, frames, arrival=None):
+        self.senders = senders
+        self.arrival = arrival
+        self.rows = {sender: i for i, sender in enumerate(senders)}
+        total = frames.sum(axis=0, dtype=np.int32)
+        count = len(senders)
+        self.everyone = (total // count).astype(np.int16).tobytes() # For listeners who are not talking
+        if count > 1:
+            # Row i: everyone but sender i, in one broadcast subtraction
+            self.minus = ((total - frames.astype(np.int32)) // (count - 1)).astype(np.int16)
+        else:
+            self.minus = None # A lone talker has nobody to hear
+
+    def for_listener(self, listener):
+        """PCM bytes for `listener`, or None if there is nothing for them to hear."""
+        row = self.rows.get(listener)
+        if row is None:
+            return self.everyone
+        return None if self.minus is None else self.minus[row].tobytes()
+
+    def label_for(self, listener):
+        """The loudest talker `listener` can hear, for the AUD:<nickname>: header."""
+        return next((sender for sender in self.senders if sender != listener), None)
+
+
+class ActiveSpeakers:
+    """
+    Who is in the mix, for CMD:SPEAKERS:<nick>,<nick> (loudest first, empty
+    when nobody talks). update() is called every tick and returns the new
+    list only when it changed and SPEAKER_EVENT_INTERVAL has passed since
+    the last one, so a speaker flickering in and out costs one event at most
+    per interval.
+    """
+    def __init__(self, interval=SPEAKER_EVENT_INTERVAL):
+        self.interval = interval
+        self.current = ()
+        self.announced_at = float('-inf')
+
+    def update(self, speakers, now):
+        speakers = tuple(speakers)
+        if speakers == self.current or now - self.announced_at < self.interval:
+            return None
+        self.current = speakers
+        self.announced_at = now
+        return speakers
+
+
+class MixEncoders:
+    """
+    Opus encoder state for outgoing mixes, keyed by the talker whose
+    mix-minus it encodes, or EVERYONE for the mix of all talkers.
+    make_encoder() builds a fresh encoder the first time a key is used.
+    """
+    EVERYONE = None
+
+    def __init__(self, make_encoder, frame_samples):
+        self.make_encoder = make_encoder
+        self.frame_samples = frame_samples
+        self.lock = threading.Lock()
+        self.encoders = {}
+
+    def encode(self, key, pcm):
+        with self.lock:
+            encoder = self.encoders.get(key)
+            if encoder is None:
+                encoder = self.encoders[key] = self.make_encoder()
+        return encoder.encode(pcm, self.frame_samples)
+
+    def discard(self, key):
+        with self.lock:
+            self.encoders.pop(key, None)
+
+
+class SpeakerSelector:
+    """
+    SFU mode: which senders are forwarded. Each sender's level is smoothed
+    (fast attack, slow release); up to `max_speakers` senders above
+    SPEAKING_LEVEL hold a slot, and a louder sender takes the quietest
+    speaker's slot only if it beats it by SWITCH_MARGIN, so the set doesn't
+    flap while people talk over each other.
+    """
+    def __init__(self, max_speakers=SFU_MAX_SPEAKERS):
+        self.max_speakers = max_speakers
+        self.lock = threading.Lock()
+        self.loudness = {} # sender -> smoothed dB above SILENT_LEVEL (higher = louder)
+        self.speakers = {} # sender -> monotonic time of their last packet
+
+    def forward(self, sender, level, now):
+        """Updates `sender`'s level from one packet; True if the packet should be forwarded."""
+        with self.lock:
+            return self._forward(sender, level, now)
+
+    def _forward(self, sender, level, now):
+        loud = SILENT_LEVEL - level
+        previous = self.loudness.get(sender, 0.0)
+        alpha = LEVEL_ATTACK if loud > previous else LEVEL_RELEASE
+        smoothed = self.loudness[sender] = previous + alpha * (loud - previous)
+        speaking = smoothed >= SILENT_LEVEL - SPEAKING_LEVEL
+
+        if sender in self.speakers:
+            if not speaking:
+                del self.speakers[sender] # Went quiet: free the slot
+                return False
+            self.speakers[sender] = now
+            return True
+        if not speaking:
+            return False
+        for stale in [s for s, seen in self.speakers.items() if now - seen > SPEAKER_TIMEOUT]:
+            del self.speakers[stale] # Stopped sending (left, or lost connection)
+        if len(self.speakers) >= self.max_speakers:
+            quietest = min(self.speakers, key=self.loudness.get)
+            if smoothed < self.loudness[quietest] + SWITCH_MARGIN:
+                return False
+            del self.speakers[quietest]
+        self.speakers[sender] = now
+        return True
+
+    def remove(self, sender):
+        with self.lock:
+            self.loudness.pop(sender, None)
+            self.speakers.pop(sender, None)
+
+    def speaking(self):
+        with self.lock:
+            return list(self.speakers)
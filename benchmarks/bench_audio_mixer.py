@@ -0,0 +1,155 @@
+# bench_audio_mixer.py
+"""
+Benchmark: the audio mixer under network jitter, old vs new.
+
+  polled   - the original loop: every 10 ms, take the one latest frame per
+             sender (frames that arrived since the last poll overwrite each
+             other) and mix whatever is there
+  clocked  - audio_mixer.AudioMixer: per-sender jitter buffers, one tick per
+             frame duration on the clock
+
+Talkers send one 960-sample frame every 20 ms with a random phase. Each
+datagram is delayed by a base latency plus gamma-distributed jitter (so
+some arrive out of order) and a fraction is lost. The run is simulated in
+virtual time, so it is repeatable and takes a few seconds.
+
+  delivered  - frames that made it into a mix
+  dropped    - frames overwritten (polled) or too late / cut by an overrun (clocked)
+  gaps       - frame slots in which a talking sender had nothing in the mix
+               (the listener hears a click or a hole)
+
+"tick us" is the real CPU time of one mix with every sender present.
+
+Run from the repository root:
+    python benchmarks/bench_audio_mixer.py [--talkers 32] [--seconds 60] [--jitter-ms 15] [--loss 0.01]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import audio_mixer
+
+RATE = 48000
+CHUNK = 960
+FRAME = CHUNK / RATE
+POLL = 0.01
+
+
+def arrivals(talkers, seconds, jitter_ms, loss, rng):
+    """Sorted (arrival time, sender, seq) for every datagram that isn't lost."""
+    events = []
+    frames = int(seconds / FRAME)
+    for sender in range(talkers):
+        phase = rng.uniform(0, FRAME)
+        sent = phase + np.arange(frames) * FRAME
+        delay = 0.002 + rng.gamma(2.0, jitter_ms / 2000.0, frames)
+        kept = rng.random(frames) >= loss
+        events.extend(zip(sent[kept] + delay[kept], [sender] * int(kept.sum()), np.nonzero(kept)[0]))
+    events.sort()
+    return events, frames
+
+
+def run_polled(events, talkers, seconds):
+    latest = {}
+    delivered = dropped = gaps = 0
+    last_in_mix = {} # sender -> time it was last in a mix
+    i = 0
+    t = 0.0
+    while t < seconds:
+        t += POLL
+        while i < len(events) and events[i][0] <= t:
+            _, sender, _ = events[i]
+            if sender in latest:
+                dropped += 1
+            latest[sender] = True
+            i += 1
+        for sender in latest:
+            delivered += 1
+            if sender in last_in_mix:
+                gaps += max(0, round((t - last_in_mix[sender]) / FRAME) - 1)
+            last_in_mix[sender] = t
+        latest.clear()
+    return delivered, dropped, gaps
+
+
+def run_clocked(events, talkers, seconds):
+    mixer = audio_mixer.AudioMixer(CHUNK)
+    pcm = np.zeros(CHUNK, dtype=np.int16).tobytes()
+    i = 0
+    t = 0.0
+    refilling = 0 # Silent ticks while a buffer fills up again
+    while t < seconds:
+        t += FRAME
+        while i < len(events) and events[i][0] <= t:
+            _, sender, seq = events[i]
+            mixer.push(sender, int(seq), pcm)
+            i += 1
+        refilling += sum(1 for buffer in mixer.buffers.values()
+                         if not buffer.playing and 0 < len(buffer.frames) < buffer.target)
+        mixer.tick()
+    stats = {}
+    for counts in mixer.take_stats().values():
+        for name, count in counts.items():
+            stats[name] = stats.get(name, 0) + count
+    # Every tick a playing buffer had no real frame for is a loss (concealed) or an underrun
+    gaps = stats['lost'] + stats['underruns'] + refilling
+    return stats['played'], stats['late'] + stats['overruns'], gaps, stats
+
+
+def tick_cost(talkers, repeat=2000):
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(-3000, 3000, CHUNK, dtype=np.int16) for _ in range(talkers)]
+    # The original: per chunk, a scan of audio_clients for the sender's
+    # nickname and one float32 accumulation, in a Python loop
+    latest = {('10.0.0.1', port): chunk.tobytes() for port, chunk in enumerate(frames)}
+    audio_clients = {f"user{port}": addr for port, addr in enumerate(latest)}
+    start = time.perf_counter()
+    for _ in range(repeat):
+        decoded, senders = [], []
+        for addr, chunk in latest.items():
+            decoded.append(np.frombuffer(chunk, dtype=np.int16))
+            senders.append(next(nick for nick, a in audio_clients.items() if a == addr))
+        mixed = np.zeros(CHUNK, dtype=np.float32)
+        for chunk in decoded:
+            mixed += chunk.astype(np.float32)
+        mixed /= len(frames)
+        np.clip(mixed, -32768, 32767).astype(np.int16).tobytes()
+    polled = (time.perf_counter() - start) / repeat
+    mixer = audio_mixer.AudioMixer(CHUNK, target=1, max_frames=repeat + 1)
+    for sender, chunk in enumerate(frames):
+        for seq in range(repeat):
+            mixer.push(sender, seq, chunk.tobytes())
+    start = time.perf_counter()
+    for _ in range(repeat):
+        mixer.tick()
+    clocked = (time.perf_counter() - start) / repeat
+    return polled, clocked
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--talkers", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--jitter-ms", type=float, default=15)
+    parser.add_argument("--loss", type=float, default=0.01)
+    args = parser.parse_args()
+
+    events, frames = arrivals(args.talkers, args.seconds, args.jitter_ms, args.loss, np.random.default_rng(1))
+    sent = frames * args.talkers
+    print(f"{args.talkers} talkers, {args.seconds:g} s, mean jitter {args.jitter_ms:g} ms, {args.loss:.0%} loss "
+          f"({sent} frames sent)")
+    print(f"{'mixer':>8} | {'delivered':>9} | {'dropped':>7} | {'gaps':>6} | {'tick us':>7}")
+    polled_cost, clocked_cost = tick_cost(args.talkers)
+    delivered, dropped, gaps = run_polled(events, args.talkers, args.seconds)
+    print(f"{'polled':>8} | {delivered / sent:>9.1%} | {dropped / sent:>7.1%} | {gaps / sent:>6.1%} | {polled_cost * 1e6:>7.0f}")
+    delivered, dropped, gaps, stats = run_clocked(events, args.talkers, args.seconds)
+    print(f"{'clocked':>8} | {delivered / sent:>9.1%} | {dropped / sent:>7.1%} | {gaps / sent:>6.1%} | {clocked_cost * 1e6:>7.0f}")
+    print("clocked jitter buffers: " + ", ".join(f"{count} {name}" for name, count in stats.items()))
+
+
+if __name__ == "__main__":
+    main()
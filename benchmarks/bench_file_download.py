@@ -0,0 +1,119 @@
+# bench_file_download.py
+"""
+Microbenchmark: server-side download throughput and CPU over loopback.
+
+  legacy    - the original handler: f.read(4096) + one send per chunk
+              (timed with sendall, so the stream stays intact)
+  chunked   - 64 KB reads, each copied into a FILE_DATA frame and sendall()ed
+  fallback  - protocol.send_file without sendfile: readinto a 1 MB buffer + sendall
+  sendfile  - protocol.send_file: 4 MB FILE_DATA frames, os.sendfile() page cache -> socket
+
+The file is read once before timing so every mode is served from the page
+cache. "cpu" is the sending thread's CPU time per GB (time.thread_time);
+the receiving side just drains the socket and is the same for all modes.
+
+Run from the repository root:
+    python benchmarks/bench_file_download.py [--size-mb 1024]
+"""
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import protocol
+
+FRAME_SIZE = 4 * 1024 * 1024
+
+
+def send_legacy(sock, path, size):
+    with open(path, 'rb') as f:
+        while (chunk := f.read(4096)):
+            sock.sendall(chunk)
+
+
+def send_chunked(sock, path, size):
+    with open(path, 'rb') as f:
+        while (chunk := f.read(65536)):
+            sock.sendall(protocol.encode_frame(protocol.FRAME_FILE_DATA, chunk))
+
+
+def make_send_file(use_sendfile):
+    def send(sock, path, size):
+        with open(path, 'rb') as f:
+            for offset in range(0, size, FRAME_SIZE):
+                length = min(FRAME_SIZE, size - offset)
+                sock.sendall(protocol.HEADER.pack(protocol.PROTOCOL_VERSION, protocol.FRAME_FILE_DATA, length))
+                protocol.send_file(sock, f, offset, length, use_sendfile=use_sendfile)
+    return send
+
+
+MODES = {
+    "legacy": send_legacy,
+    "chunked": send_chunked,
+    "fallback": make_send_file(False),
+    "sendfile": make_send_file(True),
+}
+
+
+def drain(sock, done):
+    buffer = memoryview(bytearray(1024 * 1024))
+    total = 0
+    while (n := sock.recv_into(buffer)):
+        total += n
+    done.append(total)
+
+
+def run(send, path, size):
+    sender, receiver = _tcp_pair()
+    done = []
+    reader = threading.Thread(target=drain, args=(receiver, done))
+    reader.start()
+    cpu_start, start = time.thread_time(), time.perf_counter()
+    send(sender, path, size)
+    cpu = time.thread_time() - cpu_start
+    sender.shutdown(socket.SHUT_WR)
+    reader.join()
+    elapsed = time.perf_counter() - start
+    sender.close()
+    receiver.close()
+    return done[0], elapsed, cpu
+
+
+def _tcp_pair():
+    """A real TCP connection over loopback (socketpair() would be AF_UNIX)."""
+    with socket.create_server(('127.0.0.1', 0)) as server:
+        client = socket.create_connection(server.getsockname())
+        conn, _ = server.accept()
+    return conn, client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=1024)
+    args = parser.parse_args()
+    size = args.size_mb * 1024 * 1024
+
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        path = f.name
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.size_mb):
+            f.write(block)
+    try:
+        with open(path, 'rb') as f: # Warm the page cache
+            while f.read(FRAME_SIZE):
+                pass
+        print(f"Download of a {args.size_mb} MB file over loopback TCP")
+        print(f"{'mode':>9} | {'MB/s':>8} | {'cpu s/GB':>8}")
+        for name, send in MODES.items():
+            received, elapsed, cpu = run(send, path, size)
+            print(f"{name:>9} | {received / elapsed / (1024 * 1024):>8.0f} | {cpu / (size / 1024 ** 3):>8.2f}")
+    finally:
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
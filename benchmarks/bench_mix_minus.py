@@ -0,0 +1,101 @@
+# bench_mix_minus.py
+"""
+Microbenchmark: one mixer tick producing a mix-minus for every listener.
+
+  single      - the old mixer: one average of everyone, the same packet
+                for all (listeners hear themselves)
+  per-listener- a separate sum of the other N-1 frames for each listener,
+                O(N^2) work per tick
+  mix-minus   - audio_mixer.Mix: the column total once, minus each row,
+                O(N) work per tick
+  top-4       - what AudioMixer.tick does now: the level of every frame,
+                then a mix-minus of only the MIX_MAX_SPEAKERS loudest, so
+                the mixing work stops growing with N
+
+Every participant is talking (the worst case) and gets their own PCM
+payload; "budget" is the share of one 960-sample frame (20 ms) the tick
+takes. "mixes" counts the distinct mixes a tick produces: for listeners on
+Opus each one is an encode (~0.1 ms), which top-N caps at N + 1.
+
+Run from the repository root:
+    python benchmarks/bench_mix_minus.py [--participants 10 50 200]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import audio_mixer
+
+CHUNK = 960
+FRAME = CHUNK / 48000
+
+
+def single(senders, frames):
+    mixed = (frames.sum(axis=0, dtype=np.int32) // len(senders)).astype(np.int16).tobytes()
+    return [mixed for _ in senders]
+
+
+def per_listener(senders, frames):
+    out = []
+    for i in range(len(senders)):
+        others = np.delete(frames, i, axis=0)
+        out.append((others.sum(axis=0, dtype=np.int32) // len(others)).astype(np.int16).tobytes())
+    return out
+
+
+def mix_minus(senders, frames):
+    mix = audio_mixer.Mix(senders, frames)
+    return [mix.for_listener(sender) for sender in senders]
+
+
+def top_n(senders, frames):
+    levels = audio_mixer.frame_levels(frames)
+    order = np.argsort(levels)[:audio_mixer.MIX_MAX_SPEAKERS] # Lowest -dBov = loudest
+    mix = audio_mixer.Mix([senders[i] for i in order], frames[order])
+    return [mix.for_listener(sender) for sender in senders]
+
+
+MODES = {
+    "single": single,
+    "per-listener": per_listener,
+    "mix-minus": mix_minus,
+    f"top-{audio_mixer.MIX_MAX_SPEAKERS}": top_n,
+}
+
+
+def timed(fn, senders, frames, budget=1.0):
+    """(mean seconds per call, distinct mixes), repeating for about `budget` seconds."""
+    mixes = len(set(out for out in fn(senders, frames) if out is not None))
+    runs, start = 0, time.perf_counter()
+    while time.perf_counter() - start < budget:
+        fn(senders, frames)
+        runs += 1
+    return (time.perf_counter() - start) / runs, mixes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--participants", type=int, nargs='+', default=[10, 50, 200])
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    # Check the fast path against the slow one before timing anything
+    senders = [f"user{i}" for i in range(5)]
+    frames = rng.integers(-8000, 8000, (5, CHUNK), dtype=np.int16)
+    assert mix_minus(senders, frames) == per_listener(senders, frames)
+
+    print(f"{'participants':>12} | {'mode':>12} | {'tick ms':>8} | {'budget':>6} | {'mixes':>5}")
+    for count in args.participants:
+        senders = [f"user{i}" for i in range(count)]
+        frames = rng.integers(-8000, 8000, (count, CHUNK), dtype=np.int16)
+        for name, fn in MODES.items():
+            seconds, mixes = timed(fn, senders, frames)
+            print(f"{count:>12} | {name:>12} | {seconds * 1000:>8.3f} | {seconds / FRAME:>6.1%} | {mixes:>5}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# bench_playout.py
+"""
+Benchmark: the client's playout of the server's mix under packet loss and
+jitter, simulated (no sockets, no sound card).
+
+One continuous talk spurt of 20 ms frames is sent by the server's clock;
+each packet is lost with probability --loss, or arrives after 2 ms plus
+an exponentially distributed delay averaging --jitter ms. The speaker asks
+for a frame every 20 ms, and gets:
+
+  arrival   - the old client: packets played in the order they land, as
+              soon as the speaker wants one, with no reordering and nothing
+              for a lost packet
+  fixed 3   - audio_mixer.PlayoutBuffer held at 3 frames (60 ms)
+  adaptive  - audio_mixer.PlayoutBuffer as the client uses it, sized from
+              the measured jitter
+
+  delay ms  - mean time from a packet being sent to being played
+  gaps/min  - frames the speaker got nothing for: audible dropouts
+  fec/min   - lost frames rebuilt from the next packet's Opus FEC data
+              (it had arrived when the frame was due)
+  plc/min   - frames Opus had to conceal (PLC): lost ones without FEC, and
+              the ones the adaptive buffer inserts to grow
+  late/min  - packets that arrived after their frame had been played
+
+Run from the repository root:
+    python benchmarks/bench_playout.py [--loss 1 5] [--jitter 2 10 30] [--seconds 60]
+"""
+import argparse
+import collections
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import audio_mixer
+
+FRAME = 0.02 # 960 samples at 48 kHz
+
+
+def make_arrivals(frames, loss, jitter, rng):
+    """(arrival time, seq) of every packet that gets through, in arrival order."""
+    arrivals = np.arange(frames) * FRAME + 0.002 + rng.exponential(jitter, frames)
+    kept = rng.random(frames) >= loss
+    order = np.argsort(arrivals)
+    return [(arrivals[i], i) for i in order if kept[i]]
+
+
+def run_arrival(arrivals, frames):
+    queue = collections.deque()
+    counts = dict.fromkeys(('gaps', 'fec', 'plc', 'late'), 0)
+    delays, next_arrival = [], 0
+    for tick in range(frames + 50):
+        now = (tick + 1) * FRAME
+        while next_arrival < len(arrivals) and arrivals[next_arrival][0] <= now:
+            queue.append(arrivals[next_arrival][1])
+            next_arrival += 1
+        if queue:
+            seq = queue.popleft()
+            delays.append(now - seq * FRAME)
+        elif tick < frames:
+            counts['gaps'] += 1
+    return delays, counts
+
+
+def run_buffer(arrivals, frames, buffer):
+    counts = dict.fromkeys(('gaps', 'fec', 'plc', 'late'), 0)
+    delays, next_arrival, started = [], 0, False
+    for tick in range(frames + 50):
+        now = (tick + 1) * FRAME
+        while next_arrival < len(arrivals) and arrivals[next_arrival][0] <= now:
+            arrival, seq = arrivals[next_arrival]
+            buffer.push(seq, seq, arrival)
+            next_arrival += 1
+        popped = buffer.pop()
+        if popped is None:
+            if started and tick < frames:
+                counts['gaps'] += 1
+            continue
+        started = True
+        seq, after = popped
+        if seq is not None:
+            delays.append(now - seq * FRAME)
+        elif after is not None:
+            counts['fec'] += 1
+        else:
+            counts['plc'] += 1
+    counts['late'] = buffer.take_stats()[0]['late']
+    return delays, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--loss", type=float, nargs='+', default=[1, 5], help="percent")
+    parser.add_argument("--jitter", type=float, nargs='+', default=[2, 10, 30], help="mean extra delay, ms")
+    parser.add_argument("--seconds", type=float, default=60)
+    args = parser.parse_args()
+    frames = int(args.seconds / FRAME)
+    minutes = args.seconds / 60
+
+    print(f"{'loss':>5} | {'jitter':>6} | {'playout':>8} | {'delay ms':>8} | {'gaps/min':>8} | "
+          f"{'fec/min':>7} | {'plc/min':>7} | {'late/min':>8}")
+    for loss in args.loss:
+        for jitter in args.jitter:
+            arrivals = make_arrivals(frames, loss / 100, jitter / 1000, np.random.default_rng(0))
+            runs = (
+                ("arrival", lambda: run_arrival(arrivals, frames)),
+                ("fixed 3", lambda: run_buffer(arrivals, frames, audio_mixer.PlayoutBuffer(FRAME, 3, 3))),
+                ("adaptive", lambda: run_buffer(arrivals, frames, audio_mixer.PlayoutBuffer(FRAME))),
+            )
+            for name, run in runs:
+                delays, counts = run()
+                print(f"{loss:>4g}% | {jitter:>4g}ms | {name:>8} | {1000 * np.mean(delays):>8.1f} | "
+                      f"{counts['gaps'] / minutes:>8.1f} | {counts['fec'] / minutes:>7.1f} | "
+                      f"{counts['plc'] / minutes:>7.1f} | {counts['late'] / minutes:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# bench_screen_delta.py
+"""
+Microbenchmark: bytes on the wire and presenter CPU per captured frame for
+screen sharing, full JPEG every frame vs. tile deltas (screen_delta.py).
+
+Scenes are synthetic 1920x1080 screens replayed at the presenter's 10 FPS:
+
+  editor  - a code editor where one character is typed per frame and the
+            cursor blinks
+  slides  - a slide deck that sits on each slide for 50 frames (5 s)
+  video   - a full-screen noise pattern that changes every frame (worst case)
+
+CPU is everything screen_share_loop does after sct.grab(): converting the
+raw BGRA capture, scaling it to 1280x720 and encoding it. The grab itself
+costs the same in both modes and is left out.
+
+Run from the repository root:
+    python benchmarks/bench_screen_delta.py [--frames 200]
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import screen_delta
+
+SIZE = (1920, 1080)
+CODE_LINE = "    result = compute_something(value, other_value) + offset  # comment"
+
+
+def editor_frames(count):
+    base = Image.new("RGB", SIZE, (30, 30, 30))
+    draw = ImageDraw.Draw(base)
+    for row in range(45):
+        draw.text((40, 10 + row * 23), f"{row + 1:>3}  {CODE_LINE[:20 + row * 7 % 50]}", fill=(212, 212, 212))
+    y = 10 + 30 * 23 # The line being typed
+    for n in range(count):
+        img = base.copy()
+        draw = ImageDraw.Draw(img)
+        draw.rectangle((40, y, SIZE[0], y + 22), fill=(30, 30, 30))
+        typed = f" 31  {CODE_LINE[:n % len(CODE_LINE)]}"
+        draw.text((40, y), typed, fill=(212, 212, 212))
+        if n % 10 < 5: # Cursor blinks every half second
+            x = 40 + draw.textlength(typed)
+            draw.rectangle((x, y, x + 2, y + 14), fill=(255, 255, 255))
+        yield img
+
+
+def slide_frames(count):
+    for n in range(count):
+        slide = n // 50
+        img = Image.new("RGB", SIZE, (255, 255, 255))
+        draw = ImageDraw.Draw(img)
+        draw.rectangle((0, 0, SIZE[0], 90), fill=(40, 70 + slide * 30 % 150, 140))
+        draw.text((60, 35), f"Slide {slide + 1}: Quarterly results", fill=(255, 255, 255))
+        for line in range(8):
+            draw.text((80, 150 + line * 55), f"- Bullet point {line + 1} on slide {slide + 1}", fill=(20, 20, 20))
+        draw.ellipse((900, 300, 1150, 550), fill=(200, 80 + slide * 40 % 170, 60))
+        yield img
+
+
+def video_frames(count):
+    rng = np.random.default_rng(0)
+    for _ in range(count):
+        yield Image.fromarray(rng.integers(0, 255, (SIZE[1], SIZE[0], 3), dtype=np.uint8))
+
+
+SCENES = {"editor": editor_frames, "slides": slide_frames, "video": video_frames}
+
+
+def captures(scene, count):
+    """Raw BGRA screenshots, like mss' sct_img.raw."""
+    for img in scene(count):
+        yield img.convert("RGBA").tobytes("raw", "BGRA")
+
+
+def to_image(raw):
+    img = Image.frombytes("RGB", SIZE, raw, "raw", "BGRX")
+    img.thumbnail((1280, 720))
+    return img
+
+
+def run_full(scene, count):
+    total_bytes = 0
+    elapsed = 0.0
+    for raw in captures(scene, count):
+        start = time.perf_counter()
+        with io.BytesIO() as output:
+            to_image(raw).save(output, format="JPEG", quality=75)
+            total_bytes += len(output.getvalue())
+        elapsed += time.perf_counter() - start
+    return total_bytes, elapsed
+
+
+def run_delta(scene, count):
+    encoder = screen_delta.TileEncoder(quality=75, max_size=(1280, 720))
+    total_bytes = 0
+    elapsed = 0.0
+    for n, raw in enumerate(captures(scene, count)):
+        if n:
+            encoder.last_keyframe -= 0.1 # Replay at 10 FPS without sleeping
+        start = time.perf_counter()
+        encoded = encoder.encode_capture(raw, SIZE)
+        elapsed += time.perf_counter() - start
+        if encoded:
+            total_bytes += len(encoded[1])
+    return total_bytes, elapsed, encoder
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"Screen share encoding, {SIZE[0]}x{SIZE[1]} scaled to 1280x720, {args.frames} frames at 10 FPS")
+    print(f"{'':>7} | {'full JPEG':^20} | {'tile delta':^20} | {'reduction':^15}")
+    print(f"{'scene':>7} | {'KB/s':>9} {'ms/frame':>10} | {'KB/s':>9} {'ms/frame':>10} | {'bytes':>6} {'cpu':>8}")
+    for name, scene in SCENES.items():
+        full_bytes, full_time = run_full(scene, args.frames)
+        delta_bytes, delta_time, encoder = run_delta(scene, args.frames)
+        seconds = args.frames / 10
+        print(f"{name:>7} | {full_bytes / 1024 / seconds:>9.1f} {full_time * 1000 / args.frames:>10.2f} | "
+              f"{delta_bytes / 1024 / seconds:>9.1f} {delta_time * 1000 / args.frames:>10.2f} | "
+              f"{full_bytes / delta_bytes:>5.1f}x {full_time / delta_time:>7.1f}x   ({encoder.stats()})")
+
+
+if __name__ == "__main__":
+    main()
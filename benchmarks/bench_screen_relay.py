@@ -0,0 +1,152 @@
+# bench_screen_relay.py
+"""
+Microbenchmark: how long one screen frame takes to get from the presenter to
+every viewer through the server's relay ("delivered"), and how long the
+presenter's connection is tied up before the next frame can be read ("busy").
+
+  legacy    - the old handle_client relay: recv() in 8 KB pieces, image_data += chunk,
+              then header and data sent to each viewer in turn
+  zero-copy - the current relay: FrameReader receives the frame with recv_into into a
+              pooled buffer, each viewer's writer thread sends header + that same buffer
+              with one gather write
+
+Run from the repository root:
+    python benchmarks/bench_screen_relay.py [--viewers 50] [--rounds 5]
+"""
+import argparse
+import os
+import queue
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import protocol
+
+FRAME_SIZES = [200 * 1024, 500 * 1024, 1024 * 1024, 2 * 1024 * 1024]
+
+
+class Viewer:
+    """Reads exactly `expected` bytes per frame and signals when it has them all."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.expected = 0
+        self.start = threading.Event()
+        self.done = threading.Event()
+        self.scratch = bytearray(256 * 1024)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        view = memoryview(self.scratch)
+        while True:
+            self.start.wait()
+            self.start.clear()
+            remaining = self.expected
+            while remaining:
+                received = self.sock.recv_into(view[:min(remaining, len(view))])
+                if not received:
+                    return
+                remaining -= received
+            self.done.set()
+
+
+def legacy_relay(presenter_sock, viewer_socks, filesize):
+    header = f"CMD:SCREEN_DATA:{filesize}\n".encode('utf-8')
+    image_data = b''
+    bytes_received = 0
+    while bytes_received < filesize:
+        chunk = presenter_sock.recv(min(8192, filesize - bytes_received))
+        image_data += chunk
+        bytes_received += len(chunk)
+    for sock in viewer_socks:
+        sock.sendall(header)
+        sock.sendall(image_data)
+
+
+def make_zero_copy_relay(viewer_socks):
+    pool = protocol.BufferPool()
+    queues = []
+
+    def writer(sock, q):
+        while True:
+            header, pooled = q.get()
+            protocol.send_buffers(sock, (header, pooled.view))
+            pooled.release()
+
+    for sock in viewer_socks:
+        q = queue.SimpleQueue()
+        queues.append(q)
+        threading.Thread(target=writer, args=(sock, q), daemon=True).start()
+
+    def relay(presenter_sock, frames):
+        frame_type, pooled = next(frames)
+        header = protocol.HEADER.pack(protocol.PROTOCOL_VERSION, frame_type, len(pooled))
+        for q in queues:
+            pooled.retain()
+            q.put((header, pooled))
+        pooled.release()
+
+    return pool, relay
+
+
+def run(mode, frame_size, viewer_count, rounds):
+    presenter_out, presenter_in = socket.socketpair()
+    pairs = [socket.socketpair() for _ in range(viewer_count)]
+    server_side = [a for a, b in pairs]
+    viewers = [Viewer(b) for a, b in pairs]
+    payload = os.urandom(frame_size)
+
+    if mode == "legacy":
+        wire = f"CMD:SCREEN_DATA:{frame_size}\n".encode('utf-8')
+        header_len = len(wire)
+        relay = lambda: legacy_relay(presenter_in, server_side, frame_size)
+        presenter_bytes = payload
+    else:
+        pool, zero_copy = make_zero_copy_relay(server_side)
+        frames = protocol.FrameReader(presenter_in, pool)
+        header_len = protocol.HEADER_SIZE
+        relay = lambda: zero_copy(presenter_in, frames)
+        presenter_bytes = protocol.encode_frame(protocol.FRAME_SCREEN, payload)
+
+    latencies = []
+    busy = []
+    for _ in range(rounds):
+        for viewer in viewers:
+            viewer.expected = header_len + frame_size
+            viewer.done.clear()
+            viewer.start.set()
+        t0 = time.perf_counter()
+        sender = threading.Thread(target=presenter_out.sendall, args=(presenter_bytes,))
+        sender.start()
+        relay()
+        busy.append(time.perf_counter() - t0)
+        for viewer in viewers:
+            viewer.done.wait()
+        latencies.append(time.perf_counter() - t0)
+        sender.join()
+
+    for sock in [presenter_out, presenter_in] + [s for pair in pairs for s in pair]:
+        sock.close()
+    return statistics.median(latencies), statistics.median(busy)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--viewers", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"Screen frame relay latency, {args.viewers} viewers, median of {args.rounds} frames")
+    print(f"{'':>8} | {'legacy':^21} | {'zero-copy':^21}")
+    print(f"{'frame':>8} | {'delivered':>10} {'busy':>10} | {'delivered':>10} {'busy':>10}")
+    for size in FRAME_SIZES:
+        legacy, legacy_busy = run("legacy", size, args.viewers, args.rounds)
+        zero_copy, zero_copy_busy = run("zero-copy", size, args.viewers, args.rounds)
+        print(f"{size // 1024:>5} KB | {legacy * 1000:>7.1f} ms {legacy_busy * 1000:>7.1f} ms | "
+              f"{zero_copy * 1000:>7.1f} ms {zero_copy_busy * 1000:>7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# bench_sfu.py
+"""
+Benchmark: server CPU per room, mixing vs selective forwarding (SFU).
+
+One second of audio (50 frames of 960 samples) for a room of N
+participants, every one of them sending a frame per tick (most of them
+quiet), the way the server's UDP thread and mixer see it:
+
+  mix  - audio_mixer.AudioMixer: push every decoded frame into its jitter
+         buffer, one tick per frame, and build each listener's mix-minus
+         packet (no Opus here: decoding and re-encoding every stream would
+         only add to this side)
+  sfu  - audio_mixer.SpeakerSelector: read the level byte of every packet
+         and build one relayed AUS: packet, for every other listener, for
+         each of the loudest SFU_MAX_SPEAKERS
+
+Datagrams are built but not sent, so only the server's own work is timed;
+"packets out" and "KB out" are what it would hand to sendto(). "rooms/core"
+is how many such rooms one core keeps up with in real time.
+
+Run from the repository root:
+    python benchmarks/bench_sfu.py [--participants 5 20 50] [--talkers 3]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import audio_mixer
+
+RATE = 48000
+CHUNK = 960
+TICKS = 50 # One second of 20 ms frames
+
+
+def make_frames(participants, talkers, rng):
+    """Per participant: (pcm bytes, level); the first `talkers` are loud, the rest room noise."""
+    frames = []
+    for i in range(participants):
+        amplitude = 4000 if i < talkers else 20
+        pcm = rng.integers(-amplitude, amplitude, CHUNK, dtype=np.int16).tobytes()
+        frames.append((pcm, audio_mixer.audio_level(pcm)))
+    return frames
+
+
+def run_mix(senders, frames):
+    mixer = audio_mixer.AudioMixer(CHUNK, target=1)
+    packets = sent = 0
+    for seq in range(TICKS):
+        for sender, (pcm, _) in zip(senders, frames):
+            mixer.push(sender, seq, pcm)
+        mix = mixer.tick()
+        for listener in senders:
+            pcm = mix.for_listener(listener)
+            if pcm is not None:
+                packet = f"AUD:{mix.label_for(listener)}:".encode('utf-8') + pcm
+                packets += 1
+                sent += len(packet)
+    return packets, sent
+
+
+def run_sfu(senders, frames):
+    selector = audio_mixer.SpeakerSelector()
+    data = [audio_mixer.pack_audio(0, pcm, level) for pcm, level in frames]
+    packets = sent = 0
+    now = 0.0
+    for seq in range(TICKS):
+        now += CHUNK / RATE
+        for sender, datagram in zip(senders, data):
+            _, level, _, _ = audio_mixer.unpack_audio(datagram)
+            if selector.forward(sender, level, now):
+                packet = f"AUS:{sender}:".encode('utf-8') + datagram[4:]
+                listeners = sum(1 for listener in senders if listener != sender)
+                packets += listeners
+                sent += len(packet) * listeners
+    return packets, sent
+
+
+def timed(fn, senders, frames, budget=1.0):
+    """(mean seconds per call, (packets, bytes) out per call), repeating for about `budget` seconds."""
+    out = fn(senders, frames)
+    runs, start = 0, time.perf_counter()
+    while time.perf_counter() - start < budget:
+        fn(senders, frames)
+        runs += 1
+    return (time.perf_counter() - start) / runs, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--participants", type=int, nargs='+', default=[5, 20, 50])
+    parser.add_argument("--talkers", type=int, default=3)
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    print(f"{'participants':>12} | {'mode':>4} | {'ms per s':>8} | {'rooms/core':>10} | {'packets out':>11} | {'KB out':>8}")
+    for count in args.participants:
+        senders = [f"user{i}" for i in range(count)]
+        frames = make_frames(count, min(args.talkers, count), rng)
+        for name, fn in (("mix", run_mix), ("sfu", run_sfu)):
+            seconds, (packets, sent) = timed(fn, senders, frames)
+            print(f"{count:>12} | {name:>4} | {seconds * 1000:>8.2f} | {1 / seconds:>10.0f} | {packets:>11} | "
+                  f"{sent / 1024:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# bench_transfer_compression.py
+"""
+Microbenchmark: on-the-wire compression of file transfers (transfer.CODECS).
+
+For a few kinds of file, each codec compresses and decompresses the data
+one 1 MB FILE_DATA frame at a time, the way uploads and downloads do, and
+reports the ratio, compress / decompress speed and the resulting transfer
+time over a link of the given speed (the sender compresses the next frame
+while the previous one is on the wire, so the slower of the two wins).
+
+  csv       - generated log lines (timestamps, ids, floats)
+  source    - this repository's .py files, repeated (long repeats flatter lzma)
+  random    - os.urandom, stands in for media and archives
+
+"picked" shows what transfer.pick_codec would do with the file.
+
+Run from the repository root:
+    python benchmarks/bench_transfer_compression.py [--size-mb 32] [--link-mbit 100]
+"""
+import argparse
+import glob
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import transfer
+
+FRAME_SIZE = 1024 * 1024
+
+
+def make_csv(size):
+    rng = random.Random(1)
+    lines = []
+    total = 0
+    while total < size:
+        line = f"{total},2026-10-18T12:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d},user{rng.randint(1, 500)},{rng.random():.6f},OK\n"
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines).encode()[:size]
+
+
+def make_source(size):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    text = b''.join(open(path, 'rb').read() for path in sorted(glob.glob(os.path.join(root, '*.py'))))
+    return (text * (size // len(text) + 1))[:size]
+
+
+KINDS = {
+    "csv": make_csv,
+    "source": make_source,
+    "random": os.urandom,
+}
+
+
+def run(codec, data):
+    frames = [data[i:i + FRAME_SIZE] for i in range(0, len(data), FRAME_SIZE)]
+    start = time.perf_counter()
+    packed = [transfer.pack_file_data(frame, codec.name)[1] for frame in frames]
+    compress = time.perf_counter() - start
+    start = time.perf_counter()
+    for frame, payload in zip(frames, packed):
+        if len(payload) < len(frame):
+            codec.decompress(payload, len(frame))
+    decompress = time.perf_counter() - start
+    return sum(map(len, packed)), compress, decompress
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=32)
+    parser.add_argument("--link-mbit", type=float, default=100)
+    args = parser.parse_args()
+    size = args.size_mb * 1024 * 1024
+    link = args.link_mbit * 1e6 / 8 # bytes/s
+    mb = 1024 * 1024
+
+    print(f"{args.size_mb} MB per kind, {args.link_mbit:g} Mbit/s link, 1 MB frames")
+    print(f"{'kind':>7} | {'codec':>5} | {'ratio':>6} | {'comp MB/s':>9} | {'decomp MB/s':>11} | {'transfer s':>10} | picked")
+    for kind, make in KINDS.items():
+        data = make(size)
+        with tempfile.NamedTemporaryFile(suffix='.dat', delete=False) as f:
+            f.write(data)
+        try:
+            picked = transfer.pick_codec(f.name, transfer.parse_capabilities(transfer.capabilities())) or "-"
+        finally:
+            os.unlink(f.name)
+        print(f"{kind:>7} | {'-':>5} | {1:>6.1f} | {'':>9} | {'':>11} | {size / link:>10.2f} |")
+        for name, codec in transfer.CODECS.items():
+            wire, compress, decompress = run(codec, data)
+            seconds = max(wire / link, compress, decompress)
+            decomp = f"{size / decompress / mb:.0f}" if wire < size else "-" # Nothing to decompress
+            print(f"{kind:>7} | {name:>5} | {size / wire:>6.1f} | {size / compress / mb:>9.0f} | "
+                  f"{decomp:>11} | {seconds:>10.2f} | {picked if name == picked else ''}")
+
+
+if __name__ == "__main__":
+    main()
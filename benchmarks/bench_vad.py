@@ -0,0 +1,108 @@
+# bench_vad.py
+"""
+Benchmark: client-side voice activity detection (audio_mixer.VoiceDetector)
+in a meeting where a few people talk and everyone else listens.
+
+Every participant's microphone hears room noise (about -60 dBov, some of
+them with a louder fan); the talkers take turns, speaking in syllable-length
+bursts with short pauses. One minute of 960-sample frames is generated,
+then run through the server's AudioMixer twice:
+
+  always  - the old client: every frame is sent, silence included
+  vad     - only the frames VoiceDetector calls speech (plus its hangover)
+
+  packets/s  - datagrams the server receives per second for the room
+  mixed      - senders in the average tick's mix
+  tick us    - CPU time of one mixer tick (push + tick), averaged
+  missed     - speech frames the VAD did not send (clipped syllables)
+
+Run from the repository root:
+    python benchmarks/bench_vad.py [--participants 20] [--talkers 3] [--seconds 60]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import audio_mixer
+
+RATE = 48000
+CHUNK = 960
+FRAME = CHUNK / RATE
+
+
+def make_meeting(participants, talkers, seconds, rng):
+    """(frames[participant][tick] as int16 arrays, is_speech[participant][tick])."""
+    ticks = int(seconds / FRAME)
+    t = np.arange(CHUNK) / RATE
+    frames, speech = [], []
+    turn = max(1, ticks // (talkers * 4)) # Talkers take turns, four rounds each
+    for p in range(participants):
+        noise_level = 30 if p % 5 else 150 # Every fifth one sits next to a fan
+        rows, flags = [], []
+        for tick in range(ticks):
+            frame = rng.normal(0, noise_level, CHUNK)
+            talking = p < talkers and (tick // turn) % talkers == p
+            # Syllables: 180 ms on, 60 ms off
+            voiced = talking and (tick % 12) < 9
+            if voiced:
+                pitch = 120 + 40 * p
+                frame += 3000 * np.sin(2 * np.pi * pitch * (t + tick * FRAME))
+            rows.append(np.clip(frame, -32768, 32767).astype(np.int16))
+            flags.append(voiced)
+        frames.append(rows)
+        speech.append(flags)
+    return frames, speech
+
+
+def run(frames, send):
+    """Feeds the mixer the frames `send` allows; returns (packets, mixed per tick, seconds per tick)."""
+    mixer = audio_mixer.AudioMixer(CHUNK)
+    ticks = len(frames[0])
+    pcm = [[frame.tobytes() for frame in rows] for rows in frames]
+    packets = mixed = 0
+    start = time.perf_counter()
+    for tick in range(ticks):
+        for p, rows in enumerate(pcm):
+            if send[p][tick]:
+                mixer.push(p, tick, rows[tick])
+                packets += 1
+        mix = mixer.tick()
+        if mix is not None:
+            mixed += len(mix.senders)
+    return packets, mixed / ticks, (time.perf_counter() - start) / ticks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--participants", type=int, default=20)
+    parser.add_argument("--talkers", type=int, default=3)
+    parser.add_argument("--seconds", type=float, default=60)
+    args = parser.parse_args()
+
+    frames, speech = make_meeting(args.participants, args.talkers, args.seconds, np.random.default_rng(0))
+    ticks = len(frames[0])
+    always = [[True] * ticks for _ in frames]
+    start = time.perf_counter()
+    vad = []
+    for rows in frames:
+        detector = audio_mixer.VoiceDetector()
+        vad.append([detector.is_speech(audio_mixer.audio_level(frame.tobytes())) for frame in rows])
+    vad_us = (time.perf_counter() - start) / (ticks * len(frames)) * 1e6
+    missed = sum(s and not v for rows_s, rows_v in zip(speech, vad) for s, v in zip(rows_s, rows_v))
+    voiced = sum(map(sum, speech))
+
+    print(f"{args.participants} participants, {args.talkers} talkers, {args.seconds:g} s; "
+          f"VAD costs {vad_us:.0f} us per frame on the client")
+    print(f"{'client':>7} | {'packets/s':>9} | {'mixed':>5} | {'tick us':>7} | {'missed':>6}")
+    for name, send in (("always", always), ("vad", vad)):
+        packets, mixed, tick = run(frames, send)
+        miss = f"{missed / voiced:.1%}" if name == "vad" else "-"
+        print(f"{name:>7} | {packets / args.seconds:>9.0f} | {mixed:>5.1f} | {tick * 1e6:>7.0f} | {miss:>6}")
+
+
+if __name__ == "__main__":
+    main()
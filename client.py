@@ -1,5 +1,6 @@
 # client.py
 import socket
+import struct
 import threading
 import tkinter as tk
 from tkinter import scrolledtext, simpledialog, messagebox, filedialog, ttk
@@ -8,9 +9,15 @@ import time
 import mss
 from PIL import Image, ImageTk
 import io
+import json
 import pyaudio
 import numpy as np
 import cv2 # New import
+import protocol
+import screen_delta
+import transfer
+import audio_mixer
+import video_packets
 
 # Try to import opuslib, but make it optional
 try:
@@ -23,8 +30,49 @@ except Exception:
 # --- Audio Configuration ---
 FORMAT = pyaudio.paInt16
 CHANNELS = 1
-RATE = 44100
-CHUNK = 1024
+RATE = 48000 # Opus's own rate; a sound card that can't run at it is resampled (open_audio_stream)
+FRAME_MS = 20 # Opus takes 10, 20, 40 or 60 ms frames
+CHUNK = RATE * FRAME_MS // 1000 # 960 samples
+SPEAKER_HIGHLIGHT = "#2ecc71" # Outline of a speaking user's video feed
+CAPTURE_RING_BLOCKS = 25 # Mic blocks (0.5 s) the send thread may fall behind before the oldest are dropped
+PLAYOUT_RING_FRAMES = 10 # Frames (200 ms) queued for the speaker before the oldest are dropped
+PLAYOUT_TARGET_FRAMES = 2 # Frames kept queued ahead of the speaker (the jitter is absorbed before them)
+AUDIO_LATENCY_REPORT_INTERVAL = 10.0 # Seconds between [DEBUG] audio latency lines
+AUDIO_SOCKET_BUFFER = 256 * 1024 # SO_RCVBUF / SO_SNDBUF of the audio socket
+VIDEO_SOCKET_BUFFER = 4 * 1024 * 1024 # Of the video socket, which gets bursts of everyone's JPEG frames
+
+def opus_mix_supported():
+    """True if we can decode Opus mixes from the server."""
+    if not OPUS_AVAILABLE:
+        return False
+    try:
+        opuslib.Decoder(RATE, CHANNELS)
+        return True
+    except Exception:
+        return False
+
+# --- Video Configuration ---
+# Webcam rungs, cheapest first: (frame size, JPEG quality, frames per second).
+# The sender moves along them from its viewers' feedback (see video_packets.py).
+VIDEO_LADDER = [
+    ((160, 120), 40, 10),
+    ((320, 240), 50, 15),
+    ((640, 360), 60, 15),
+    ((960, 540), 70, 20),
+    ((1280, 720), 75, 25),
+]
+VIDEO_START_RUNG = 1 # 320x240 at 15 fps until the first feedback
+VIDEO_BUDGET = 50_000_000 # Bits/s our video may take, times its viewers (a fraction of a gigabit LAN)
+VIDEO_FEED_SIZE = (320, 240) # Frames are shown at most this big in the video grid
+
+# --- Screen Share Configuration ---
+SCREEN_DELTA_MODE = True # Send only changed tiles between keyframes (see screen_delta.py)
+
+# --- File Transfer Configuration ---
+UPLOAD_FRAME_SIZE = 1024 * 1024 # Bytes per FILE_DATA frame on the data connection (divides transfer.CHUNK_SIZE)
+
+# --- Debug Output ---
+QUIET_COMMANDS = ('CMD:SPEAKERS:', 'CMD:VIDEO_FEEDBACK:') # Arrive every second or more often: not echoed
 
 class ChatClient:
     def __init__(self):
@@ -32,6 +80,7 @@ class ChatClient:
         self.HOST = simpledialog.askstring("Server IP", "Enter Server IP:", initialvalue="172.16.141.51") # Use your IP
         if not self.HOST: exit()
         self.PORT = 6543
+        self.DATA_PORT = 6545 # File bodies go over separate data connections
         
         self.NICKNAME = None
         self.client_socket = None
@@ -41,26 +90,55 @@ class ChatClient:
 
         self.socket_lock = threading.Lock() 
         self.available_files = {}
-        self.pending_upload = None
-        self.downloading = False
+        self.pending_uploads = {} # basename -> (filepath, chunk hashes), waiting for FILE_UPLOAD_TOKEN/EXISTS
+        self.pending_downloads = {} # filename -> transfer.PartialFile, waiting for FILE_DOWNLOAD_TOKEN
+        self.active_downloads = set() # Filenames with a download thread running
+        self.transfer_codecs = () # Compression the server agreed to for file transfers (CMD:CAPS)
         self.connected = True
         self.is_presenting = False
         self.presenter_thread = None
         self.screen_view_window = None
         self.screen_view_label = None
+        self.screen_encoder = None # Presenter side, set while sharing
+        self.screen_compositor = screen_delta.TileCompositor() # Viewer side
         self.audio_running = False
         self.is_muted = False
-        self.udp_socket = None
+        self.udp_socket = None # Audio only
         self.server_udp_addr = None # (host, port)
+        self.video_socket = None # Video has its own socket and receive thread
+        self.server_video_addr = None
+        self.video_frames = video_packets.Reassembler() # Peers' webcam frames, from their fragments
+        self.video_frame_id = 0 # Keeps counting across camera on/off, so the server never sees old numbers
+        self.video_rate = video_packets.RateController(VIDEO_LADDER, VIDEO_START_RUNG, VIDEO_BUDGET)
+        self.video_decode = {} # sender -> [ms spent decoding their frames, frames] since the last feedback
         self.p_audio = pyaudio.PyAudio()
         self.mic_stream = None
         self.speaker_stream = None
+        self.mic_resampler = None # audio_mixer.Resampler when the mic can't run at RATE
+        self.mic_pending = np.zeros(0, dtype=np.int16) # Resampled samples not yet making up a frame
+        self.speaker_resampler = None
+        # Both streams run in callback mode; these rings are all that connects
+        # them to the send, receive and playout threads
+        self.capture_ring = audio_mixer.SampleRing(CAPTURE_RING_BLOCKS) # Mic callback -> send thread
+        self.playout_ring = audio_mixer.SampleRing(PLAYOUT_RING_FRAMES) # Receive/playout thread -> speaker callback
+        self.mic_ready = threading.Event() # Set by the mic callback after each block
+        self.playout_wanted = threading.Event() # Set by the speaker callback when the ring runs low
+        self.speaker_playing = False # The last speaker callback was filled, so running dry is a gap
+        self.playout_gaps = 0
+        self.capture_latency = audio_mixer.LatencyMeter() # Mic ADC -> sendto
+        self.playout_latency = audio_mixer.LatencyMeter() # recvfrom -> speaker DAC, jitter buffer included
         
         # --- Opus Codec State ---
         self.opus_encoder = None
         self.opus_decoder = None
-        # Add a dictionary to store decoders for other users
+        # SFU mode: one decoder per forwarded speaker, mixed locally
         self.peer_opus_decoders = {}
+        self.sfu_mixer = None # audio_mixer.AudioMixer, made on the first AUS: packet
+        # Mix mode: the server's mix, reordered and held back as long as the jitter needs
+        self.playout_buffer = audio_mixer.PlayoutBuffer(CHUNK / RATE)
+        self.mix_opus = False # Whether the mix last played was Opus
+        self.mix_last = None # Last raw mix frame, repeated once for a lost one
+        self.loss_stats = {'recovered': 0, 'concealed': 0} # Lost mix frames rebuilt from FEC / by PLC
         # --- End of Opus state ---
         
         # --- NEW: Video State ---
@@ -68,12 +146,17 @@ class ChatClient:
         self.video_send_thread = None
         self.video_window = None # Toplevel window for video grid
         self.video_feeds = {} # Maps nickname -> tk.Label
+        self.active_speakers = () # Who is in the audio mix, loudest first (CMD:SPEAKERS)
         self.video_capture = None # Our own webcam
         # --- End of new state ---
 
         # --- Build the GUI ---
         self.build_gui()
         
+        # Offer our transfer codecs and audio formats, the server answers with what it will use
+        audio_formats = 'opus,pcm' if opus_mix_supported() else 'pcm'
+        self.send_with_lock(protocol.encode_text(f"CMD:CAPS:{transfer.capabilities()};audio={audio_formats}"))
+
         # --- Start receive thread (identical) ---
         self.receive_thread = threading.Thread(target=self.receive_handler)
         self.receive_thread.daemon = True
@@ -100,12 +183,15 @@ class ChatClient:
                 
                 self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.client_socket.connect((self.HOST, self.PORT))
-                server_cmd = self.client_socket.recv(1024).decode('utf-8').strip()
+                # Frames left over after the handshake stay in this generator
+                # and are picked up by receive_handler.
+                self.frames = protocol.read_frames(self.client_socket)
+                server_cmd = self.next_text_frame()
                 if server_cmd != 'NICK':
                     messagebox.showerror("Protocol Error", f"Unexpected server response: {server_cmd}")
                     return False
-                self.client_socket.send(self.NICKNAME.encode('utf-8'))
-                response = self.client_socket.recv(1024).decode('utf-8').strip()
+                self.client_socket.sendall(protocol.encode_text(self.NICKNAME))
+                response = self.next_text_frame()
                 if response.startswith('ERROR:NICK_TAKEN:'):
                     print(f"Username '{self.NICKNAME}' is already taken. Retrying...")
                     self.client_socket.close()
@@ -128,6 +214,13 @@ class ChatClient:
         messagebox.showerror("Connection Failed", f"Failed to connect after {max_attempts} attempts.")
         return False
 
+    def next_text_frame(self):
+        """Blocks until the next frame arrives and returns it as text."""
+        frame_type, payload = next(self.frames)
+        if frame_type != protocol.FRAME_TEXT:
+            raise protocol.ProtocolError(f"Expected a text frame, got type {frame_type}")
+        return payload.decode('utf-8').strip()
+
     # --- MODIFIED: build_gui Function ---
     def build_gui(self):
         """
@@ -190,6 +283,10 @@ class ChatClient:
         self.video_button = tk.Button(self.controls_frame, text="Start Video", command=self.toggle_video, bg="blue", fg="white")
         self.video_button.pack(fill=tk.X, pady=(5, 0))
 
+        self.speakers_label = tk.Label(self.controls_frame, text="", font=("Helvetica", 9), fg="#2e8b57",
+                                       anchor='w', justify=tk.LEFT, wraplength=180)
+        self.speakers_label.pack(fill=tk.X, pady=(5, 0))
+
         # --- (Status, Progress, Message Entry are the same) ---
         self.status_label = tk.Label(self.window, text="Ready", font=("Helvetica", 9), fg="green", anchor='w')
         self.status_label.pack(fill=tk.X, padx=10, pady=(5, 0))
@@ -231,12 +328,9 @@ class ChatClient:
             if not self.connected:
                 self.safe_ui_update(self.display_message, "[SYSTEM] Not connected.\n")
                 return
-            try:
-                self.client_socket.send(message.encode('utf-8'))
+            self.send_with_lock(protocol.encode_text(message))
+            if self.connected:
                 self.msg_entry.delete(0, tk.END)
-            except Exception as e:
-                self.connected = False
-                self.safe_ui_update(self.display_message, f"[SYSTEM] Connection lost: {e}\n")
 
     # --- MODIFIED: on_closing Function ---
     def on_closing(self):
@@ -244,13 +338,12 @@ class ChatClient:
         self.audio_running = False
         self.is_video_on = False # --- NEW
         
-        try: self.client_socket.send("".encode('utf-8'))
-        except: pass
         try: self.client_socket.close()
         except: pass
         
         try:
             if self.udp_socket: self.udp_socket.close()
+            if self.video_socket: self.video_socket.close()
             if self.mic_stream: self.mic_stream.stop_stream(); self.mic_stream.close()
             if self.speaker_stream: self.speaker_stream.stop_stream(); self.speaker_stream.close()
             self.p_audio.terminate()
@@ -265,56 +358,111 @@ class ChatClient:
         if not self.connected:
             messagebox.showerror("Not Connected", "Not connected to server.")
             return
-        if self.is_presenting or self.screen_view_window:
-            messagebox.showwarning("Busy", "Cannot send files while presenting or viewing.")
-            return
             
         filepath = filedialog.askopenfilename()
         if not filepath: return
-        filesize = os.path.getsize(filepath)
         basename = os.path.basename(filepath)
-        self.pending_upload = (filepath, basename)
+        if basename in self.pending_uploads:
+            messagebox.showwarning("Busy", f"{basename} is already being sent.")
+            return
+        self.pending_uploads[basename] = None # Hashing
+        threading.Thread(target=self.offer_upload_thread, args=(filepath, basename), daemon=True).start()
+
+    def offer_upload_thread(self, filepath, basename):
+        """
+        [THREAD] Hashes the file and announces it with its content hash, so the
+        server can skip the upload if it already stores the same content.
+        """
+        self.safe_ui_update(self.status_label.config, text=f"Hashing: {basename}", fg="blue")
         try:
-            self.client_socket.send(f"CMD:FILE_UPLOAD_START:{basename}:{filesize}".encode('utf-8'))
+            filesize = os.path.getsize(filepath)
+            hashes = transfer.hash_file_chunks(filepath)
+        except OSError as e:
+            self.pending_uploads.pop(basename, None)
+            self.safe_ui_update(self.display_message, f"[SYSTEM] ✗ Cannot read {basename}: {e}\n")
+            return
+        self.pending_uploads[basename] = (filepath, hashes)
+        content_id = transfer.content_hash(hashes)
+        self.send_with_lock(protocol.encode_text(f"CMD:FILE_UPLOAD_START:{basename}:{filesize}:{content_id}"))
+        if self.connected:
             self.safe_ui_update(self.display_message, f"[SYSTEM] Requesting to send {basename}...\n")
-            self.safe_ui_update(self.send_file_button.config, state=tk.DISABLED)
-        except Exception as e:
-            self.connected = False
-            self.safe_ui_update(self.display_message, f"[SYSTEM] Failed to send file request: {e}\n")
 
-    def upload_file_thread(self, filepath, basename):
+    def open_data_channel(self, token):
+        """Opens a data connection for the transfer the server issued `token` for."""
+        sock = socket.create_connection((self.HOST, self.DATA_PORT))
+        sock.sendall(protocol.encode_text(f"DATA:{token}"))
+        return sock
+
+    def upload_file_thread(self, filepath, basename, hashes, token):
+        """
+        [THREAD] Sends one file on its own data connection, so chat and screen
+        frames never wait behind it and several files can go at once.
+        """
         try:
             filesize = os.path.getsize(filepath)
-            self.safe_ui_update(self.status_label.config, text=f"Uploading: {basename}", fg="blue")
-            bytes_sent = 0
-            with self.socket_lock:
+            with self.open_data_channel(token) as sock:
+                frames = protocol.read_frames(sock)
+                reply = self.next_data_reply(frames)
+                if not reply.startswith('CMD:FILE_READY_TO_RECV:'):
+                    raise transfer.TransferError(reply)
+                # CMD:FILE_READY_TO_RECV:<filename>:<offset>:<hash of the last verified chunk>
+                _, offset, last_hash = reply.split(':', 2)[2].rsplit(':', 2)
+                offset = int(offset)
+                # Only resume if the server's partial copy ends with the same chunk as our file
+                if offset and (offset > filesize or hashes[transfer.chunk_count(offset) - 1] != last_hash):
+                    offset = 0
+                if offset:
+                    self.safe_ui_update(self.display_message, f"[SYSTEM] Resuming upload of {basename} at {offset / (1024 * 1024):.1f} MB.\n")
+                codec = transfer.pick_codec(filepath, self.transfer_codecs)
+                sock.sendall(protocol.encode_text(f"CMD:FILE_UPLOAD_RESUME:{basename}:{offset}:{codec or transfer.NO_CODEC}"))
+                self.safe_ui_update(self.status_label.config, text=f"Uploading: {basename}", fg="blue")
+                bytes_sent = offset
+                wire_bytes = 0
+                started = time.monotonic()
+                rate = "nothing left to send"
+                buffer = memoryview(bytearray(UPLOAD_FRAME_SIZE))
                 with open(filepath, 'rb') as f:
-                    while (chunk := f.read(4096)):
-                        self.client_socket.send(chunk)
-                        bytes_sent += len(chunk)
+                    f.seek(offset)
+                    while (n := f.readinto(buffer)):
+                        frame_type, payload = transfer.pack_file_data(buffer[:n], codec)
+                        header = protocol.HEADER.pack(protocol.PROTOCOL_VERSION, frame_type, len(payload))
+                        protocol.send_buffers(sock, (header, payload))
+                        wire_bytes += len(payload)
+                        bytes_sent += n
+                        if bytes_sent % transfer.CHUNK_SIZE == 0 or bytes_sent == filesize: # Last frame of a chunk
+                            index = transfer.chunk_count(bytes_sent) - 1
+                            sock.sendall(protocol.encode_text(f"CMD:FILE_CHUNK_HASH:{index}:{hashes[index]}"))
                         progress = (bytes_sent / filesize) * 100
+                        rate = transfer.describe_rate(bytes_sent - offset, wire_bytes, time.monotonic() - started, codec)
                         self.safe_ui_update(self.progress_bar.config, value=progress)
                         self.safe_ui_update(self.status_label.config, 
-                                          text=f"Uploading: {basename} - {int(progress)}%")
+                                          text=f"Uploading: {basename} - {int(progress)}% ({rate})")
+                reply = self.next_data_reply(frames)
+                if not reply.startswith('CMD:FILE_UPLOAD_COMPLETE:'):
+                    raise transfer.TransferError(reply)
+            listed = reply.split(':', 2)[2]
+            note = f" (listed as {listed}, the name was taken)" if listed != basename else ""
             self.safe_ui_update(self.status_label.config, text="Upload complete!", fg="green")
-            self.safe_ui_update(self.display_message, f"[SYSTEM] ✓ Upload complete for {basename}.\n")
+            self.safe_ui_update(self.display_message, f"[SYSTEM] ✓ Upload complete for {basename}{note} ({rate}).\n")
         except Exception as e:
             self.safe_ui_update(self.status_label.config, text="Upload failed!", fg="red")
             self.safe_ui_update(self.display_message, f"[SYSTEM] ✗ Upload failed: {e}\n")
         finally:
-            self.pending_upload = None
-            self.safe_ui_update(self.send_file_button.config, state=tk.NORMAL)
+            self.pending_uploads.pop(basename, None)
             self.window.after(3000, lambda: self.status_label.config(text="Ready", fg="green"))
             self.window.after(3000, lambda: self.progress_bar.config(value=0))
+
+    def next_data_reply(self, frames):
+        """Next text frame on a data connection ("connection closed" if there is none)."""
+        for frame_type, payload in frames:
+            if frame_type == protocol.FRAME_TEXT:
+                return payload.decode('utf-8').strip()
+        return "Server closed the data connection"
             
     def request_download(self):
         if not self.connected:
             messagebox.showerror("Not Connected", "Not connected to server.")
             return
-        # Add other checks from your debugged code
-        if self.is_presenting or self.screen_view_window or self.downloading:
-            messagebox.showwarning("Busy", "Cannot download while another operation is in progress.")
-            return
             
         try:
             # --- Get selected item from Treeview ---
@@ -326,55 +474,39 @@ class ChatClient:
             # The filename is the iid we used when inserting
             filename = selected_item_iid
             # --- End of Treeview specific code ---
-            
-            self.client_socket.send(f"CMD:FILE_DOWNLOAD_REQUEST:{filename}".encode('utf-8'))
-            self.safe_ui_update(self.download_button.config, state=tk.DISABLED)
-            self.downloading = True
+            if filename in self.active_downloads:
+                messagebox.showwarning("Busy", f"{filename} is already being downloaded.")
+                return
+
+            save_path = filedialog.asksaveasfilename(initialfile=filename)
+            if not save_path:
+                return
+            # Picks up <save_path>.part from an interrupted download of the same file
+            filesize = self.available_files.get(filename, (0, None))[0]
+            partial = transfer.PartialFile(save_path, filename, filesize)
+            self.pending_downloads[filename] = partial
+            offset, last_hash = partial.resume_point()
+            if offset:
+                self.display_message(f"[SYSTEM] Found {offset / (1024 * 1024):.1f} MB of {filename}, asking to resume.\n")
+
+            self.send_with_lock(protocol.encode_text(f"CMD:FILE_DOWNLOAD_REQUEST:{filename}:{offset}:{last_hash}"))
 
         except Exception as e:
             self.connected = False
             self.safe_ui_update(self.display_message, f"[SYSTEM] Download request failed: {e}\n")
 
-    def download_file_inline(self, save_path, filesize):
-        try:
-            filename = os.path.basename(save_path)
-            self.safe_ui_update(self.status_label.config, text=f"Downloading: {filename}", fg="blue")
-            bytes_received = 0
-            with open(save_path, 'wb') as f:
-                while bytes_received < filesize:
-                    remaining = filesize - bytes_received
-                    chunk_size = min(4096, remaining)
-                    chunk = self.client_socket.recv(chunk_size)
-                    if not chunk: raise Exception("Server disconnected")
-                    f.write(chunk)
-                    bytes_received += len(chunk)
-                    progress = (bytes_received / filesize) * 100
-                    self.safe_ui_update(self.progress_bar.config, value=progress)
-                    self.safe_ui_update(self.status_label.config, 
-                                        text=f"Downloading: {filename} - {int(progress)}%")
-            self.safe_ui_update(self.status_label.config, text="Download complete!", fg="green")
-            self.safe_ui_update(self.display_message, f"[SYSTEM] ✓ Download complete: {filename}\n")
-        except Exception as e:
-            self.safe_ui_update(self.status_label.config, text="Download failed!", fg="red")
-            self.safe_ui_update(self.display_message, f"[SYSTEM] ✗ Download failed: {e}\n")
-        finally:
-            self.downloading = False
-            self.safe_ui_update(self.download_button.config, state=tk.NORMAL)
-            self.window.after(3000, lambda: self.status_label.config(text="Ready", fg="green"))
-            self.window.after(3000, lambda: self.progress_bar.config(value=0))
-            
     # --- (All Screen Share functions are identical to your Step 4) ---
     def toggle_presenting(self):
         if not self.connected:
             messagebox.showerror("Not Connected", "Not connected to server.")
             return
         if self.is_presenting:
-            self.send_with_lock("CMD:PRESENTER_STOP\n".encode('utf-8')) # Added \n
+            self.send_with_lock(protocol.encode_text("CMD:PRESENTER_STOP"))
         else:
-            if self.downloading or self.screen_view_window:
-                messagebox.showwarning("Busy", "Cannot present while downloading or viewing.")
+            if self.screen_view_window:
+                messagebox.showwarning("Busy", "Cannot present while viewing.")
                 return
-            self.send_with_lock("CMD:PRESENTER_REQUEST\n".encode('utf-8')) # Added \n
+            self.send_with_lock(protocol.encode_text("CMD:PRESENTER_REQUEST"))
             
     def start_sharing_thread(self):
         if self.presenter_thread is None or not self.presenter_thread.is_alive():
@@ -396,34 +528,44 @@ class ChatClient:
                 monitor = sct.monitors[1]
                 print(f"[PRESENTER] Monitor selected: {monitor}")
                 frame_count = 0
+                encoder = screen_delta.TileEncoder(quality=75, max_size=(1280, 720)) if SCREEN_DELTA_MODE else None
+                self.screen_encoder = encoder
                 
                 while self.is_presenting and self.connected:
                     try:
                         # Capture screen
                         sct_img = sct.grab(monitor)
-                        img = Image.frombytes("RGB", sct_img.size, sct_img.bgra, "raw", "BGRX")
-                        img.thumbnail((1280, 720)) 
                         
-                        # Convert to JPEG
-                        with io.BytesIO() as output:
-                            img.save(output, format='JPEG', quality=75)
-                            data = output.getvalue()
+                        if encoder:
+                            # Changed tiles only (delta) or a full JPEG (keyframe)
+                            encoded = encoder.encode_capture(sct_img.raw, sct_img.size)
+                            if encoded is None: # Nothing changed on screen
+                                time.sleep(0.1)
+                                continue
+                            frame_type, data = encoded
+                        else:
+                            img = Image.frombytes("RGB", sct_img.size, sct_img.bgra, "raw", "BGRX")
+                            img.thumbnail((1280, 720)) 
+                            
+                            # Convert to JPEG
+                            with io.BytesIO() as output:
+                                img.save(output, format='JPEG', quality=75)
+                                frame_type, data = protocol.FRAME_SCREEN, output.getvalue()
                         
                         frame_count += 1
                         if frame_count == 1:
                             print(f"[PRESENTER] First frame captured, size: {len(data)} bytes")
                         
-                        # Send data
-                        header = f"CMD:SCREEN_DATA:{len(data)}\n".encode('utf-8')
+                        # Send data (one SCREEN or SCREEN_DELTA frame)
+                        frame = protocol.encode_frame(frame_type, data)
                         with self.socket_lock:
                             if not self.connected:
                                 print("[PRESENTER] Connection lost, stopping...")
                                 break
-                            self.client_socket.sendall(header)
-                            self.client_socket.sendall(data)
+                            self.client_socket.sendall(frame)
                         
                         if frame_count % 30 == 0:  # Log every 30 frames
-                            print(f"[PRESENTER] Sent {frame_count} frames")
+                            print(f"[PRESENTER] Sent {frame_count} frames" + (f" ({encoder.stats()})" if encoder else ""))
                             
                         time.sleep(0.1) # 10 FPS
                         
@@ -431,7 +573,7 @@ class ChatClient:
                         print(f"[ERROR] Screen share socket error: {e}")
                         self.connected = False
                         self.is_presenting = False
-                        self.safe_ui_update(self.display_message, f"[SYSTEM] Screen sharing stopped: Connection error\n")
+                        self.safe_ui_update(self.display_message, "[SYSTEM] Screen sharing stopped: Connection error\n")
                         break
                     except Exception as e:
                         print(f"[ERROR] Screen share frame error: {e}")
@@ -449,6 +591,7 @@ class ChatClient:
             self.is_presenting = False
             
         self.is_presenting = False
+        self.screen_encoder = None
         print("[PRESENTER] Share thread stopped.")
         
     def show_screen_view_window(self):
@@ -466,10 +609,19 @@ class ChatClient:
             self.screen_view_window = None
             self.screen_view_label = None
 
-    def update_screen_view(self, image_data):
+    def handle_screen_frame(self, frame_type, payload):
+        """Composites a keyframe or tile delta (receive thread), then shows the result."""
+        try:
+            img = self.screen_compositor.apply(frame_type, payload)
+        except Exception as e:
+            print(f"[ERROR] Failed to decode screen frame: {e}")
+            return
+        if img is not None:
+            self.safe_ui_update(self.update_screen_view, img)
+
+    def update_screen_view(self, img):
         if self.screen_view_window is None: return
         try:
-            img = Image.open(io.BytesIO(image_data))
             win_width = self.screen_view_window.winfo_width()
             win_height = self.screen_view_window.winfo_height()
             if win_width > 1 and win_height > 1:
@@ -492,13 +644,15 @@ class ChatClient:
         """Called by receive_handler to start all audio systems."""
         try:
             self.server_udp_addr = (self.HOST, int(port))
-            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp_socket = protocol.open_udp_socket(AUDIO_SOCKET_BUFFER, AUDIO_SOCKET_BUFFER)
             
-            self.mic_stream = self.p_audio.open(
-                format=FORMAT, channels=CHANNELS, rate=RATE, input=True, frames_per_buffer=CHUNK)
+            self.mic_stream, mic_rate = self.open_audio_stream(input=True, stream_callback=self.on_mic)
+            if mic_rate != RATE:
+                self.mic_resampler = audio_mixer.Resampler(mic_rate, RATE)
             
-            self.speaker_stream = self.p_audio.open(
-                format=FORMAT, channels=CHANNELS, rate=RATE, output=True, frames_per_buffer=CHUNK)
+            self.speaker_stream, speaker_rate = self.open_audio_stream(output=True, stream_callback=self.on_speaker)
+            if speaker_rate != RATE:
+                self.speaker_resampler = audio_mixer.Resampler(RATE, speaker_rate)
             
             # Initialize Opus encoder and decoder
             if OPUS_AVAILABLE:
@@ -518,116 +672,366 @@ class ChatClient:
             
             threading.Thread(target=self.audio_send_thread, daemon=True).start()
             threading.Thread(target=self.audio_receive_thread, daemon=True).start()
+            threading.Thread(target=self.audio_playout_thread, daemon=True).start()
             
             self.udp_socket.sendto(f'HELLO:{self.NICKNAME}'.encode('utf-8'), self.server_udp_addr)
             
-            print(f"[AUDIO] Audio initialized for UDP port {port}")
+            print(f"[AUDIO] Audio initialized for UDP port {port} ({protocol.socket_buffers(self.udp_socket)})")
             self.safe_ui_update(self.display_message, "[SYSTEM] Audio connected.\n")
             
         except Exception as e:
             print(f"[AUDIO] Failed to initialize audio: {e}")
             self.safe_ui_update(self.display_message, f"[SYSTEM] Audio failed to start: {e}\n")
 
+    def init_video(self, port):
+        """Called by receive_handler: opens the video socket, which works whether or not audio does."""
+        try:
+            self.server_video_addr = (self.HOST, int(port))
+            self.video_socket = protocol.open_udp_socket(VIDEO_SOCKET_BUFFER, VIDEO_SOCKET_BUFFER)
+            self.video_socket.sendto(f'HELLO:{self.NICKNAME}'.encode('utf-8'), self.server_video_addr)
+            threading.Thread(target=self.video_receive_thread, daemon=True).start()
+            print(f"[VIDEO] Video initialized for UDP port {port} ({protocol.socket_buffers(self.video_socket)})")
+        except Exception as e:
+            print(f"[VIDEO] Failed to initialize video: {e}")
+            self.video_socket = None
+
+    def open_audio_stream(self, **direction):
+        """
+        Opens a 16-bit mono stream (input=True or output=True, plus its
+        stream_callback) at RATE, or at the default device's own rate if it
+        can't do RATE. Returns (stream, rate); anything but RATE has to be
+        resampled.
+        """
+        try:
+            return self.p_audio.open(format=FORMAT, channels=CHANNELS, rate=RATE,
+                                     frames_per_buffer=CHUNK, **direction), RATE
+        except Exception as e:
+            if direction.get('input'):
+                info = self.p_audio.get_default_input_device_info()
+            else:
+                info = self.p_audio.get_default_output_device_info()
+            rate = int(info['defaultSampleRate'])
+            if rate == RATE:
+                raise
+            print(f"[AUDIO] {info.get('name', 'Audio device')} can't run at {RATE} Hz ({e}), resampling to/from {rate} Hz")
+            return self.p_audio.open(format=FORMAT, channels=CHANNELS, rate=rate,
+                                     frames_per_buffer=round(CHUNK * rate / RATE), **direction), rate
+
+    def on_mic(self, in_data, frame_count, time_info, status):
+        """
+        [CALLBACK] PortAudio's thread: queues one mic block, stamped with
+        when it was captured, and wakes the send thread. Never blocks.
+        """
+        stamp = time.monotonic()
+        if time_info and time_info.get('input_buffer_adc_time'):
+            # How long ago the sound card sampled the block's first frame
+            stamp -= min(max(time_info['current_time'] - time_info['input_buffer_adc_time'], 0.0), 1.0)
+        self.capture_ring.put(np.frombuffer(in_data, dtype=np.int16), stamp)
+        self.mic_ready.set()
+        return (None, pyaudio.paContinue)
+
+    def on_speaker(self, in_data, frame_count, time_info, status):
+        """
+        [CALLBACK] PortAudio's thread: plays what the playout ring holds,
+        silence for whatever it lacks. Never blocks.
+        """
+        samples, stamp, missing = self.playout_ring.take(frame_count)
+        if stamp is not None:
+            delay = time.monotonic() - stamp
+            if time_info and time_info.get('output_buffer_dac_time'):
+                # Plus how long until the sound card actually plays it
+                delay += min(max(time_info['output_buffer_dac_time'] - time_info['current_time'], 0.0), 1.0)
+            self.playout_latency.add(delay)
+        if missing and (self.speaker_playing or stamp is not None):
+            self.playout_gaps += 1
+        self.speaker_playing = not missing
+        if len(self.playout_ring) < PLAYOUT_TARGET_FRAMES:
+            self.playout_wanted.set()
+        return (samples.tobytes(), pyaudio.paContinue)
+
+    def mic_frames(self, samples, stamp):
+        """
+        The CHUNK-sample frames at RATE one mic block completes, as
+        (pcm, stamp): always one, unless the device runs at another rate and
+        is resampled, when now and then a block yields none or two.
+        """
+        if self.mic_resampler is None:
+            return [(samples.tobytes(), stamp)]
+        self.mic_pending = np.concatenate((self.mic_pending, self.mic_resampler.process(samples)))
+        frames = []
+        while len(self.mic_pending) >= CHUNK:
+            frames.append((self.mic_pending[:CHUNK].tobytes(), stamp))
+            self.mic_pending = self.mic_pending[CHUNK:]
+        return frames
+
+    def play(self, pcm, stamp):
+        """
+        Queues PCM at RATE for the speaker callback, resampled if the device
+        runs at another rate; `stamp` is when it was received, None for
+        silence and concealment (not measured). Never blocks:
+        if playout falls behind, the oldest queued frames are dropped.
+        """
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        if self.speaker_resampler is not None:
+            samples = self.speaker_resampler.process(samples)
+        self.playout_ring.put(samples, stamp)
+
+    def report_audio_latency(self):
+        """Prints, and resets, the latencies measured since the last report."""
+        capture = self.capture_latency.take()
+        playout = self.playout_latency.take()
+        capture = f"avg {capture[0]:.1f} ms (max {capture[1]:.1f}) over {capture[2]} frames" if capture else "idle"
+        playout = f"avg {playout[0]:.1f} ms (max {playout[1]:.1f}) over {playout[2]} blocks" if playout else "idle"
+        print(f"[DEBUG] Audio latency: capture->send {capture}, receive->play {playout}; "
+              f"{self.playout_gaps} playout gaps, {self.capture_ring.dropped} mic blocks and "
+              f"{self.playout_ring.dropped} playout frames dropped so far")
+        counts, target, jitter = self.playout_buffer.take_stats()
+        if counts['received']:
+            counts.update(self.loss_stats)
+            self.loss_stats = dict.fromkeys(self.loss_stats, 0)
+            print(f"[DEBUG] Mix playout buffer: {target} frames ({jitter * 1000:.1f} ms jitter); "
+                  + ", ".join(f"{count} {name}" for name, count in counts.items()))
+
     # --- MODIFIED: audio_send_thread ---
     def audio_send_thread(self):
-        """[THREAD] Reads from mic, ENCODES, and sends via UDP with AUD: header."""
-        opus_frame_size = CHUNK # Opus works well with common chunk sizes
+        """
+        [THREAD] Takes mic blocks from the capture ring, ENCODES, and sends via UDP with AUD:<sequence number><level> header.
+        Only frames the VoiceDetector calls speech are sent; while muted or
+        quiet nothing goes out, but the sequence number keeps counting.
+        Also prints the audio latency report every AUDIO_LATENCY_REPORT_INTERVAL.
+        """
+        opus_frame_size = CHUNK # 20 ms, a frame size Opus accepts
+        seq = 0 # Lets the server's jitter buffer put frames back in order
+        vad = audio_mixer.VoiceDetector()
+        sent = suppressed = 0
+        next_report = time.monotonic() + AUDIO_LATENCY_REPORT_INTERVAL
         while self.audio_running:
             try:
-                if self.is_muted:
-                    # Read mic data even if muted to keep timing, but don't send real data
-                    _ = self.mic_stream.read(opus_frame_size, exception_on_overflow=False)
-                    # Create silence IN THE CORRECT FORMAT (int16 numpy array)
-                    silent_frame = np.zeros(opus_frame_size * CHANNELS, dtype=np.int16)
-                    raw_data = silent_frame.tobytes() # Convert numpy silence to bytes
-                else:
-                    # Read raw audio data (bytes)
-                    raw_data = self.mic_stream.read(opus_frame_size, exception_on_overflow=False)
-
-                if self.opus_encoder:
-                    # Encode the raw audio bytes
-                    encoded_data = self.opus_encoder.encode(raw_data, opus_frame_size)
-                    # Send encoded data with header
-                    self.udp_socket.sendto(b'AUD:' + encoded_data, self.server_udp_addr)
-                else: # Fallback if encoder failed
-                    self.udp_socket.sendto(b'AUD:' + raw_data, self.server_udp_addr)
-
-            # Add a small sleep to prevent high CPU usage if mic read is too fast
-            except BlockingIOError:
-                time.sleep(0.005) # Wait briefly if no data available
+                if time.monotonic() >= next_report:
+                    self.report_audio_latency()
+                    next_report += AUDIO_LATENCY_REPORT_INTERVAL
+                # Woken by the mic callback; the timeout only keeps the report going
+                if not self.mic_ready.wait(0.5):
+                    continue
+                self.mic_ready.clear()
+                while True:
+                    block = self.capture_ring.get()
+                    if block is None:
+                        break
+                    # Blocks keep coming while muted, so seq keeps time
+                    for raw_data, stamp in self.mic_frames(*block):
+                        seq += 1
+                        if self.is_muted:
+                            suppressed += 1
+                            continue
+                        # The level lets an SFU server pick the loudest speakers without decoding
+                        level = audio_mixer.audio_level(raw_data)
+                        if not vad.is_speech(level):
+                            suppressed += 1
+                            continue
+
+                        packet = None
+                        if self.opus_encoder:
+                            try:
+                                # Encode the raw audio bytes
+                                encoded_data = self.opus_encoder.encode(raw_data, opus_frame_size)
+                                packet = audio_mixer.pack_audio(seq, encoded_data, level, opus=True)
+                            except Exception as e:
+                                print(f"[AUDIO] Opus encode failed ({e}), sending raw audio from now on")
+                                self.opus_encoder = None
+                        if packet is None:
+                            # Fallback if encoder failed
+                            packet = audio_mixer.pack_audio(seq, raw_data, level)
+                        self.udp_socket.sendto(packet, self.server_udp_addr)
+                        self.capture_latency.add(time.monotonic() - stamp)
+                        sent += 1
             except Exception as e:
                 if self.audio_running:
                     print(f"[AUDIO] Send error: {e}")
                 break
+        if sent or suppressed:
+            print(f"[AUDIO] Sent {sent} of {sent + suppressed} frames, "
+                  f"{100 * suppressed / (sent + suppressed):.0f}% were silence or muted")
         print("[AUDIO] Send thread stopped.")
 
     # --- MODIFIED: audio_receive_thread ---
     def audio_receive_thread(self):
-        """[THREAD] Receives UDP data, routes to video or DECODES audio."""
+        """[THREAD] Receives audio UDP data and queues it for playout (video has its own thread)."""
         opus_frame_size = CHUNK # Should match sender
-        expected_audio_bytes = opus_frame_size * CHANNELS * 2 # 2 bytes per int16 sample
 
         while self.audio_running:
             try:
                 data, addr = self.udp_socket.recvfrom(65536)
-                if not data: continue
+            except OSError as e:
+                if self.audio_running:
+                    print(f"[AUDIO] Receive error: {e}")
+                break
+            if not data: continue
+            received = time.monotonic()
 
-                # 1. Video Packet (Same as before)
-                if data.startswith(b'VID:'):
-                    try:
-                        parts = data.split(b':', 2)
-                        if len(parts) < 3: continue
-                        nickname = parts[1].decode('utf-8')
-                        jpeg_data = parts[2]
-                        self.safe_ui_update(self.update_video_feed, nickname, jpeg_data)
-                    except Exception as e:
-                        print(f"[VIDEO] Failed to decode video packet: {e} - {data[:50]}")
-
-                # 2. Audio Packet (Now received with AUD:<nickname>:encoded_data)
-                elif data.startswith(b'AUD:'):
-                    parts = data.split(b':', 2)
-                    if len(parts) < 3: continue
-                    nickname = parts[1].decode('utf-8')
-                    encoded_data = parts[2]
-
-                    # Find or create decoder for this peer
-                    if nickname not in self.peer_opus_decoders:
-                        if OPUS_AVAILABLE:
-                            try:
-                                self.peer_opus_decoders[nickname] = opuslib.Decoder(RATE, CHANNELS)
-                            except Exception as e:
-                                print(f"[AUDIO] Failed to create decoder for {nickname}: {e}")
-                                self.peer_opus_decoders[nickname] = None
+            # One malformed datagram costs that datagram, not the call
+            try:
+                # 1. The mix: raw PCM (AUD:<nickname>:<seq><flags><pcm>) or
+                # Opus (AUO:<nickname>:<seq><flags><opus packet>), one stream from
+                # the server whoever is talking. Queued as it came, and decoded
+                # in order by audio_playout_thread, which can use the FEC data
+                # of the packet after a lost one
+                if data.startswith(b'AUD:') or data.startswith(b'AUO:'):
+                    label_end = data.find(b':', 4)
+                    packet = audio_mixer.unpack_audio(data, label_end + 1) if label_end > 0 else None
+                    if packet is None: continue
+                    seq, _, opus, payload = packet
+                    if opus and not self.opus_decoder: continue
+                    self.playout_buffer.push(seq, (opus, payload, received), received)
 
-                    decoder = self.peer_opus_decoders.get(nickname)
-                    if decoder and OPUS_AVAILABLE:
+                # 2. SFU mode: one speaker's own frame (AUS:<nickname>:<seq><flags><payload>),
+                # decoded here and mixed by audio_playout_thread
+                elif data.startswith(b'AUS:'):
+                    label_end = data.find(b':', 4)
+                    packet = audio_mixer.unpack_audio(data, label_end + 1) if label_end > 0 else None
+                    if packet is None: continue
+                    nickname = data[4:label_end].decode('utf-8')
+                    seq, _, opus, payload = packet
+                    if opus:
+                        decoder = self.peer_opus_decoders.get(nickname)
+                        if decoder is None:
+                            if not OPUS_AVAILABLE: continue
+                            decoder = self.peer_opus_decoders[nickname] = opuslib.Decoder(RATE, CHANNELS)
                         try:
-                            # Decode the audio data
-                            decoded_data = decoder.decode(encoded_data, opus_frame_size)
-
-                            # Play the decoded raw audio bytes
-                            if self.speaker_stream:
-                                self.speaker_stream.write(decoded_data)
+                            payload = decoder.decode(payload, opus_frame_size)
                         except Exception as e:
-                            # Opus decode failed, try playing as raw
-                            # print(f"[AUDIO] Opus decode error from {nickname}: {e}")
-                            if self.speaker_stream:
-                                self.speaker_stream.write(encoded_data)
-                    else:
-                        # No Opus, play raw audio
-                        if self.speaker_stream:
-                            self.speaker_stream.write(encoded_data)
+                            print(f"[AUDIO] Dropping undecodable Opus packet from {nickname}: {e}")
+                            continue
+                    if self.sfu_mixer is None:
+                        self.sfu_mixer = audio_mixer.AudioMixer(CHUNK * CHANNELS)
+                    self.sfu_mixer.push(nickname, seq, payload, received)
+
+            except (ValueError, UnicodeDecodeError, struct.error) as e:
+                print(f"[AUDIO] Dropping malformed packet: {e} - {data[:50]}")
+        print("[AUDIO] Receive thread stopped.")
+
+    # --- NEW: video_receive_thread ---
+    def video_receive_thread(self):
+        """
+        [THREAD] Receives VID:<nickname>:<frame id><index><count><jpeg bytes>
+        fragments on the video socket and shows each frame once it is whole.
+        Every FEEDBACK_INTERVAL it tells each sender how their frames fared.
+        """
+        self.video_socket.settimeout(video_packets.FEEDBACK_INTERVAL)
+        next_feedback = time.monotonic() + video_packets.FEEDBACK_INTERVAL
+        while self.connected:
+            try:
+                if time.monotonic() >= next_feedback:
+                    next_feedback += video_packets.FEEDBACK_INTERVAL
+                    self.send_video_feedback()
+                try:
+                    data, addr = self.video_socket.recvfrom(65536)
+                except socket.timeout:
+                    continue
+                if not data.startswith(b'VID:'): continue
+                try:
+                    label_end = data.find(b':', 4)
+                    fragment = video_packets.unpack(data, label_end + 1) if label_end > 0 else None
+                    if fragment is None: continue
+                    nickname = data[4:label_end].decode('utf-8')
+                    jpeg_data = self.video_frames.add(nickname, *fragment, time.monotonic())
+                    if jpeg_data is not None:
+                        self.safe_ui_update(self.update_video_feed, nickname, jpeg_data)
+                except Exception as e:
+                    print(f"[VIDEO] Failed to decode video packet: {e} - {data[:50]}")
+            except Exception as e:
+                if self.connected:
+                    print(f"[VIDEO] Receive error: {e}")
+                break
+        print("[VIDEO] Receive thread stopped.")
+
+    def send_video_feedback(self):
+        """CMD:VIDEO_FEEDBACK:<sender>:<frames>:<lost>:<late>:<decode ms> for each sender we got frames from."""
+        decode, self.video_decode = self.video_decode, {}
+        for sender, (frames, lost, late) in self.video_frames.take_feedback().items():
+            total_ms, decoded = decode.get(sender, (0.0, 0))
+            decode_ms = total_ms / decoded if decoded else 0.0
+            self.send_with_lock(protocol.encode_text(
+                f"CMD:VIDEO_FEEDBACK:{sender}:{frames}:{lost}:{late}:{decode_ms:.1f}"))
 
+    def audio_playout_thread(self):
+        """
+        [THREAD] Keeps PLAYOUT_TARGET_FRAMES queued for the speaker
+        callback, one frame at a time: the next frame of the server's mix
+        (mix mode), or the mix of the forwarded speakers' jitter buffers
+        (SFU mode). The callback asks for more as it plays, so playout never
+        drifts from what the sound card plays. Latency is measured from when
+        the frame's packet was received, so it includes the jitter buffer.
+        """
+        silence = bytes(CHUNK * CHANNELS * 2)
+        active_speakers = audio_mixer.ActiveSpeakers()
+        while self.audio_running:
+            try:
+                self.playout_wanted.wait(0.5)
+                self.playout_wanted.clear()
+                while len(self.playout_ring) < PLAYOUT_TARGET_FRAMES:
+                    if self.sfu_mixer is not None:
+                        mix = self.sfu_mixer.tick()
+                        speaking = active_speakers.update(mix.senders if mix else (), time.monotonic())
+                        if speaking is not None:
+                            self.safe_ui_update(self.show_speakers, speaking)
+                        pcm, stamp = (mix.everyone, mix.arrival) if mix else (None, None)
+                    else:
+                        pcm, stamp = self.next_mix_frame()
+                    self.play(pcm or silence, stamp if pcm else None)
             except Exception as e:
                 if self.audio_running:
-                    print(f"[AV] Receive error: {e}")
+                    print(f"[AUDIO] Playout error: {e}")
                 break
-        print("[AV] Receive thread stopped.")
+        print("[AUDIO] Playout thread stopped.")
+
+    def next_mix_frame(self):
+        """
+        The next frame of the server's mix as (PCM, when its packet was
+        received), PCM None for silence and the time None for concealment.
+        A lost Opus frame is rebuilt from the in-band FEC data of the packet
+        after it if that has arrived, else by Opus's own concealment (PLC);
+        a lost raw frame repeats the previous one at half volume, once.
+        """
+        popped = self.playout_buffer.pop()
+        if popped is None:
+            self.mix_last = None
+            return None, None
+        packet, after = popped
+        if packet is not None:
+            self.mix_opus, payload, received = packet
+            if not self.mix_opus:
+                self.mix_last = payload
+                return payload, received
+            try:
+                return self.opus_decoder.decode(payload, CHUNK), received
+            except Exception as e:
+                print(f"[AUDIO] Concealing undecodable Opus packet: {e}")
+        elif not self.mix_opus:
+            if self.mix_last is None:
+                return None, None
+            pcm = (np.frombuffer(self.mix_last, dtype=np.int16) * audio_mixer.CONCEAL_GAIN).astype(np.int16).tobytes()
+            self.mix_last = None # Repeat once, then silence until real audio
+            self.loss_stats['concealed'] += 1
+            return pcm, None
+        elif after is not None and after[0]:
+            try:
+                pcm = self.opus_decoder.decode(after[1], CHUNK, decode_fec=True)
+                self.loss_stats['recovered'] += 1
+                return pcm, after[2] # Rebuilt from that packet, so it is that late
+            except Exception:
+                pass # No usable FEC data: conceal instead
+        try:
+            pcm = self.opus_decoder.decode(b'', CHUNK) # An empty packet asks the decoder for PLC
+            self.loss_stats['concealed'] += 1
+            return pcm, None
+        except Exception:
+            return None, None
 
     # --- NEW: Video Functions ---
     def toggle_video(self):
-        if not self.audio_running: # Need UDP to be active
-            messagebox.showwarning("Audio Off", "Must be in the audio call to start video.")
+        if self.video_socket is None: # Need the video socket to be open
+            messagebox.showwarning("Video Off", "Video is not connected to the server.")
             return
             
         self.is_video_on = not self.is_video_on
@@ -656,11 +1060,19 @@ class ChatClient:
             self.safe_ui_update(self.video_button.config, text="Start Video", bg="blue")
 
     def video_send_loop(self):
-        """[THREAD] Captures webcam and sends via UDP with VID: header."""
+        """
+        [THREAD] Captures webcam and sends via UDP, each frame as VID:
+        fragments, at the size, quality and frame rate of the rung the
+        viewers' feedback allows.
+        """
         try:
             self.video_capture = cv2.VideoCapture(0)
             if not self.video_capture.isOpened():
                 raise Exception("Could not open webcam")
+            # Ask for the top rung's size, so every rung is a downscale
+            width, height = VIDEO_LADDER[-1][0]
+            self.video_capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+            self.video_capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
         except Exception as e:
             self.video_capture = None  # Ensure it's None on failure
             self.safe_ui_update(messagebox.showerror, "Webcam Error", f"Failed to open webcam: {e}")
@@ -669,7 +1081,9 @@ class ChatClient:
             
         print("[VIDEO] Webcam capture started.")
         consecutive_failures = 0
-        max_failures = 30  # Allow 30 consecutive failures before giving up (2 seconds at 15 FPS)
+        max_failures = 30  # Allow 30 consecutive failures before giving up (3 seconds)
+        rung = None
+        next_frame = time.monotonic()
         
         while self.is_video_on: # Loop controlled by the flag
             try:
@@ -688,21 +1102,32 @@ class ChatClient:
                 # Reset failure counter on success
                 consecutive_failures = 0
                 
-                # 1. Resize (CRITICAL for LAN performance)
-                frame_small = cv2.resize(frame, (320, 240))
+                # 1. Resize to the current rung (CRITICAL for LAN performance)
+                now = time.monotonic()
+                size, quality, fps = self.video_rate.rung(now)
+                if (size, quality, fps) != rung:
+                    if rung is not None:
+                        print(f"[VIDEO] Sending {size[0]}x{size[1]} q{quality} at {fps} fps")
+                    rung = (size, quality, fps)
+                frame_small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
                 
                 # 2. Compress to JPEG
-                ret, buffer = cv2.imencode('.jpg', frame_small, [cv2.IMWRITE_JPEG_QUALITY, 50])
+                ret, buffer = cv2.imencode('.jpg', frame_small, [cv2.IMWRITE_JPEG_QUALITY, quality])
                 if not ret:
                     continue
                 
-                # 3. Send over UDP with header
-                self.udp_socket.sendto(b'VID:' + buffer.tobytes(), self.server_udp_addr)
+                # 3. Send over UDP in MTU-sized fragments with VID:<frame id><index><count> headers
+                self.video_frame_id += 1
+                for packet in video_packets.packetize(self.video_frame_id, buffer.tobytes()):
+                    self.video_socket.sendto(packet, self.server_video_addr)
+                    self.video_rate.sent(len(packet))
                 
                 # 4. Display our *own* feed locally
                 self.safe_ui_update(self.update_video_feed, self.NICKNAME, buffer.tobytes())
                 
-                time.sleep(1/15) # Aim for 15 FPS
+                # Frames on a fixed schedule, however long capture and encoding took
+                next_frame = max(next_frame + 1 / fps, now)
+                time.sleep(max(0.0, next_frame - time.monotonic()))
 
             except Exception as e:
                 if self.is_video_on:
@@ -747,8 +1172,8 @@ class ChatClient:
 
         if messagebox.askyesno("Report User", f"Are you sure you want to report {reported_nickname}?"):
             try:
-                # Send command without lock (short message)
-                self.client_socket.send(f"CMD:REPORT_USER:{reported_nickname}\n".encode('utf-8'))
+                with self.socket_lock:
+                    self.client_socket.sendall(protocol.encode_text(f"CMD:REPORT_USER:{reported_nickname}"))
                 self.safe_ui_update(self.display_message, f"[SYSTEM] Your report for {reported_nickname} has been logged by the server.\n")
             except Exception as e:
                 self.safe_ui_update(self.display_message, f"[SYSTEM] Failed to send report: {e}\n")
@@ -783,6 +1208,9 @@ class ChatClient:
             report_button.pack(side=tk.RIGHT, padx=4, pady=1)
         # --- End ---
 
+        if nickname in self.active_speakers:
+            user_frame.config(highlightthickness=3, highlightbackground=SPEAKER_HIGHLIGHT)
+
         # Pack the main user frame
         user_frame.pack(side=tk.LEFT, padx=5, pady=5)
         user_frame.pack_propagate(False) # Prevent frame from shrinking to fit label text
@@ -804,30 +1232,44 @@ class ChatClient:
             if not jpeg_data:
                 return
 
+            start = time.perf_counter()
             data = np.frombuffer(jpeg_data, dtype=np.uint8)
             frame_bgr = cv2.imdecode(data, cv2.IMREAD_COLOR)
+            height, width = frame_bgr.shape[:2]
+            if width > VIDEO_FEED_SIZE[0] or height > VIDEO_FEED_SIZE[1]: # Fit the grid cell
+                scale = min(VIDEO_FEED_SIZE[0] / width, VIDEO_FEED_SIZE[1] / height)
+                frame_bgr = cv2.resize(frame_bgr, (round(width * scale), round(height * scale)),
+                                       interpolation=cv2.INTER_AREA)
             frame_rgb = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB)
             
             # 3. Convert to Tkinter format
             img = Image.fromarray(frame_rgb)
             photo = ImageTk.PhotoImage(img)
+            if nickname != self.NICKNAME: # Reported to the sender, who backs off if we can't keep up
+                decode = self.video_decode.setdefault(nickname, [0.0, 0])
+                decode[0] += (time.perf_counter() - start) * 1000
+                decode[1] += 1
             
             # 4. Update the label
             label = self.video_feeds[nickname]
             label.config(image=photo, text="") # Remove "loading" text
             label.image = photo # Keep reference
             
-        except Exception as e:
+        except Exception:
             # This can happen if a packet is corrupted
-            # print(f"[VIDEO] Failed to update feed for {nickname}: {e}")
             pass
             
+    def show_speakers(self, speakers):
+        """Shows who is talking and outlines their video feeds."""
+        self.active_speakers = tuple(speakers)
+        self.speakers_label.config(text=f"Speaking: {', '.join(speakers)}" if speakers else "")
+        for nickname, label in self.video_feeds.items():
+            if label.winfo_exists():
+                speaking = nickname in self.active_speakers
+                label.master.config(highlightthickness=3 if speaking else 0, highlightbackground=SPEAKER_HIGHLIGHT)
+
     def remove_video_feed(self, nickname):
-        """Removes a user's video feed AND audio decoder."""
-        # --- NEW: Remove audio decoder ---
-        if nickname in self.peer_opus_decoders:
-            del self.peer_opus_decoders[nickname]
-        # --- End ---
+        """Removes a user's video feed."""
         if nickname in self.video_feeds:
             label = self.video_feeds.pop(nickname)
             if label.winfo_exists():
@@ -835,242 +1277,241 @@ class ChatClient:
                 parent_frame = label.master
                 parent_frame.destroy()
 
-    # --- (helper functions for buffered receiving - identical to Step 4) ---
-    def receive_data_inline(self, total_size, data_buffer):
-        received_data = data_buffer[:total_size]
-        data_buffer = data_buffer[total_size:]
-        bytes_received = len(received_data)
-        while bytes_received < total_size:
-            remaining = total_size - bytes_received
-            chunk_size = min(4096, remaining)
-            try:
-                chunk = self.client_socket.recv(chunk_size)
-                if not chunk: raise Exception("Server disconnected")
-                if len(chunk) > remaining:
-                    received_data += chunk[:remaining]
-                    data_buffer = chunk[remaining:] + data_buffer
-                    bytes_received += remaining
-                else:
-                    received_data += chunk
-                    bytes_received += len(chunk)
-            except Exception as e:
-                self.safe_ui_update(self.display_message, f"[ERROR] Receive data failed: {e}\n")
-                return data_buffer, None
-        return data_buffer, received_data
-        
-    def skip_data(self, total_size, data_buffer):
-        bytes_to_skip = total_size
-        skipped_from_buffer = len(data_buffer[:bytes_to_skip])
-        data_buffer = data_buffer[skipped_from_buffer:]
-        bytes_to_skip -= skipped_from_buffer
-        while bytes_to_skip > 0:
-            chunk_size = min(4096, bytes_to_skip)
-            try:
-                chunk = self.client_socket.recv(chunk_size)
-                if not chunk: raise Exception("Server disconnected")
-                bytes_to_skip -= len(chunk)
-            except Exception as e:
-                print(f"[ERROR] Failed to skip data: {e}")
-                return b""
-        return data_buffer
-        
-    def download_file_inline_buffered_v2(self, save_path, filesize, data_buffer):
+    # --- NEW: Downloads run on their own data connection ---
+    def download_file_thread(self, partial, token):
+        """
+        [THREAD] Receives one file on a data connection into the partial file
+        picked in request_download. Every chunk is checked against the
+        FILE_CHUNK_HASH that follows it.
+        """
+        filename = partial.name
+        codec, offset, wire_bytes, rate = None, 0, 0, "nothing left to fetch"
+        started = time.monotonic()
         try:
-            filename = os.path.basename(save_path)
-            self.safe_ui_update(self.status_label.config, text=f"Downloading: {filename}", fg="blue")
-            self.safe_ui_update(self.progress_bar.config, value=0)
-            
-            with open(save_path, 'wb') as f:
-                bytes_received = len(data_buffer[:filesize])
-                f.write(data_buffer[:filesize])
-                data_buffer = data_buffer[filesize:]
-                
-                while bytes_received < filesize:
-                    remaining = filesize - bytes_received
-                    chunk_size = min(4096, remaining)
-                    chunk = self.client_socket.recv(chunk_size)
-                    if not chunk: raise Exception("Server disconnected")
-                    
-                    if len(chunk) > remaining:
-                        f.write(chunk[:remaining])
-                        data_buffer = chunk[remaining:] + data_buffer
-                        bytes_received += remaining
+            with self.open_data_channel(token) as sock:
+                for frame_type, payload in protocol.read_frames(sock):
+                    if frame_type in protocol.FILE_DATA_TYPES:
+                        partial.write(transfer.unpack_file_data(frame_type, payload, codec, partial))
+                        wire_bytes += len(payload)
+                        rate = transfer.describe_rate(partial.written - offset, wire_bytes, time.monotonic() - started, codec)
+                        self.safe_ui_update(self.progress_bar.config, value=partial.written / partial.size * 100)
+                        self.safe_ui_update(self.status_label.config,
+                                            text=f"Downloading: {filename} - {int(partial.written / partial.size * 100)}% ({rate})")
+                        continue
+                    message = payload.decode('utf-8').strip()
+                    if message.startswith('CMD:FILE_SEND_START:'):
+                        # CMD:FILE_SEND_START:<filename>:<filesize>:<offset>:<codec>
+                        _, filesize, offset, codec = message.split(':', 2)[2].rsplit(':', 3)
+                        codec, offset = transfer.parse_codec(codec), int(offset)
+                        if partial.size != int(filesize): # The file changed on the server since the list was sent
+                            partial = transfer.PartialFile(partial.path, filename, int(filesize))
+                        partial.start(offset)
+                        started = time.monotonic()
+                        self.safe_ui_update(self.status_label.config, text=f"Downloading: {filename}", fg="blue")
+                    elif message.startswith('CMD:FILE_CHUNK_HASH:'):
+                        _, _, index, digest = message.split(':', 3)
+                        partial.verify_chunk(int(index), digest)
                     else:
-                        f.write(chunk)
-                        bytes_received += len(chunk)
-                    
-                    progress = (bytes_received / filesize) * 100
-                    self.safe_ui_update(self.progress_bar.config, value=progress)
-
+                        raise transfer.TransferError(message) # e.g. the file is gone
+                    if partial.complete:
+                        break
+            if not partial.complete:
+                raise transfer.TransferError("Server closed the data connection")
+            partial.finish()
             self.safe_ui_update(self.status_label.config, text="Download complete!", fg="green")
-            self.safe_ui_update(self.display_message, f"[SYSTEM] ✓ Download complete: {save_path}\n")
+            self.safe_ui_update(self.display_message, f"[SYSTEM] ✓ Download complete: {partial.path} ({rate})\n")
         except Exception as e:
+            partial.close() # Verified chunks are kept for a resume
             self.safe_ui_update(self.status_label.config, text="Download failed!", fg="red")
-            self.safe_ui_update(self.display_message, f"[SYSTEM] ✗ Download failed: {e}\n")
+            self.safe_ui_update(self.display_message, f"[SYSTEM] ✗ Download of {filename} failed: {e} "
+                                f"({partial.verified_bytes}/{partial.size} bytes kept, download again to resume)\n")
         finally:
-            self.downloading = False
-            self.safe_ui_update(self.download_button.config, state=tk.NORMAL)
+            self.active_downloads.discard(filename)
             self.window.after(3000, lambda: self.status_label.config(text="Ready", fg="green"))
             self.window.after(3000, lambda: self.progress_bar.config(value=0))
-        
-        return data_buffer
+
+    # --- NEW: File list ---
+    def show_available_files(self, entries):
+        """Adds or updates (filename, filesize, sender) rows in the file list, in one UI update."""
+        rows = []
+        for filename, filesize, sender in entries:
+            # Format filesize nicely
+            if filesize < 1024:
+                size_str = f"{filesize} B"
+            elif filesize < 1024*1024:
+                size_str = f"{filesize/1024:.1f} KB"
+            else:
+                size_str = f"{filesize/(1024*1024):.1f} MB"
+            rows.append((filename, size_str, sender))
+            self.available_files[filename] = (filesize, sender)
+
+        # This function needs to be run on the main thread
+        def update_tree():
+            for filename, size_str, sender in rows:
+                # Use filename as the item ID (iid) to prevent duplicates
+                if self.file_tree.exists(filename):
+                    self.file_tree.item(filename, values=(filename, size_str, sender))
+                else:
+                    self.file_tree.insert('', tk.END, iid=filename, values=(filename, size_str, sender))
+
+        self.safe_ui_update(update_tree)
 
     # --- MODIFIED: Main Receive Handler Thread ---
     def receive_handler(self):
         """
-        [THREAD] Handles *all* incoming TCP messages and commands.
+        [THREAD] Handles *all* incoming TCP frames and commands.
         """
         if hasattr(self, 'welcome_message'):
             self.safe_ui_update(self.display_message, self.welcome_message + "\n")
-        
-        data_buffer = b""
 
-        while self.connected:
-            try:
-                new_data = self.client_socket.recv(4096)
-                if not new_data: break
-                
-                data_buffer += new_data
-                
-                while True:
-                    try:
-                        newline_index = data_buffer.index(b'\n')
-                        header_bytes = data_buffer[:newline_index]
-                        message = header_bytes.decode('utf-8').strip()
-                        data_buffer = data_buffer[newline_index + 1:]
-                    except ValueError:
-                        break # No complete message
-                    except UnicodeDecodeError:
-                        print(f"UnicodeDecodeError. Discarding buffer part.")
-                        if b'\n' in data_buffer:
-                            data_buffer = data_buffer[data_buffer.index(b'\n') + 1:]
-                        else: data_buffer = b""
-                        continue
-                    
+        try:
+            for frame_type, payload in self.frames:
+                if not self.connected:
+                    break
+
+                # --- Binary frames ---
+                if frame_type in (protocol.FRAME_SCREEN, protocol.FRAME_SCREEN_DELTA):
+                    self.handle_screen_frame(frame_type, payload)
+                    continue
+                if frame_type != protocol.FRAME_TEXT:
+                    print(f"WARNING: Unknown frame type {frame_type}")
+                    continue
+
+                try:
+                    message = payload.decode('utf-8').strip()
+                except UnicodeDecodeError:
+                    print("UnicodeDecodeError. Discarding frame.")
+                    continue
+
+                if not message.startswith(QUIET_COMMANDS):
                     print(f"DEBUG: Recv '{message}'")
 
-                    # --- Command Parsing ---
-                    
-                    if message.startswith('CMD:FILE_READY_TO_RECV:'):
-                        filename = message.split(':', 2)[2]
-                        if self.pending_upload and self.pending_upload[1] == filename:
-                            threading.Thread(target=self.upload_file_thread, 
-                                             args=(self.pending_upload[0], self.pending_upload[1]), 
-                                             daemon=True).start()
-                    
-                    elif message.startswith('CMD:FILE_NEW_AVAILABLE:'):
-                        parts = message.split(':', 4)
-                        if len(parts) >= 5:
-                            sender, filename, filesize_str = parts[2], parts[3], parts[4]
-                            try:
-                                filesize = int(filesize_str)
-                                # Format filesize nicely
-                                if filesize < 1024:
-                                    size_str = f"{filesize} B"
-                                elif filesize < 1024*1024:
-                                    size_str = f"{filesize/1024:.1f} KB"
-                                else:
-                                    size_str = f"{filesize/(1024*1024):.1f} MB"
-
-                                # Use filename as the item ID (iid) to prevent duplicates
-                                iid = filename
-                                
-                                # This function needs to be run on the main thread
-                                def update_tree():
-                                    if self.file_tree.exists(iid):
-                                        self.file_tree.item(iid, values=(filename, size_str, sender))
-                                    else:
-                                        self.file_tree.insert('', tk.END, iid=iid, values=(filename, size_str, sender))
-
-                                self.safe_ui_update(update_tree)
-                                self.available_files[filename] = (filesize, sender)
-                            except (ValueError, IndexError) as e:
-                                print(f"Error parsing FILE_NEW_AVAILABLE: {e}")
-                    
-                    elif message.startswith('CMD:FILE_SEND_START:'):
-                        parts = message.split(':', 3)
-                        if len(parts) >= 4:
-                            filename, filesize = parts[2], int(parts[3])
-                            save_path_container = [None]; dialog_done = threading.Event()
-                            def ask_save_location():
-                                save_path_container[0] = filedialog.asksaveasfilename(initialfile=filename)
-                                dialog_done.set()
-                            self.safe_ui_update(ask_save_location)
-                            
-                            if dialog_done.wait(timeout=60):
-                                save_path = save_path_container[0]
-                                if save_path:
-                                    data_buffer = self.download_file_inline_buffered_v2(save_path, filesize, data_buffer)
-                                else:
-                                    self.safe_ui_update(self.display_message, f"[SYSTEM] Download for {filename} cancelled.\n")
-                                    self.downloading = False
-                                    self.safe_ui_update(self.download_button.config, state=tk.NORMAL)
-                                    data_buffer = self.skip_data(filesize, data_buffer)
-                            else:
-                                self.safe_ui_update(self.display_message, f"[SYSTEM] Download timeout for {filename}.\n")
-                                self.downloading = False
-                                self.safe_ui_update(self.download_button.config, state=tk.NORMAL)
-                                data_buffer = self.skip_data(filesize, data_buffer)
-                    
-                    elif message.startswith('CMD:PRESENTER_SET:'):
-                        nickname = message.split(':', 2)[2]
-                        if nickname == self.NICKNAME:
-                            self.start_sharing_thread()
-                        elif nickname == "NONE":
-                            self.stop_sharing_thread()
-                            self.safe_ui_update(self.hide_screen_view_window)
-                            self.safe_ui_update(self.status_label.config, text="Ready", fg="green")
-                        else:
-                            self.safe_ui_update(self.show_screen_view_window)
-                            self.safe_ui_update(self.status_label.config, text=f"{nickname} is presenting", fg="blue")
+                # --- Command Parsing ---
 
-                    elif message.startswith('CMD:SCREEN_DATA:'):
-                        try:
-                            filesize = int(message.split(':', 2)[2])
-                            data_buffer, image_data = self.receive_data_inline(filesize, data_buffer)
-                            if image_data:
-                                self.safe_ui_update(self.update_screen_view, image_data)
-                        except Exception as e:
-                            print(f"[ERROR] Screen data processing failed: {e}")
+                # CMD:FILE_UPLOAD_TOKEN:<token>:<filename> - the upload goes over a data connection
+                if message.startswith('CMD:FILE_UPLOAD_TOKEN:'):
+                    _, _, token, filename = message.split(':', 3)
+                    pending = self.pending_uploads.get(filename)
+                    if pending:
+                        filepath, hashes = pending
+                        threading.Thread(target=self.upload_file_thread, 
+                                         args=(filepath, filename, hashes, token), 
+                                         daemon=True).start()
+
+                # CMD:CAPS:compress=<codecs> - the transfer compression the server shares with us
+                elif message.startswith('CMD:CAPS:'):
+                    self.transfer_codecs = transfer.parse_capabilities(message.split(':', 2)[2])
+
+                # CMD:SPEAKERS:<nick>,<nick> - who is in the audio mix now, loudest first
+                elif message.startswith('CMD:SPEAKERS:'):
+                    names = message.split(':', 2)[2]
+                    self.safe_ui_update(self.show_speakers, names.split(',') if names else [])
 
-                    # --- G. AUDIO PORT ---
-                    elif message.startswith('CMD:AUDIO_PORT:'):
+                # CMD:FILE_UPLOAD_EXISTS:<filename> - the server already stores this content, nothing to send
+                elif message.startswith('CMD:FILE_UPLOAD_EXISTS:'):
+                    filename = message.split(':', 2)[2]
+                    self.pending_uploads.pop(filename, None)
+                    self.safe_ui_update(self.display_message,
+                                        f"[SYSTEM] ✓ The server already has the contents of {filename}, shared without uploading.\n")
+
+                # CMD:FILE_DOWNLOAD_TOKEN:<token>:<filename> - so does the download
+                elif message.startswith('CMD:FILE_DOWNLOAD_TOKEN:'):
+                    _, _, token, filename = message.split(':', 3)
+                    partial = self.pending_downloads.pop(filename, None)
+                    if partial:
+                        self.active_downloads.add(filename)
+                        threading.Thread(target=self.download_file_thread, args=(partial, token), daemon=True).start()
+
+                elif message.startswith('CMD:FILE_NEW_AVAILABLE:'):
+                    parts = message.split(':', 4)
+                    if len(parts) >= 5:
+                        sender, filename, filesize_str = parts[2], parts[3], parts[4]
                         try:
-                            port = int(message.split(':', 2)[2])
-                            self.init_audio(port) # Start all audio systems
-                        except Exception as e:
-                            print(f"[ERROR] Failed to parse AUDIO_PORT: {e}")
-
-                    # --- H. NEW: USER_JOINED ---
-                    elif message.startswith('CMD:USER_JOINED:'):
-                        nickname = message.split(':', 2)[2]
-                        if nickname != self.NICKNAME:
-                            self.safe_ui_update(self.display_message, f"[SYSTEM] {nickname} has joined the call.\n")
-                            # Create a placeholder for their video feed
-                            self.safe_ui_update(self.update_video_feed, nickname, b'')
-
-                    # --- I. NEW: USER_LEFT ---
-                    elif message.startswith('CMD:USER_LEFT:'):
-                        nickname = message.split(':', 2)[2]
-                        if nickname != self.NICKNAME:
-                            self.safe_ui_update(self.display_message, f"[SYSTEM] {nickname} has left the call.\n")
-                            self.safe_ui_update(self.remove_video_feed, nickname)
-                                
-                    # --- J. REGULAR CHAT MESSAGE ---
+                            self.show_available_files([(filename, int(filesize_str), sender)])
+                        except (ValueError, IndexError) as e:
+                            print(f"Error parsing FILE_NEW_AVAILABLE: {e}")
+
+                # CMD:FILE_LIST:<page>:<pages>:<json [[name, size, sender], ...]> - the listing sent on join
+                elif message.startswith('CMD:FILE_LIST:'):
+                    try:
+                        _, _, page, pages, listing = message.split(':', 4)
+                        self.show_available_files(json.loads(listing))
+                    except ValueError as e:
+                        print(f"Error parsing FILE_LIST: {e}")
+
+                elif message.startswith('CMD:PRESENTER_SET:'):
+                    nickname = message.split(':', 2)[2]
+                    self.screen_compositor.reset() # Next presenter starts with a keyframe
+                    if nickname == self.NICKNAME:
+                        self.start_sharing_thread()
+                    elif nickname == "NONE":
+                        self.stop_sharing_thread()
+                        self.safe_ui_update(self.hide_screen_view_window)
+                        self.safe_ui_update(self.status_label.config, text="Ready", fg="green")
                     else:
-                        if not message.startswith('CMD:'):
-                            self.safe_ui_update(self.display_message, message + "\n")
+                        self.safe_ui_update(self.show_screen_view_window)
+                        self.safe_ui_update(self.status_label.config, text=f"{nickname} is presenting", fg="blue")
+
+                elif message == 'CMD:SCREEN_KEYFRAME_REQUEST':
+                    if self.screen_encoder:
+                        self.screen_encoder.request_keyframe()
+
+                # --- G. AUDIO PORT ---
+                # CMD:AUDIO_PORT:<audio port>:<video port>
+                elif message.startswith('CMD:AUDIO_PORT:'):
+                    try:
+                        ports = message.split(':')[2:]
+                        if len(ports) > 1:
+                            self.init_video(int(ports[1]))
                         else:
-                            print(f"WARNING: Unhandled command: {message}")
+                            print("[VIDEO] Server sent no video port, video is off")
+                        self.init_audio(int(ports[0])) # Start all audio systems
+                    except Exception as e:
+                        print(f"[ERROR] Failed to parse AUDIO_PORT: {e}")
 
-            except Exception as e:
-                print(f"[ERROR] Disconnected from server. {e}")
-                self.connected = False
-                self.audio_running = False
-                self.safe_ui_update(self.display_message, f"[SYSTEM] Connection error: {e}\n")
-                try: self.client_socket.close()
-                except: pass
-                break
+                # CMD:VIDEO_FEEDBACK:<viewer>:<frames>:<lost>:<late>:<decode ms>, about our video
+                elif message.startswith('CMD:VIDEO_FEEDBACK:'):
+                    try:
+                        viewer, frames, lost, late, decode_ms = message.split(':')[2:]
+                        self.video_rate.report(viewer, int(frames), int(lost), int(late), float(decode_ms),
+                                               time.monotonic())
+                    except ValueError:
+                        print(f"[VIDEO] Bad feedback: {message}")
+
+                # --- H. NEW: USER_JOINED ---
+                elif message.startswith('CMD:USER_JOINED:'):
+                    nickname = message.split(':', 2)[2]
+                    if nickname != self.NICKNAME:
+                        self.safe_ui_update(self.display_message, f"[SYSTEM] {nickname} has joined the call.\n")
+                        # Create a placeholder for their video feed
+                        self.safe_ui_update(self.update_video_feed, nickname, b'')
+
+                # --- I. NEW: USER_LEFT ---
+                elif message.startswith('CMD:USER_LEFT:'):
+                    nickname = message.split(':', 2)[2]
+                    if nickname != self.NICKNAME:
+                        self.safe_ui_update(self.display_message, f"[SYSTEM] {nickname} has left the call.\n")
+                        self.safe_ui_update(self.remove_video_feed, nickname)
+                        self.peer_opus_decoders.pop(nickname, None)
+                        self.video_frames.remove(nickname)
+                        if self.sfu_mixer:
+                            self.sfu_mixer.remove(nickname)
+
+                # --- J. REGULAR CHAT MESSAGE ---
+                else:
+                    if not message.startswith('CMD:'):
+                        self.safe_ui_update(self.display_message, message + "\n")
+                    else:
+                        print(f"WARNING: Unhandled command: {message}")
+
+        except Exception as e:
+            print(f"[ERROR] Disconnected from server. {e}")
+            self.safe_ui_update(self.display_message, f"[SYSTEM] Connection error: {e}\n")
+        finally:
+            self.connected = False
+            self.audio_running = False
+            try: self.client_socket.close()
+            except: pass
     
     # --- (start is identical) ---
     def start(self):
@@ -0,0 +1,331 @@
+# protocol.py
+"""
+Binary framing for the TCP control channel (shared by server.py and client.py).
+
+Every message on the TCP connection is one frame:
+
+    +---------+--------+-----------------+-----------------+
+    | version | type   | payload length  | payload         |
+    | 1 byte  | 1 byte | 4 bytes (big-e) | <length> bytes  |
+    +---------+--------+-----------------+-----------------+
+
+so commands can no longer be split or glued together by TCP segmentation.
+"""
+import errno
+import os
+import socket
+import struct
+import threading
+
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!BBI')
+HEADER_SIZE = HEADER.size
+MAX_PAYLOAD = 64 * 1024 * 1024 # Sanity limit, protects against garbage lengths
+
+# --- Frame types ---
+FRAME_TEXT = 1       # UTF-8 text: nickname, chat line or CMD:... command
+FRAME_SCREEN = 2     # One complete JPEG screen frame
+FRAME_FILE_DATA = 3  # A chunk of a file upload/download body
+FRAME_SCREEN_DELTA = 4 # Changed screen tiles on top of the last frame (see screen_delta.py)
+FRAME_FILE_DATA_COMPRESSED = 5 # A FILE_DATA chunk compressed with the transfer's codec (see transfer.py)
+FILE_DATA_TYPES = (FRAME_FILE_DATA, FRAME_FILE_DATA_COMPRESSED)
+
+RECV_SIZE = 65536
+FILE_CHUNK_SIZE = 1024 * 1024 # Read size when sendfile() is not available
+STAGING_SIZE = 128 * 1024 # Frames larger than this are received straight into their own buffer
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends something that is not a valid frame."""
+
+
+def encode_frame(frame_type, payload):
+    """Returns header + payload ready to be passed to sendall()."""
+    return HEADER.pack(PROTOCOL_VERSION, frame_type, len(payload)) + payload
+
+
+def encode_text(text):
+    """Shortcut for the most common frame: a text command or chat line."""
+    return encode_frame(FRAME_TEXT, text.encode('utf-8'))
+
+
+def parse_capabilities(payload):
+    """CMD:CAPS payload, e.g. 'compress=zstd,zlib;audio=opus,pcm' -> {'compress': [...], 'audio': [...]}."""
+    capabilities = {}
+    for item in payload.split(';'):
+        key, _, value = item.partition('=')
+        if key:
+            capabilities[key] = [v for v in value.split(',') if v]
+    return capabilities
+
+
+class FrameParser:
+    """
+    Incremental frame parser. Feed it whatever recv() returned and it hands
+    back every frame that is now complete.
+
+    Bytes are appended to one bytearray and each header is inspected once, so
+    a burst of n bytes is parsed in O(n). Each payload is copied exactly once
+    (out of the receive buffer) and the consumed prefix is dropped once per
+    feed() instead of once per message.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        buf = self.buffer
+        buf += data
+        frames = []
+        pos = 0
+        end = len(buf)
+        with memoryview(buf) as view:
+            while end - pos >= HEADER_SIZE:
+                version, frame_type, length = HEADER.unpack_from(buf, pos)
+                if version != PROTOCOL_VERSION:
+                    raise ProtocolError(f"Unsupported protocol version {version}")
+                if length > MAX_PAYLOAD:
+                    raise ProtocolError(f"Frame too large ({length} bytes)")
+                start = pos + HEADER_SIZE
+                if end - start < length:
+                    break # Wait for the rest of this frame
+                frames.append((frame_type, view[start:start + length].tobytes()))
+                pos = start + length
+        if pos:
+            del buf[:pos]
+        return frames
+
+
+class PooledBuffer:
+    """
+    A payload living in a BufferPool buffer. `view` is exactly the payload.
+    Whoever holds a reference calls release() once; the buffer is recycled
+    when the last reference is gone.
+    """
+    __slots__ = ('pool', 'buffer', 'view', 'refs')
+
+    def __init__(self, pool, buffer, size):
+        self.pool = pool
+        self.buffer = buffer
+        self.view = memoryview(buffer)[:size]
+        self.refs = 1
+
+    def __len__(self):
+        return len(self.view)
+
+    def retain(self):
+        with self.pool.lock:
+            self.refs += 1
+
+    def release(self):
+        with self.pool.lock:
+            self.refs -= 1
+            if self.refs:
+                return
+        self.view.release()
+        self.pool.recycle(self.buffer)
+
+
+class BufferPool:
+    """
+    Reusable bytearrays for large frame payloads (screen frames), so a steady
+    stream of 200 KB - 2 MB frames doesn't allocate a fresh buffer each time.
+    """
+    def __init__(self, max_free=8, granularity=64 * 1024):
+        self.lock = threading.Lock()
+        self.free = []
+        self.max_free = max_free
+        self.granularity = granularity
+
+    def acquire(self, size):
+        with self.lock:
+            fitting = [buf for buf in self.free if len(buf) >= size]
+            if fitting:
+                buf = min(fitting, key=len)
+                self.free.remove(buf)
+                return PooledBuffer(self, buf, size)
+        capacity = -(-size // self.granularity) * self.granularity # Round up
+        return PooledBuffer(self, bytearray(capacity), size)
+
+    def recycle(self, buffer):
+        with self.lock:
+            if len(self.free) < self.max_free:
+                self.free.append(buffer)
+
+
+class FrameReader:
+    """
+    Reads frames from a blocking socket with recv_into.
+
+    Small frames are parsed out of one fixed staging buffer that is reused for
+    the whole connection. A frame that doesn't fit in it is received straight
+    into a buffer sized from its header: a PooledBuffer for `pooled_types`
+    (caller must release() it) or a fresh bytearray otherwise. Either way a
+    2 MB screen frame is never concatenated or copied on the way in.
+    """
+    def __init__(self, sock, pool=None, pooled_types=(FRAME_SCREEN, FRAME_SCREEN_DELTA), staging_size=STAGING_SIZE):
+        self.sock = sock
+        self.pool = pool
+        self.pooled_types = pooled_types
+        self.staging = bytearray(staging_size)
+        self.view = memoryview(self.staging)
+        self.start = 0
+        self.end = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            frame = self._parse_staged()
+            if frame is not None:
+                return frame
+            # Move the partial frame to the front and top up the staging buffer
+            if self.start:
+                pending = self.end - self.start
+                self.staging[:pending] = self.staging[self.start:self.end]
+                self.start, self.end = 0, pending
+            received = self.sock.recv_into(self.view[self.end:])
+            if not received:
+                raise StopIteration
+            self.end += received
+
+    def _parse_staged(self):
+        available = self.end - self.start
+        if available < HEADER_SIZE:
+            return None
+        version, frame_type, length = HEADER.unpack_from(self.staging, self.start)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}")
+        if length > MAX_PAYLOAD:
+            raise ProtocolError(f"Frame too large ({length} bytes)")
+        payload_start = self.start + HEADER_SIZE
+        if available - HEADER_SIZE >= length:
+            self.start = payload_start + length
+            return frame_type, self.view[payload_start:self.start].tobytes()
+        if HEADER_SIZE + length <= len(self.staging):
+            return None # Fits in staging, just wait for more bytes
+        return frame_type, self._receive_large(frame_type, length, payload_start)
+
+    def _receive_large(self, frame_type, length, payload_start):
+        if self.pool is not None and frame_type in self.pooled_types:
+            payload = self.pool.acquire(length)
+            target = payload.view
+        else:
+            payload = bytearray(length)
+            target = memoryview(payload)
+        # Whatever is already staged goes first, the rest comes off the socket
+        have = self.end - payload_start
+        target[:have] = self.view[payload_start:self.end]
+        self.start = self.end = 0
+        try:
+            while have < length:
+                received = self.sock.recv_into(target[have:])
+                if not received:
+                    raise ConnectionError("Connection closed in the middle of a frame")
+                have += received
+        except BaseException:
+            if isinstance(payload, PooledBuffer):
+                payload.release()
+            raise
+        return payload
+
+
+def read_frames(sock, pool=None):
+    """
+    [GENERATOR] Yields (frame_type, payload) from a blocking socket until the
+    peer closes the connection.
+    """
+    yield from FrameReader(sock, pool)
+
+
+def send_buffers(sock, buffers):
+    """
+    sendall() for several buffers (e.g. a frame header and a shared payload)
+    without joining them: one sendmsg() gather write where the OS supports it.
+    """
+    if not hasattr(sock, 'sendmsg'): # Windows
+        for buf in buffers:
+            sock.sendall(buf)
+        return
+    views = [memoryview(buf) for buf in buffers]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= views[0].nbytes:
+            sent -= views[0].nbytes
+            views.pop(0)
+        if views and sent:
+            views[0] = views[0][sent:]
+
+
+def open_udp_socket(receive_buffer, send_buffer, address=None):
+    """
+    A UDP socket for one kind of media (audio and video each get their own,
+    so a burst of one never queues ahead of the other), with SO_RCVBUF /
+    SO_SNDBUF as given and bound to `address` if there is one. The OS may
+    cap the sizes (Linux: net.core.rmem_max / wmem_max); socket_buffers()
+    tells what it granted.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for option, size in ((socket.SO_RCVBUF, receive_buffer), (socket.SO_SNDBUF, send_buffer)):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+        except OSError:
+            pass # Keep the default
+    if address is not None:
+        sock.bind(address)
+    return sock
+
+
+def socket_buffers(sock):
+    """'<receive> KB in, <send> KB out' as the OS granted them, for logging."""
+    receive = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    send = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+    return f"{receive // 1024} KB in, {send // 1024} KB out"
+
+
+def send_file(sock, file, offset, count, progress=None, use_sendfile=True):
+    """
+    Sends `count` bytes of `file` starting at `offset` to a blocking socket.
+
+    Uses os.sendfile() so the data goes from the page cache to the socket
+    without passing through Python; where that is not available (Windows) or
+    refused, falls back to readinto() a reusable 1 MB buffer + sendall().
+    progress() is called after every piece, for stall detection.
+    """
+    sent = 0
+    if use_sendfile and hasattr(os, 'sendfile'):
+        try:
+            while sent < count:
+                n = os.sendfile(sock.fileno(), file.fileno(), offset + sent, count - sent)
+                if n == 0:
+                    raise OSError(f"File ended {count - sent} bytes early")
+                sent += n
+                if progress: progress()
+            return
+        except OSError as e:
+            if sent or e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                raise # Part of the range is already on the wire
+
+    buffer = bytearray(min(FILE_CHUNK_SIZE, count - sent) or 1)
+    view = memoryview(buffer)
+    file.seek(offset + sent)
+    while sent < count:
+        n = file.readinto(view[:min(len(buffer), count - sent)])
+        if not n:
+            raise OSError(f"File ended {count - sent} bytes early")
+        sock.sendall(view[:n])
+        sent += n
+        if progress: progress()
+
+
+async def read_frames_async(reader, parser=None):
+    """
+    [ASYNC GENERATOR] Same as read_frames, for an asyncio StreamReader.
+    """
+    parser = parser or FrameParser()
+    while True:
+        data = await reader.read(RECV_SIZE)
+        if not data:
+            return
+        for frame in parser.feed(data):
+            yield frame
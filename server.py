@@ -4,8 +4,17 @@ import threading
 import sys
 import os
 import time
-import numpy as np
+import asyncio
+import collections
+import json
+import argparse
+import queue
+import secrets
 import pyaudio # New import
+import protocol
+import transfer
+import audio_mixer
+import video_packets
 
 # Try to import opuslib, but make it optional
 try:
@@ -14,7 +23,7 @@ try:
     print("[INFO] Opus codec available - using compressed audio")
 except Exception as e:
     OPUS_AVAILABLE = False
-    print(f"[INFO] Opus codec not available - using raw audio (install Opus library for better quality)")
+    print("[INFO] Opus codec not available - using raw audio (install Opus library for better quality)")
     print(f"[DEBUG] Opus import error: {e}")
 
 # --- Server Configuration ---
@@ -22,62 +31,744 @@ HOST = '0.0.0.0'  # Bind to all network interfaces (recommended for LAN)
 # Or use your specific IP: HOST = '172.16.141.51'
 PORT = 6543
 SERVER_FILES_DIR = "server_files"
+BLOB_DIR = os.path.join(SERVER_FILES_DIR, ".blobs") # File contents, each stored once under its content hash
+PARTIAL_DIR = os.path.join(SERVER_FILES_DIR, ".partial") # Interrupted uploads (by content hash), kept for resuming
+HASH_CACHE_DIR = os.path.join(SERVER_FILES_DIR, ".hashes") # Chunk hashes of stored contents
+FILE_INDEX_PATH = os.path.join(SERVER_FILES_DIR, ".index", "files.json") # Name -> content table; None = memory only
+LOOSE_FILE_SETTLE_TIME = 2.0 # Seconds a file dropped into SERVER_FILES_DIR must sit still before it is imported
+FILE_LIST_PAGE_SIZE = 500 # Files per CMD:FILE_LIST frame sent to a joining client
+# "threaded" = one OS thread per client, "async" = single-threaded event loop
+# (selectable with --mode on the command line)
+SERVER_MODE = "threaded"
+
+# --- Outbound Queue Configuration ---
+OUTBOUND_QUEUE_MAX_BYTES = 16 * 1024 * 1024 # Per client
+# "drop_oldest_screen" = drop stale screen frames when the queue is full,
+# "disconnect" = evict the client as soon as the queue is full
+OUTBOUND_OVERFLOW_POLICY = "drop_oldest_screen"
+SLOW_CLIENT_TIMEOUT = 10.0 # Seconds without write progress before eviction (0 = never)
+QUEUE_STATS_INTERVAL = 30.0 # Seconds between [QUEUE] stats lines
+# Latest-frame-wins: a viewer never has more than one screen frame waiting
+# behind the one being sent; a newer frame replaces the pending one
+SCREEN_LATEST_FRAME_ONLY = True
+# A viewer that missed a tile delta needs a keyframe; the presenter is asked
+# for one at most this often (seconds)
+KEYFRAME_REQUEST_MIN_INTERVAL = 1.0
+
+# --- Data Channel Configuration ---
+# File bodies travel on their own TCP connections, so a transfer never
+# holds up chat or screen frames on the control connection
+DATA_PORT = 6545
+TRANSFER_WORKERS = 8 # Worker threads = data connections served at the same time
+TRANSFER_TOKEN_TTL = 30.0 # Seconds a client has to open the data connection for a token
+DOWNLOAD_FRAME_SIZE = transfer.CHUNK_SIZE # One FILE_DATA frame per chunk, pushed with sendfile()
+SENDFILE_CHUNK_SIZE = 1024 * 1024 # Bytes per sendfile() call, so a slow reader still shows progress
 
 # --- Audio/Video Configuration ---
-UDP_PORT = 6544 # New port for audio/video
+UDP_PORT = 6544 # Audio datagrams
+VIDEO_PORT = 6546 # Video datagrams, on their own socket and thread so a burst of frames never delays audio
+AUDIO_SOCKET_BUFFER = 1024 * 1024 # SO_RCVBUF / SO_SNDBUF of the audio sockets: a tick's mixes to every listener
+VIDEO_SOCKET_BUFFER = 8 * 1024 * 1024 # Of the video socket: bursts of JPEG frames, fanned out to every viewer
+VIDEO_STATS_INTERVAL = 30.0 # Seconds between [VIDEO] relay stats lines
 FORMAT = pyaudio.paInt16
 CHANNELS = 1
-RATE = 44100
-CHUNK = 1024
+RATE = 48000 # Opus's own rate (clients resample at their sound card if they must)
+FRAME_MS = 20 # Opus takes 10, 20, 40 or 60 ms frames
+CHUNK = RATE * FRAME_MS // 1000 # 960 samples
+AUDIO_FRAME_DURATION = CHUNK / RATE # The mixer ticks once per frame (20 ms)
+AUDIO_STATS_INTERVAL = 30.0 # Seconds between [AUDIO] jitter buffer stats lines
+OPUS_MIX_BITRATE = 32000 # Bits/s of each Opus-encoded mix (raw PCM is RATE * 16)
+OPUS_MIX_FEC_LOSS = 5 # Packet loss (%) the mixes carry in-band FEC for, so clients can rebuild a lost frame; 0 = no FEC
+# "mix" = decode every sender and send each listener a mix-minus,
+# "sfu" = forward the loudest SFU_MAX_SPEAKERS senders' packets untouched and
+# let the clients decode and mix (selectable with --audio on the command line)
+AUDIO_MODE = "mix"
+SFU_MAX_SPEAKERS = audio_mixer.SFU_MAX_SPEAKERS
+MIX_MAX_SPEAKERS = audio_mixer.MIX_MAX_SPEAKERS # Mix mode: loudest senders mixed per tick
+
+# --- NEW: Session registry (client management) ---
+class Session:
+    """One joined user: their TCP connection and, once they said HELLO on each, their audio and video UDP addresses."""
+    __slots__ = ('nickname', 'client', 'udp_addr', 'video_addr', 'audio_format', 'decoder')
+
+    def __init__(self, nickname, client):
+        self.nickname = nickname
+        self.client = client
+        self.udp_addr = None # (ip, port) of their audio socket
+        self.video_addr = None # (ip, port) of their video socket
+        self.audio_format = 'pcm' # How they get their mix: 'opus' or 'pcm' (CMD:CAPS audio=)
+        self.decoder = None # opuslib.Decoder for their audio, mix mode only
+
+class SessionRegistry:
+    """
+    Every joined user, indexed by TCP connection, nickname and audio and
+    video UDP address, so the UDP threads find the sender of a datagram
+    with one dict lookup however many are in the room. `connected`,
+    `audio_sessions` and `video_sessions` are tuples rebuilt on every
+    join/leave, so broadcasts iterate them without copying or holding the
+    lock.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_client = {} # ClientConnection -> Session
+        self.by_nick = {} # nickname -> Session
+        self.by_addr = {} # Audio UDP (ip, port) -> Session
+        self.by_video_addr = {} # Video UDP (ip, port) -> Session
+        self.connected = () # Every ClientConnection
+        self.audio_sessions = () # Every Session with an audio address
+        self.video_sessions = () # Every Session with a video address
+
+    def add(self, client, nickname):
+        """Registers a new user; returns their Session, or None if the nickname is taken."""
+        with self.lock:
+            if nickname in self.by_nick:
+                return None
+            session = self.by_client[client] = self.by_nick[nickname] = Session(nickname, client)
+            self.connected += (client,)
+            return session
+
+    def remove(self, client):
+        """Unregisters the user on `client`; returns their Session, or None if they weren't registered."""
+        with self.lock:
+            session = self.by_client.pop(client, None)
+            if session is None:
+                return None
+            del self.by_nick[session.nickname]
+            if session.udp_addr is not None:
+                self.by_addr.pop(session.udp_addr, None)
+            if session.video_addr is not None:
+                self.by_video_addr.pop(session.video_addr, None)
+            self._rebuild()
+            return session
+
+    def register_udp(self, nickname, addr, video=False):
+        """
+        Binds `nickname` to the audio (or video) UDP address its HELLO came
+        from; returns the Session, or None if not joined.
+        """
+        index, field = (self.by_video_addr, 'video_addr') if video else (self.by_addr, 'udp_addr')
+        with self.lock:
+            session = self.by_nick.get(nickname)
+            if session is None:
+                return None
+            if getattr(session, field) is not None:
+                index.pop(getattr(session, field), None)
+            previous = index.get(addr)
+            if previous is not None and previous is not session:
+                setattr(previous, field, None) # Their socket was closed and the port reused
+            setattr(session, field, addr)
+            index[addr] = session
+            self._rebuild()
+            return session
+
+    def get(self, client):
+        return self.by_client.get(client)
+
+    def at(self, addr):
+        """The Session whose audio UDP address is `addr`, or None."""
+        return self.by_addr.get(addr)
 
-# --- Client Management ---
-clients = []
-nicknames = []
+    def at_video(self, addr):
+        """The Session whose video UDP address is `addr`, or None."""
+        return self.by_video_addr.get(addr)
+
+    def _rebuild(self):
+        self.connected = tuple(self.by_client)
+        self.audio_sessions = tuple(session for session in self.by_client.values() if session.udp_addr is not None)
+        self.video_sessions = tuple(session for session in self.by_client.values() if session.video_addr is not None)
+
+sessions = SessionRegistry()
 server_running = True
 
 # --- Audio/Video Client Management ---
-audio_clients = {} # Maps nickname -> (ip, port)
-latest_audio_chunks = {} # Maps (ip, port) -> audio_data
-audio_lock = threading.Lock() # Lock for audio_clients and latest_audio_chunks
-audio_decoders = {} # Maps (ip, port) -> opuslib.Decoder
+mixer = audio_mixer.AudioMixer(CHUNK * CHANNELS, max_speakers=MIX_MAX_SPEAKERS) # Per-sender jitter buffers, drained by audio_broadcast_thread
+speakers = audio_mixer.SpeakerSelector(SFU_MAX_SPEAKERS) # SFU mode: whose packets are forwarded
+video_frames = video_packets.Reassembler() # Webcam frames, put back together before they are relayed
+
+# --- NEW: Opus encoding of the outgoing mixes ---
+def make_mix_encoder():
+    encoder = opuslib.Encoder(RATE, CHANNELS, opuslib.APPLICATION_VOIP)
+    encoder.bitrate = OPUS_MIX_BITRATE
+    if OPUS_MIX_FEC_LOSS:
+        # opuslib's inband_fec setter drops its value, so set it through the ctl itself
+        opuslib.api.encoder.encoder_ctl(encoder.encoder_state, opuslib.api.ctl.set_inband_fec, 1)
+        encoder.packet_loss_perc = OPUS_MIX_FEC_LOSS
+    return encoder
+
+def opus_mix_supported():
+    """True if Opus can encode our frames (a check on RATE / FRAME_MS, and that the library loads)."""
+    if not OPUS_AVAILABLE:
+        return False
+    try:
+        make_mix_encoder().encode(bytes(CHUNK * CHANNELS * 2), CHUNK)
+        return True
+    except Exception as e:
+        print(f"[AUDIO] Opus can't encode {CHUNK}-sample frames at {RATE} Hz ({e}), mixes are sent as raw PCM")
+        return False
+
+OPUS_MIX_AVAILABLE = opus_mix_supported()
+mix_encoders = audio_mixer.MixEncoders(make_mix_encoder, CHUNK)
 
 # --- Presenter Management (from your Step 3) ---
 current_presenter = None
-presenter_lock = threading.Lock()
+screen_pool = protocol.BufferPool() # Reused receive buffers for screen frames
+presenter_lock = threading.RLock() # Re-entrant: a broadcast under it may evict (remove_client)
+
+# --- NEW: Per-client outbound queues ---
+class RelayFrame:
+    """
+    A frame fanned out to many queues without copying: the header is built
+    once and every viewer sends the very buffer the frame was received into.
+    Each queue holding the frame owns one reference to the pooled buffer.
+    """
+    __slots__ = ('header', 'payload', 'pooled', 'size')
+
+    def __init__(self, frame_type, payload, pooled=None):
+        self.header = protocol.HEADER.pack(protocol.PROTOCOL_VERSION, frame_type, len(payload))
+        self.payload = payload
+        self.pooled = pooled
+        self.size = len(self.header) + len(payload) # Still valid after release()
+
+    def __len__(self):
+        return self.size
+
+    def buffers(self):
+        return (self.header, self.payload)
+
+    def retain(self):
+        if self.pooled: self.pooled.retain()
+
+    def release(self):
+        if self.pooled: self.pooled.release()
+
+class FileSegment:
+    """
+    A FILE_DATA frame whose payload is a byte range of a file on disk. Only the
+    header lives in memory; the transfer worker streams the range with
+    sendfile(), so a download never passes through Python buffers.
+    """
+    __slots__ = ('header', 'path', 'offset', 'length')
+
+    def __init__(self, path, offset, length):
+        self.header = protocol.HEADER.pack(protocol.PROTOCOL_VERSION, protocol.FRAME_FILE_DATA, length)
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return len(self.header) + self.length
+
+def file_segments(path, start, end):
+    """Splits bytes [start, end) of a file into DOWNLOAD_FRAME_SIZE FileSegments."""
+    for offset in range(start, end, DOWNLOAD_FRAME_SIZE):
+        yield FileSegment(path, offset, min(DOWNLOAD_FRAME_SIZE, end - offset))
+
+SCREEN_KINDS = ('screen', 'screen_delta')
+
+class OutboundQueue:
+    """
+    Bounded queue of frames waiting to be written to one client.
+
+    Frames are tagged with a kind: 'control' (commands/chat, never dropped),
+    'screen' / 'screen_delta' (stale ones are skipped, see
+    SCREEN_LATEST_FRAME_ONLY and OUTBOUND_OVERFLOW_POLICY). File data never
+    goes through here, it has its own connections (see DataConnection).
+    Once a delta (or the keyframe under it) is skipped the rest are useless
+    until the next keyframe, so they are dropped and needs_keyframe is set.
+    put() returns False when the client can't keep up and must be evicted.
+    """
+    def __init__(self, max_bytes=OUTBOUND_QUEUE_MAX_BYTES, on_put=None):
+        self.items = collections.deque() # (data, kind)
+        self.cond = threading.Condition()
+        self.max_bytes = max_bytes
+        self.on_put = on_put # Wakes up an event-loop writer
+        self.queued_bytes = 0
+        self.in_flight = False
+        self.in_flight_kind = None
+        self.closed = False
+        self.last_progress = time.monotonic()
+        self.needs_keyframe = True # Deltas are useless until a full screen frame got through
+        # Counters
+        self.peak_depth = 0
+        self.dropped_frames = 0
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        # Screen frames for the current presenting session (see take_screen_counts)
+        self.screen_delivered = 0
+        self.screen_skipped = 0
+
+    def put(self, data, kind='control'):
+        with self.cond:
+            if self.closed:
+                return False
+            if not self.items and not self.in_flight:
+                self.last_progress = time.monotonic() # Stall clock starts now
+            if kind == 'screen':
+                if SCREEN_LATEST_FRAME_ONLY:
+                    self._skip_pending_screen_frames()
+                self.needs_keyframe = False # Fresh base for the deltas after it
+            elif kind == 'screen_delta':
+                if self.needs_keyframe or (SCREEN_LATEST_FRAME_ONLY and self._has_pending_screen_frames()):
+                    self._skip_delta()
+                    return True
+            self.items.append((data, kind))
+            self.queued_bytes += len(data)
+            if isinstance(data, RelayFrame):
+                data.retain()
+            if self.queued_bytes > self.max_bytes:
+                if OUTBOUND_OVERFLOW_POLICY == "drop_oldest_screen":
+                    self._drop_oldest_screen_frames()
+                if self.queued_bytes > self.max_bytes:
+                    return False
+            self.peak_depth = max(self.peak_depth, len(self.items))
+            self.cond.notify_all()
+        if self.on_put:
+            self.on_put()
+        return True
+
+    def _drop_oldest_screen_frames(self):
+        # Keep the newest screen frame, drop older ones until we fit again
+        screen_items = [item for item in self.items if item[1] in SCREEN_KINDS][:-1]
+        for item in screen_items:
+            if self.queued_bytes <= self.max_bytes:
+                break
+            self._drop(item)
+        if self.needs_keyframe:
+            self._drop_pending_deltas()
+
+    def _skip_pending_screen_frames(self):
+        # The frame being put is newer than anything still waiting to be sent
+        for item in [item for item in self.items if item[1] in SCREEN_KINDS]:
+            self._drop(item)
+
+    def _has_pending_screen_frames(self):
+        return any(kind in SCREEN_KINDS for data, kind in self.items)
+
+    def _skip_delta(self):
+        # The delta being put is not queued; a pending keyframe still goes out
+        self._drop_pending_deltas()
+        self.needs_keyframe = True
+        self.dropped_frames += 1
+        self.screen_skipped += 1
+
+    def _drop_pending_deltas(self):
+        for item in [item for item in self.items if item[1] == 'screen_delta']:
+            self._drop(item)
+
+    def _drop(self, item):
+        try:
+            index = self.items.index(item)
+        except ValueError:
+            return # Already dropped along with its keyframe
+        self._discard(index)
+        if item[1] == 'screen_delta':
+            self.needs_keyframe = True
+        elif item[1] == 'screen':
+            # The deltas queued after a keyframe were built on it: they go too,
+            # and if no newer keyframe is queued, so do the ones still to come
+            while index < len(self.items) and self.items[index][1] != 'screen':
+                if self.items[index][1] == 'screen_delta':
+                    self._discard(index)
+                else:
+                    index += 1
+            if index == len(self.items):
+                self.needs_keyframe = True
+
+    def _discard(self, index):
+        data, kind = self.items[index]
+        del self.items[index]
+        self.queued_bytes -= len(data)
+        self.dropped_frames += 1
+        self.screen_skipped += 1
+        if isinstance(data, RelayFrame):
+            data.release()
+
+    def get(self, timeout=None):
+        """Blocking pop for writer threads. Returns None once closed and empty, or after `timeout`."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while not self.items and not self.closed:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return self._pop()
+
+    def pop(self):
+        """Non-blocking pop for event-loop writers."""
+        with self.cond:
+            return self._pop()
+
+    def _pop(self):
+        if not self.items:
+            return None
+        data, kind = self.items.popleft()
+        self.queued_bytes -= len(data)
+        self.in_flight = True
+        self.in_flight_kind = kind
+        return data
+
+    def task_done(self, data):
+        """Called by the writer once `data` is on the wire (or failed to get there)."""
+        if isinstance(data, RelayFrame):
+            data.release()
+        with self.cond:
+            if self.in_flight_kind in SCREEN_KINDS:
+                self.screen_delivered += 1
+            self.in_flight = False
+            self.in_flight_kind = None
+            self.sent_frames += 1
+            self.sent_bytes += len(data)
+            self.last_progress = time.monotonic()
+            self.cond.notify_all()
+
+    def stalled_for(self):
+        """Seconds the writer has gone without progress while data is pending."""
+        with self.cond:
+            if not self.items and not self.in_flight:
+                return 0.0
+            return time.monotonic() - self.last_progress
+
+    def close(self, flush=True):
+        with self.cond:
+            self.closed = True
+            if not flush:
+                for data, kind in self.items:
+                    if isinstance(data, RelayFrame):
+                        data.release()
+                self.items.clear()
+                self.queued_bytes = 0
+            self.cond.notify_all()
+        if self.on_put:
+            self.on_put()
+
+    def begin_screen_session(self):
+        """A new presenter started: reset the counts, wait for their first keyframe."""
+        self.take_screen_counts()
+        with self.cond:
+            self.needs_keyframe = True
+
+    def take_screen_counts(self):
+        """Returns (delivered, skipped) screen frames since the last call and resets them."""
+        with self.cond:
+            counts = (self.screen_delivered, self.screen_skipped)
+            self.screen_delivered = self.screen_skipped = 0
+            return counts
+
+    def stats(self):
+        with self.cond:
+            return (f"depth={len(self.items)} (peak {self.peak_depth}), "
+                    f"{self.queued_bytes / 1024:.0f} KB queued, "
+                    f"{self.dropped_frames} screen frames dropped, "
+                    f"{self.sent_bytes / (1024 * 1024):.1f} MB sent")
+
+class ClientConnection:
+    """
+    Base for a connected TCP client. sendall() only enqueues, so a broadcast
+    never waits on a slow peer; each subclass drains its queue with its own
+    writer (a thread or an asyncio task).
+    """
+    def __init__(self):
+        self.nickname = None
+        self.codecs = () # File transfer compression shared with the client (CMD:CAPS)
+        self.queue = OutboundQueue(on_put=self._wakeup_writer)
+
+    def _wakeup_writer(self):
+        pass
+
+    def sendall(self, data, kind='control'):
+        if not self.queue.put(data, kind):
+            if self.queue.closed:
+                raise OSError("Connection closed")
+            print(f"[QUEUE] Evicting {self.nickname}: outbound queue over "
+                  f"{OUTBOUND_QUEUE_MAX_BYTES // (1024 * 1024)} MB ({self.queue.stats()})")
+            self.abort()
+            raise OSError("Slow consumer evicted")
+
+    def close(self):
+        """Flushes what is queued, then closes."""
+        self.queue.close(flush=True)
+
+    def abort(self):
+        """Drops what is queued and closes right away."""
+        self.queue.close(flush=False)
+
+class ThreadedClient(ClientConnection):
+    """A plain blocking socket drained by a dedicated writer thread."""
+    def __init__(self, sock):
+        super().__init__()
+        self.sock = sock
+        self.writer_thread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer_thread.start()
+
+    def writer_loop(self):
+        """[THREAD] Sends queued frames in order until the queue is closed."""
+        try:
+            while (data := self.queue.get()) is not None:
+                try:
+                    if isinstance(data, RelayFrame):
+                        protocol.send_buffers(self.sock, data.buffers()) # Header + shared payload, one syscall
+                    else:
+                        self.sock.sendall(data)
+                finally:
+                    self.queue.task_done(data)
+        except OSError:
+            self.queue.close(flush=False)
+        finally:
+            try: self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+            self.sock.close()
+
+    def abort(self):
+        super().abort()
+        # Unblocks both a writer stuck in sendall and the reader in recv
+        try: self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+
+def outbound_monitor_thread():
+    """
+    [THREAD] Evicts clients whose writer has been stuck for SLOW_CLIENT_TIMEOUT
+    seconds, drops data connections that stopped moving for as long, and
+    periodically logs queue counters.
+    """
+    last_stats = time.monotonic()
+    while server_running:
+        time.sleep(1.0)
+        for client in sessions.connected:
+            stalled = client.queue.stalled_for()
+            if SLOW_CLIENT_TIMEOUT and stalled > SLOW_CLIENT_TIMEOUT:
+                print(f"[QUEUE] Evicting {client.nickname}: no progress for {stalled:.0f}s ({client.queue.stats()})")
+                client.abort()
+                remove_client(client)
+        with transfer_lock:
+            transfers = active_transfers[:]
+        for conn in transfers:
+            stalled = conn.stalled_for()
+            if SLOW_CLIENT_TIMEOUT and stalled > SLOW_CLIENT_TIMEOUT:
+                print(f"[TRANSFER] Dropping data connection of {conn}: no progress for {stalled:.0f}s")
+                conn.abort()
+
+        if time.monotonic() - last_stats >= QUEUE_STATS_INTERVAL:
+            last_stats = time.monotonic()
+            for client in sessions.connected:
+                if client.queue.sent_frames:
+                    print(f"[QUEUE] {client.nickname}: {client.queue.stats()}")
+
+def report_screen_session(presenter_nick):
+    """
+    Logs how many screen frames each viewer got and how many stale ones were
+    skipped for them while presenter_nick was presenting, then resets the counts.
+    """
+    for client in sessions.connected:
+        delivered, skipped = client.queue.take_screen_counts()
+        if delivered or skipped:
+            total = delivered + skipped
+            print(f"[SCREEN] {client.nickname} watching {presenter_nick}: {delivered} frames delivered, "
+                  f"{skipped} stale frames skipped ({100 * skipped / total:.0f}%)")
+
+# --- NEW: Content-addressed file store ---
+def blob_path(content_id):
+    """Where the content with this hash is stored: BLOB_DIR/<first two hex digits>/<hash>."""
+    return os.path.join(BLOB_DIR, content_id[:2], content_id)
+
+class FileIndex:
+    """
+    The files people see: name -> (size, uploader, mtime_ns, content hash).
+
+    File bodies live in BLOB_DIR, once per distinct content (see blob_path),
+    so the same deck uploaded by three people takes the space of one. A name
+    is never overwritten with different content; the newcomer gets stored as
+    "name (2).ext" instead.
+
+    Kept in memory and persisted to FILE_INDEX_PATH. A joining client is
+    sent the same pre-encoded CMD:FILE_LIST pages as everyone else. Files
+    dropped straight into SERVER_FILES_DIR (or left there by older versions)
+    are imported into the store at startup, and again once the directory's
+    mtime shows new ones.
+    """
+    def __init__(self, directory, path=None, page_size=FILE_LIST_PAGE_SIZE):
+        self.directory = directory
+        self.path = path
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.import_lock = threading.Lock() # One import at a time
+        self.files = {}
+        self.dir_mtime = None
+        self.pages = None # Encoded CMD:FILE_LIST frames, rebuilt after a change
+
+    def load(self):
+        """Reads the persisted table, then imports any loose files."""
+        known = {} # Entries from before the blob store, their files are still loose
+        if self.path:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    for name, entry in json.load(f).items():
+                        if len(entry) == 4 and os.path.isfile(blob_path(entry[3])):
+                            self.files[name] = tuple(entry)
+                        else:
+                            known[name] = entry
+            except (OSError, ValueError):
+                pass
+        self.import_loose_files(known)
+        distinct = len({entry[3] for entry in self.files.values()})
+        print(f"[FILES] Indexed {len(self.files)} files ({distinct} distinct contents) in {self.directory}")
+
+    def loose_files_changed(self):
+        """One stat(): has anything been added to the directory behind the server's back?"""
+        try:
+            return os.stat(self.directory).st_mtime_ns != self.dir_mtime
+        except OSError:
+            return False
+
+    def import_loose_files(self, known=None, on_added=None):
+        """
+        Hashes the regular files lying directly in the directory and moves
+        them into the store. on_added(name, size) is called for every new
+        listing entry. Files modified in the last LOOSE_FILE_SETTLE_TIME
+        seconds may still be being copied in and are left for the next time.
+        """
+        if not self.import_lock.acquire(blocking=False):
+            return # Another thread is already at it
+        try:
+            with os.scandir(self.directory) as entries:
+                loose = [entry for entry in entries if entry.is_file()]
+            settled = True
+            for entry in loose:
+                try:
+                    stat = entry.stat()
+                    if time.time() - stat.st_mtime < LOOSE_FILE_SETTLE_TIME:
+                        settled = False
+                        continue
+                    hashes = transfer.hash_file_chunks(entry.path)
+                    content_id = transfer.content_hash(hashes)
+                    if os.path.isfile(blob_path(content_id)):
+                        os.remove(entry.path) # Same content is already stored
+                    else:
+                        os.makedirs(os.path.dirname(blob_path(content_id)), exist_ok=True)
+                        os.replace(entry.path, blob_path(content_id))
+                        transfer.save_file_hashes(blob_path(content_id), HASH_CACHE_DIR, hashes)
+                    old = (known or {}).get(entry.name)
+                    uploader = old[1] if old and old[0] == stat.st_size else "Server"
+                    name, added = self.add(entry.name, uploader, stat.st_size, content_id)
+                    print(f"[FILES] Imported {entry.name} into the store as {name} ({content_id[:12]})")
+                    if added and on_added:
+                        on_added(name, stat.st_size)
+                except OSError as e:
+                    print(f"[FILES] Could not import {entry.name}: {e}")
+            with self.lock:
+                # Moving files out changed the mtime again; only remember it once everything is in
+                self.dir_mtime = os.stat(self.directory).st_mtime_ns if settled else None
+        finally:
+            self.import_lock.release()
+
+    def add(self, name, uploader, size, content_id):
+        """
+        Lists `name` for a stored content. Returns (name it is listed under,
+        whether that is a new entry): the same content under the same name
+        is listed once, different content under a taken name gets a suffix.
+        """
+        stem, ext = os.path.splitext(name)
+        with self.lock:
+            listed, n = name, 2
+            while listed in self.files and self.files[listed][3] != content_id:
+                listed, n = f"{stem} ({n}){ext}", n + 1
+            if listed in self.files:
+                return listed, False
+            self.files[listed] = (size, uploader, time.time_ns(), content_id)
+            self.pages = None
+        self.save()
+        return listed, True
+
+    def lookup(self, name):
+        """(size, content hash) of a listed file, or None."""
+        with self.lock:
+            entry = self.files.get(name)
+        return (entry[0], entry[3]) if entry else None
+
+    def has_content(self, content_id, size):
+        """True if the store already holds this content (so it needn't be uploaded)."""
+        try:
+            return os.path.getsize(blob_path(content_id)) == size
+        except OSError:
+            return False
+
+    def discard(self, name):
+        """Forgets a file whose content turned out to be gone."""
+        with self.lock:
+            if self.files.pop(name, None) is None:
+                return
+            self.pages = None
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            snapshot = json.dumps(self.files)
+        try:
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(snapshot)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            print(f"[FILES] Could not save the file index: {e}")
+
+    def listing_frames(self):
+        """
+        The CMD:FILE_LIST:<page>:<pages>:<json [[name, size, uploader], ...]>
+        frames for a joining client, encoded once per change of the index.
+        """
+        with self.lock:
+            if self.pages is None:
+                entries = [[name, size, uploader] for name, (size, uploader, _, _) in sorted(self.files.items())]
+                count = max(1, -(-len(entries) // self.page_size))
+                self.pages = [
+                    protocol.encode_text(f"CMD:FILE_LIST:{n + 1}:{count}:" +
+                                         json.dumps(entries[n * self.page_size:(n + 1) * self.page_size]))
+                    for n in range(count)]
+            return self.pages
+
+def import_loose_files_thread():
+    """[THREAD] Imports files dropped into SERVER_FILES_DIR and announces them."""
+    def announce(name, size):
+        broadcast_all(protocol.encode_text(f"CMD:FILE_NEW_AVAILABLE:Server:{name}:{size}"))
+    file_index.import_loose_files(on_added=announce)
 
 # --- (os.makedirs, broadcast, broadcast_all functions are identical) ---
-os.makedirs(SERVER_FILES_DIR, exist_ok=True)
+os.makedirs(BLOB_DIR, exist_ok=True)
 print(f"[INFO] Files will be stored in: {os.path.abspath(SERVER_FILES_DIR)}")
+file_index = FileIndex(SERVER_FILES_DIR, FILE_INDEX_PATH)
+file_index.load()
 
-def broadcast(message, _sender_client):
-    for client in clients:
+def broadcast(message, _sender_client, kind='control'):
+    for client in sessions.connected:
         if client != _sender_client:
             try:
-                client.send(message)
+                client.sendall(message, kind)
             except:
                 remove_client(client)
 
 def broadcast_all(message):
-    for client in clients[:]:
+    for client in sessions.connected:
         try:
-            client.send(message)
+            client.sendall(message)
         except:
             remove_client(client)
 
 # --- NEW: UDP Broadcast Function ---
-def broadcast_udp(data, _sender_addr, udp_socket):
+def broadcast_udp(packets, _sender_addr, udp_socket):
     """
-    Broadcasts UDP data to all registered clients except the sender.
+    Broadcasts a video frame's datagrams to every registered video socket except the sender's.
     """
-    with audio_lock:
-        # Create a copy of addresses to broadcast to
-        targets = [addr for addr in audio_clients.values() if addr != _sender_addr]
-    
-    for addr in targets:
+    for session in sessions.video_sessions:
+        addr = session.video_addr
+        if addr == _sender_addr:
+            continue
         try:
-            udp_socket.sendto(data, addr)
+            for packet in packets:
+                udp_socket.sendto(packet, addr)
         except Exception as e:
-            print(f"[AUDIO] Failed to send UDP to {addr}: {e}")
+            print(f"[VIDEO] Failed to send UDP to {addr}: {e}")
 
 # --- MODIFIED: remove_client Function ---
 def remove_client(client):
@@ -85,394 +776,1044 @@ def remove_client(client):
     Removes a client from all lists and notifies others.
     """
     global current_presenter
-    if client in clients:
-        index = clients.index(client)
-        nickname = nicknames[index]
+    session = sessions.remove(client)
+    if session is not None:
+        nickname = session.nickname
         
         # Stop presenter if disconnecting
         with presenter_lock:
             if current_presenter == client:
                 current_presenter = None
                 print(f"[PRESENTER] {nickname} stopped presenting (disconnected).")
-                broadcast_all("CMD:PRESENTER_SET:NONE\n".encode('utf-8'))
+                report_screen_session(nickname)
+                broadcast_all(protocol.encode_text("CMD:PRESENTER_SET:NONE"))
         
-        # Remove from audio list
-        with audio_lock:
-            if nickname in audio_clients:
-                addr = audio_clients.pop(nickname)
-                latest_audio_chunks.pop(addr, None) # Remove any lingering chunk
-                # --- NEW: Remove decoder ---
-                audio_decoders.pop(addr, None)
-                # --- End ---
-                print(f"[AUDIO] Removed {nickname} from audio clients.")
+        # Drop their audio state (the decoder went with the session)
+        if session.udp_addr is not None:
+            mixer.remove(nickname) # Drop any buffered audio
+            speakers.remove(nickname)
+            mix_encoders.discard(nickname)
+            print(f"[AUDIO] Removed {nickname} from audio clients.")
+        video_frames.remove(nickname)
 
         client.close()
-        clients.remove(client)
-        nicknames.remove(nickname)
         
         print(f"[DISCONNECT] {nickname} has left.")
-        broadcast(f"[SERVER] {nickname} has left the chat.\n".encode('utf-8'), None)
+        broadcast(protocol.encode_text(f"[SERVER] {nickname} has left the chat."), None)
         # --- NEW: Notify clients to remove user from UI ---
-        broadcast_all(f"CMD:USER_LEFT:{nickname}\n".encode('utf-8'))
+        broadcast_all(protocol.encode_text(f"CMD:USER_LEFT:{nickname}"))
         # --- End of new code ---
 
+# --- NEW: Nickname validation + join sequence (shared by both server modes) ---
+def admit_client(client, nickname):
+    """
+    Validates the nickname, registers the client and sends the join sequence.
+    Returns False (and closes the client) if the nickname was rejected.
+    """
+    if not nickname:
+        client.sendall(protocol.encode_text("ERROR:NICK_EMPTY"))
+        client.close()
+        return False
+
+    if sessions.add(client, nickname) is None:
+        client.sendall(protocol.encode_text(f"ERROR:NICK_TAKEN:{nickname}"))
+        client.close()
+        return False
+    client.nickname = nickname
+
+    print(f"[CONNECT] {nickname} has joined.")
+    # --- FIX: Corrected utf-g to utf-8 ---
+    broadcast(protocol.encode_text(f"[SERVER] {nickname} joined the chat!"), client)
+    client.sendall(protocol.encode_text("[SERVER] Connected successfully."))
+
+    # Existing files: the cached listing, a few frames however many files there are
+    for page in file_index.listing_frames():
+        client.sendall(page)
+    if file_index.loose_files_changed():
+        threading.Thread(target=import_loose_files_thread, daemon=True).start()
+
+    # Tell client the UDP ports: audio, then video
+    client.sendall(protocol.encode_text(f"CMD:AUDIO_PORT:{UDP_PORT}:{VIDEO_PORT}"))
+    return True
+
+# --- NEW: Commands shared by the threaded and event-loop handlers ---
+def process_message(client, nickname, message):
+    """
+    Handles file transfer requests, presenter control, reports and chat. None
+    of these need to read more data off the socket (file bodies have their
+    own data connections), so both server modes dispatch here.
+    """
+    global current_presenter
+
+    # --- FILE TRANSFERS (only tokens here, see handle_data_connection) ---
+    if message.startswith('CMD:FILE_UPLOAD_START:'):
+        offer_upload(client, nickname, message)
+
+    elif message.startswith('CMD:FILE_DOWNLOAD_REQUEST:'):
+        offer_download(client, nickname, message)
+
+    # --- CAPABILITIES (CMD:CAPS:compress=zstd,zlib,lzma;audio=opus,pcm) - answered with what we'll use ---
+    elif message.startswith('CMD:CAPS:'):
+        payload = message.split(':', 2)[2]
+        client.codecs = transfer.parse_capabilities(payload)
+        print(f"[TRANSFER] {nickname} can compress transfers with: {', '.join(client.codecs) or 'nothing we have'}")
+        # In SFU mode the server relays the senders' own Opus packets, so only the client has to handle Opus
+        opus_ok = OPUS_MIX_AVAILABLE or AUDIO_MODE == "sfu"
+        audio_format = 'opus' if opus_ok and 'opus' in protocol.parse_capabilities(payload).get('audio', []) else 'pcm'
+        session = sessions.get(client)
+        if session is not None:
+            session.audio_format = audio_format
+        client.sendall(protocol.encode_text(f"CMD:CAPS:{transfer.capabilities(client.codecs)};audio={audio_format}"))
+
+    # --- PRESENTER REQUEST ---
+    elif message == 'CMD:PRESENTER_REQUEST':
+        with presenter_lock:
+            if current_presenter is None:
+                current_presenter = client
+                presenter_nick = client.nickname
+                for other in sessions.connected:
+                    other.queue.begin_screen_session()
+                print(f"[PRESENTER] {presenter_nick} is now presenting.")
+                broadcast_all(protocol.encode_text(f"CMD:PRESENTER_SET:{presenter_nick}"))
+                print("[PRESENTER] Broadcast presenter set message to all clients")
+            else:
+                existing_presenter = current_presenter.nickname
+                print(f"[PRESENTER] {nickname} denied - {existing_presenter} is already presenting")
+                client.sendall(protocol.encode_text("[SERVER] Cannot start presenting, another user is active."))
+
+    # --- PRESENTER STOP ---
+    elif message == 'CMD:PRESENTER_STOP':
+        with presenter_lock:
+            if current_presenter == client:
+                current_presenter = None
+                print(f"[PRESENTER] {nickname} stopped presenting.")
+                report_screen_session(nickname)
+                broadcast_all(protocol.encode_text("CMD:PRESENTER_SET:NONE"))
+
+    # --- VIDEO FEEDBACK (CMD:VIDEO_FEEDBACK:<sender>:<stats>) - relayed to the sender, from the viewer ---
+    elif message.startswith('CMD:VIDEO_FEEDBACK:'):
+        fields = message.split(':', 3)
+        session = sessions.by_nick.get(fields[2]) if len(fields) == 4 else None
+        if session is not None:
+            try:
+                session.client.sendall(protocol.encode_text(f"CMD:VIDEO_FEEDBACK:{nickname}:{fields[3]}"))
+            except Exception:
+                remove_client(session.client)
+
+    # --- REPORT USER ---
+    elif message.startswith('CMD:REPORT_USER:'):
+        try:
+            reported_nickname = message.split(':', 2)[2]
+            # Simple logging for now. In a real app, write to a file.
+            print(f"--- [REPORT LOG] ---\n  Reporter: {nickname}\n  Reported: {reported_nickname}\n  Timestamp: {time.ctime()}\n  --------------------")
+
+            # Optional: Notify the reporter their action was logged
+            client.sendall(protocol.encode_text(f"[SERVER] Report for {reported_nickname} has been logged."))
+        except Exception as e:
+            print(f"[ERROR] Failed to parse report command: {message} - {e}")
+
+    # --- CHAT MESSAGE ---
+    else:
+        message_to_broadcast = f"[{nickname}] {message}"
+        print(f"[MESSAGE] {message_to_broadcast}")
+        broadcast_all(protocol.encode_text(message_to_broadcast))
+
+# --- NEW: Bulk-data channel ---
+# A transfer is negotiated on the control connection, which only hands out a
+# one-time token; the client then opens a data connection to DATA_PORT, sends
+# DATA:<token>, and the whole upload or download runs on that connection in
+# one of the transfer worker threads.
+pending_transfers = {} # token -> what it was issued for
+uploads_in_progress = set() # Content hashes being uploaded (they share a partial file)
+active_transfers = [] # DataConnections being served right now
+transfer_lock = threading.Lock()
+transfer_queue = queue.Queue() # Accepted data connections waiting for a worker
+
+class DataConnection:
+    """
+    One data connection, served start to finish by a transfer worker with
+    plain blocking I/O. The outbound monitor aborts it when the peer stops
+    making progress.
+    """
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.client = None # The owner's control connection, once the token checked out
+        self.nickname = None
+        self.busy = False # Set while the server itself is working (hashing a file)
+        self.last_progress = time.monotonic()
+
+    def __str__(self):
+        return self.nickname or f"{self.address[0]}:{self.address[1]}"
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.progress()
+
+    def progress(self):
+        self.last_progress = time.monotonic()
+
+    def stalled_for(self):
+        return 0.0 if self.busy else time.monotonic() - self.last_progress
+
+    def abort(self):
+        """Unblocks a worker stuck in recv or sendfile."""
+        try: self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+
+    def close(self):
+        try: self.sock.close()
+        except OSError: pass
+
+def issue_transfer_token(client, nickname, kind, **details):
+    """Registers a transfer for the data channel and returns its token."""
+    token = secrets.token_hex(16)
+    now = time.monotonic()
+    with transfer_lock:
+        for stale in [t for t, entry in pending_transfers.items() if now - entry['issued'] > TRANSFER_TOKEN_TTL]:
+            del pending_transfers[stale]
+        pending_transfers[token] = dict(details, kind=kind, client=client, nickname=nickname, issued=now)
+    return token
+
+def claim_transfer_token(token):
+    """Returns what the token was issued for (once), or None if it is unknown or expired."""
+    with transfer_lock:
+        entry = pending_transfers.pop(token, None)
+    if entry is None or time.monotonic() - entry['issued'] > TRANSFER_TOKEN_TTL:
+        return None
+    return entry
+
+def offer_upload(client, nickname, message):
+    """
+    CMD:FILE_UPLOAD_START:<filename>:<filesize>:<content hash> - if that
+    content is already stored, the file is listed without a byte being sent
+    (CMD:FILE_UPLOAD_EXISTS); otherwise answers with a token for the data
+    connection.
+    """
+    try:
+        filename, filesize, content_id = message.split(':', 2)[2].rsplit(':', 2)
+        filename = os.path.basename(filename)
+        filesize = int(filesize)
+        if not transfer.is_content_hash(content_id):
+            raise ValueError(f"bad content hash {content_id!r}")
+    except (IndexError, ValueError):
+        print(f"[ERROR] Bad upload request from {nickname}: {message}")
+        client.sendall(protocol.encode_text("[SERVER] Error uploading file: bad request"))
+        return
+    if file_index.has_content(content_id, filesize):
+        listed, added = file_index.add(filename, nickname, filesize, content_id)
+        print(f"[FILE UPLOAD] {nickname} uploaded {filename}: content already stored, nothing to transfer.")
+        client.sendall(protocol.encode_text(f"CMD:FILE_UPLOAD_EXISTS:{filename}"))
+        if added:
+            broadcast(protocol.encode_text(f"CMD:FILE_NEW_AVAILABLE:{nickname}:{listed}:{filesize}"), client)
+        return
+    token = issue_transfer_token(client, nickname, 'upload', filename=filename, filesize=filesize, content_id=content_id)
+    print(f"[FILE UPLOAD] {nickname} wants to upload {filename} ({filesize} bytes).")
+    client.sendall(protocol.encode_text(f"CMD:FILE_UPLOAD_TOKEN:{token}:{filename}"))
+
+def offer_download(client, nickname, message):
+    """CMD:FILE_DOWNLOAD_REQUEST:<filename>:<offset>:<hash> - answers with a token for the data connection."""
+    filename, offset, last_hash = parse_download_request(message)
+    if file_index.lookup(filename) is None:
+        client.sendall(protocol.encode_text(f"[SERVER] Error: File '{filename}' not found."))
+        return
+    token = issue_transfer_token(client, nickname, 'download', filename=filename, offset=offset, last_hash=last_hash)
+    client.sendall(protocol.encode_text(f"CMD:FILE_DOWNLOAD_TOKEN:{token}:{filename}"))
+
+def data_server_thread():
+    """[THREAD] Accepts data connections and queues them for the transfer workers."""
+    for _ in range(TRANSFER_WORKERS):
+        threading.Thread(target=transfer_worker_thread, daemon=True).start()
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.settimeout(1.0)
+    try:
+        server.bind((HOST, DATA_PORT))
+        server.listen(16)
+        print(f"[TRANSFER] Data channel listening on {HOST}:{DATA_PORT} ({TRANSFER_WORKERS} workers)")
+        while server_running:
+            try:
+                sock, address = server.accept()
+            except socket.timeout:
+                continue
+            sock.settimeout(None) # Blocking I/O in the worker, stalls are caught by the monitor
+            transfer_queue.put(DataConnection(sock, address))
+    except OSError as e:
+        if server_running: print(f"[ERROR] Data channel error: {e}")
+    finally:
+        server.close()
+        print("[TRANSFER] Data channel shut down.")
+
+def transfer_worker_thread():
+    """[THREAD] Serves queued data connections one at a time."""
+    while True:
+        conn = transfer_queue.get()
+        conn.progress() # The stall clock starts when a worker picks it up
+        with transfer_lock:
+            active_transfers.append(conn)
+        try:
+            handle_data_connection(conn)
+        finally:
+            with transfer_lock:
+                active_transfers.remove(conn)
+            conn.close()
+
+def handle_data_connection(conn):
+    """
+    The first frame must be DATA:<token>; then the upload or download the
+    token was issued for runs to completion on this connection.
+    """
+    frames = protocol.read_frames(conn.sock)
+    try:
+        frame_type, payload = next(frames)
+        message = payload.decode('utf-8').strip() if frame_type == protocol.FRAME_TEXT else ''
+        entry = claim_transfer_token(message[len('DATA:'):]) if message.startswith('DATA:') else None
+        if entry is None:
+            print(f"[TRANSFER] {conn} did not present a valid token, closing.")
+            conn.sendall(protocol.encode_text("ERROR:BAD_TOKEN"))
+            return
+        conn.client, conn.nickname = entry['client'], entry['nickname']
+        if entry['kind'] == 'upload':
+            serve_upload(conn, frames, entry['filename'], entry['filesize'], entry['content_id'])
+        else:
+            serve_download(conn, entry['filename'], entry['offset'], entry['last_hash'])
+    except StopIteration:
+        pass # Closed before sending a token
+    except Exception as e:
+        print(f"[TRANSFER] Data connection from {conn} failed: {e}")
+
+# --- Uploads (the body arrives as FILE_DATA frames on the data connection) ---
+def serve_upload(conn, frames, filename, filesize, content_id):
+    """
+    Offers to resume an interrupted upload of the same content (whoever
+    started it, under whatever name), then receives FILE_DATA frames and
+    checks each chunk against its FILE_CHUNK_HASH. Nothing is written until
+    the client picks an offset with CMD:FILE_UPLOAD_RESUME.
+    """
+    with transfer_lock:
+        busy = content_id in uploads_in_progress
+        uploads_in_progress.add(content_id)
+    if busy:
+        print(f"[FILE UPLOAD] {conn} is uploading content that is already on its way, refusing.")
+        conn.sendall(protocol.encode_text("[SERVER] Error uploading file: someone is uploading the same file right now, "
+                                          "try again when they are done"))
+        return
+    upload = None
+    try:
+        upload = start_upload(conn, filename, filesize, content_id)
+        for frame_type, payload in frames:
+            if upload is None:
+                break
+            conn.progress()
+            if frame_type in protocol.FILE_DATA_TYPES:
+                upload = receive_upload_chunk(conn, upload, frame_type, payload)
+                continue
+            message = payload.decode('utf-8').strip() if frame_type == protocol.FRAME_TEXT else ''
+            if message.startswith('CMD:FILE_UPLOAD_RESUME:'):
+                upload = resume_upload(conn, message, upload)
+            elif message.startswith('CMD:FILE_CHUNK_HASH:'):
+                upload = verify_upload_chunk(conn, upload, message)
+            else:
+                print(f"[WARNING] Unexpected frame during {conn}'s upload: type {frame_type} {message!r}")
+    finally:
+        if upload:
+            abort_upload(upload)
+        with transfer_lock:
+            uploads_in_progress.discard(content_id)
+
+def start_upload(conn, filename, filesize, content_id):
+    """Sends CMD:FILE_READY_TO_RECV:<filename>:<offset>:<hash> and returns the new upload state."""
+    try:
+        partial = transfer.PartialFile(blob_path(content_id), content_id, filesize, PARTIAL_DIR)
+        offset, last_hash = partial.resume_point()
+        if offset:
+            print(f"[FILE UPLOAD] Found {offset} verified bytes of {filename}, offering to resume.")
+        conn.sendall(protocol.encode_text(f"CMD:FILE_READY_TO_RECV:{filename}:{offset}:{last_hash}"))
+        return {'partial': partial, 'filename': filename, 'filesize': filesize, 'content_id': content_id,
+                'received': None, 'codec': None, 'wire_bytes': 0, 'started': time.monotonic()}
+    except Exception as e:
+        print(f"[ERROR] File upload failed: {e}")
+        conn.sendall(protocol.encode_text(f"[SERVER] Error uploading file: {e}"))
+        return None
+
+def resume_upload(conn, message, upload):
+    """CMD:FILE_UPLOAD_RESUME:<filename>:<offset>:<codec> - the client starts sending at offset."""
+    try:
+        _, offset, codec = message.rsplit(':', 2)
+        offset = int(offset)
+        upload['codec'] = transfer.parse_codec(codec)
+        upload['partial'].start(offset)
+        upload['received'] = offset
+        upload['offset'] = offset
+        if offset:
+            print(f"[FILE UPLOAD] Resuming {upload['filename']} from {conn} at byte {offset}.")
+        if upload['codec']:
+            print(f"[FILE UPLOAD] {conn} is sending {upload['filename']} {upload['codec']}-compressed.")
+        if upload['partial'].complete:
+            return finish_upload(conn, upload)
+        return upload
+    except Exception as e:
+        return fail_upload(conn, upload, e)
+
+def receive_upload_chunk(conn, upload, frame_type, payload):
+    """Writes one FILE_DATA / FILE_DATA_COMPRESSED frame; returns the upload state."""
+    if upload['received'] is None:
+        print(f"[WARNING] {conn} sent file data before picking a resume offset")
+        return upload
+    try:
+        chunk = transfer.unpack_file_data(frame_type, payload, upload['codec'], upload['partial'])
+        upload['partial'].write(chunk)
+        upload['wire_bytes'] += len(payload)
+        upload['received'] += len(chunk)
+        return upload
+    except Exception as e:
+        return fail_upload(conn, upload, e)
+
+def verify_upload_chunk(conn, upload, message):
+    """CMD:FILE_CHUNK_HASH:<index>:<hash> - checks the chunk just received; returns the upload state (None when done)."""
+    if upload['received'] is None:
+        print(f"[WARNING] {conn} sent a chunk hash before picking a resume offset")
+        return upload
+    try:
+        _, _, index, digest = message.split(':', 3)
+        upload['partial'].verify_chunk(int(index), digest)
+        if upload['partial'].complete:
+            return finish_upload(conn, upload)
+        return upload
+    except Exception as e:
+        return fail_upload(conn, upload, e)
+
+def finish_upload(conn, upload):
+    partial = upload['partial']
+    if transfer.content_hash(partial.hashes) != upload['content_id']:
+        partial.discard() # Every chunk checked out, but it is not the content that was announced
+        raise transfer.TransferError("Content hash doesn't match the one announced")
+    partial.finish() # Into the store, under its content hash
+    transfer.save_file_hashes(partial.path, HASH_CACHE_DIR, partial.hashes) # Downloads won't need to re-hash it
+    filename, filesize = upload['filename'], upload['filesize']
+    listed, added = file_index.add(filename, conn.nickname, filesize, upload['content_id'])
+    elapsed = time.monotonic() - upload['started']
+    received = filesize - upload['offset']
+    rate = transfer.describe_rate(received, upload['wire_bytes'], elapsed, upload['codec'])
+    print(f"[FILE UPLOAD] ✓ Received {filename} from {conn} successfully ({len(partial.hashes)} chunks verified, "
+          f"{received / (1024 * 1024):.1f} MB in {elapsed:.1f}s, {rate})" + (f", listed as {listed}." if listed != filename else "."))
+    conn.sendall(protocol.encode_text(f"CMD:FILE_UPLOAD_COMPLETE:{listed}"))
+    if added:
+        broadcast(protocol.encode_text(f"CMD:FILE_NEW_AVAILABLE:{conn.nickname}:{listed}:{filesize}"), conn.client)
+    return None
+
+def fail_upload(conn, upload, error):
+    print(f"[ERROR] File upload failed: {error}")
+    abort_upload(upload)
+    try:
+        conn.sendall(protocol.encode_text(f"[SERVER] Error uploading file: {error} (send it again to resume)"))
+    except OSError:
+        pass
+    return None
+
+def abort_upload(upload):
+    """Closes the partial file but keeps it (and its manifest) for a later resume."""
+    upload['partial'].close()
+    print(f"[FILE UPLOAD] ✗ Upload of {upload['filename']} stopped with "
+          f"{upload['partial'].verified_bytes}/{upload['filesize']} bytes verified.")
+
+# --- Downloads (resumable, pushed with sendfile() on the data connection) ---
+def parse_download_request(message):
+    """CMD:FILE_DOWNLOAD_REQUEST:<filename>[:<offset>:<hash>] -> (filename, offset, hash)"""
+    request = message.split(':', 2)[2]
+    pieces = request.rsplit(':', 2)
+    if len(pieces) == 3 and pieces[1].isdigit():
+        return os.path.basename(pieces[0]), int(pieces[1]), pieces[2]
+    return os.path.basename(request), 0, transfer.NO_HASH
+
+def prepare_download(nickname, filename, offset, last_hash):
+    """
+    Returns (filepath, filesize, offset, chunk hashes), or None if there is no
+    such file. The client's resume offset is only honoured if the hash of its
+    last chunk matches ours. May hash the whole file the first time.
+    """
+    entry = file_index.lookup(filename)
+    filepath = blob_path(entry[1]) if entry else None
+    if filepath is None or not os.path.isfile(filepath):
+        file_index.discard(filename)
+        return None
+    filesize = os.path.getsize(filepath)
+    hashes = transfer.cached_file_hashes(filepath, HASH_CACHE_DIR)
+    print(f"[FILE DOWNLOAD] {nickname} requesting {filename} ({filesize} bytes).")
+    if offset:
+        index = transfer.chunk_count(offset) - 1
+        if offset > filesize or (offset % transfer.CHUNK_SIZE and offset != filesize) or hashes[index] != last_hash:
+            print(f"[FILE DOWNLOAD] {nickname}'s partial copy of {filename} doesn't match, starting over.")
+            offset = 0
+        else:
+            print(f"[FILE DOWNLOAD] Resuming {filename} for {nickname} at byte {offset}.")
+    return filepath, filesize, offset, hashes
+
+def download_frames(filepath, filesize, offset, hashes):
+    """[GENERATOR] The FILE_DATA segments of each chunk from offset on, each followed by its hash."""
+    for index in range(offset // transfer.CHUNK_SIZE, transfer.chunk_count(filesize)):
+        start = index * transfer.CHUNK_SIZE
+        yield from file_segments(filepath, start, min(start + transfer.CHUNK_SIZE, filesize))
+        yield protocol.encode_text(f"CMD:FILE_CHUNK_HASH:{index}:{hashes[index]}")
+
+def serve_download(conn, filename, offset, last_hash):
+    """
+    Sends CMD:FILE_SEND_START:<filename>:<filesize>:<offset>:<codec>, then
+    the file from offset on: straight from the page cache with sendfile(),
+    or read and compressed frame by frame if the client takes a codec the
+    file is worth compressing with.
+    """
+    conn.busy = True # Hashing a large file for the first time can take a while
+    try:
+        download = prepare_download(conn.nickname, filename, offset, last_hash)
+    finally:
+        conn.busy = False
+        conn.progress()
+    if download is None:
+        conn.sendall(protocol.encode_text(f"[SERVER] Error: File '{filename}' not found."))
+        return
+    filepath, filesize, offset, hashes = download
+    codec = transfer.pick_codec(filepath, conn.client.codecs, filename)
+    started = time.monotonic()
+    wire_bytes = 0
+    conn.sendall(protocol.encode_text(f"CMD:FILE_SEND_START:{filename}:{filesize}:{offset}:{codec or transfer.NO_CODEC}"))
+    with open(filepath, 'rb') as f:
+        for data in download_frames(*download):
+            if not isinstance(data, FileSegment):
+                conn.sendall(data)
+            elif codec:
+                wire_bytes += send_compressed_segment(conn, f, data, codec)
+            else:
+                conn.sendall(data.header)
+                end = data.offset + data.length
+                for position in range(data.offset, end, SENDFILE_CHUNK_SIZE):
+                    protocol.send_file(conn.sock, f, position, min(SENDFILE_CHUNK_SIZE, end - position), conn.progress)
+                wire_bytes += data.length
+    elapsed = time.monotonic() - started
+    rate = transfer.describe_rate(filesize - offset, wire_bytes, elapsed, codec)
+    print(f"[FILE DOWNLOAD] ✓ Sent {filename} to {conn} ({(filesize - offset) / (1024 * 1024):.1f} MB in {elapsed:.1f}s, {rate}).")
+
+def send_compressed_segment(conn, f, segment, codec):
+    """Sends one segment as a FILE_DATA_COMPRESSED frame (plain FILE_DATA if it doesn't shrink); returns the payload size."""
+    f.seek(segment.offset)
+    data = f.read(segment.length)
+    if len(data) != segment.length:
+        raise OSError(f"File ended {segment.length - len(data)} bytes early")
+    conn.busy = True # Compressing a 4 MB chunk is not a stall
+    try:
+        frame_type, payload = transfer.pack_file_data(data, codec)
+    finally:
+        conn.busy = False
+        conn.progress()
+    protocol.send_buffers(conn.sock, (protocol.HEADER.pack(protocol.PROTOCOL_VERSION, frame_type, len(payload)), payload))
+    conn.progress()
+    return len(payload)
+
+# --- NEW: Screen frame relay (SCREEN = keyframe JPEG, SCREEN_DELTA = changed tiles) ---
+last_keyframe_request = 0.0
+
+def relay_screen_frame(client, nickname, frame_type, image_data):
+    """
+    Fans the frame out to every viewer's queue. image_data is either bytes or
+    a protocol.PooledBuffer the frame was received into; all viewers share it.
+    """
+    pooled = image_data if isinstance(image_data, protocol.PooledBuffer) else None
+    try:
+        with presenter_lock:
+            is_presenter = (current_presenter == client)
+
+        if is_presenter:
+            kind = 'screen_delta' if frame_type == protocol.FRAME_SCREEN_DELTA else 'screen'
+            frame = RelayFrame(frame_type, pooled.view if pooled else image_data, pooled)
+            broadcast(frame, client, kind=kind)
+            if kind == 'screen_delta':
+                request_keyframe_if_needed(client, nickname)
+        else:
+            print(f"[WARNING] {nickname} tried to send screen data but is not the presenter")
+    finally:
+        if pooled:
+            pooled.release() # The reader's reference; the queues hold their own
+
+def request_keyframe_if_needed(client, nickname):
+    """Asks the presenter for a keyframe when some viewer can't use deltas right now."""
+    global last_keyframe_request
+    if time.monotonic() - last_keyframe_request < KEYFRAME_REQUEST_MIN_INTERVAL:
+        return
+    waiting = [other.nickname for other in sessions.connected if other is not client and other.queue.needs_keyframe]
+    if waiting:
+        last_keyframe_request = time.monotonic()
+        print(f"[SCREEN] Asking {nickname} for a keyframe (needed by {', '.join(waiting)})")
+        client.sendall(protocol.encode_text("CMD:SCREEN_KEYFRAME_REQUEST"))
+
 # --- MODIFIED: handle_client Function ---
 def handle_client(client):
     """
     Handles Chat, Files, and Screen Sharing commands.
     """
-    global current_presenter
-    
     # 1. Nickname setup
     nickname = None
+    frames = protocol.read_frames(client.sock, screen_pool)
     try:
-        client.send('NICK'.encode('utf-8'))
-        nickname = client.recv(1024).decode('utf-8').strip()
-        
-        if nickname in nicknames:
-            client.send(f"ERROR:NICK_TAKEN:{nickname}\n".encode('utf-8'))
-            client.close()
+        client.sendall(protocol.encode_text('NICK'))
+        frame_type, payload = next(frames)
+        if frame_type != protocol.FRAME_TEXT:
+            raise protocol.ProtocolError("Expected nickname")
+        nickname = payload.decode('utf-8').strip()
+        if not admit_client(client, nickname):
             return
-        
-        if not nickname:
-            client.send("ERROR:NICK_EMPTY\n".encode('utf-8'))
-            client.close()
-            return
-        
-        nicknames.append(nickname)
-        clients.append(client)
-        
-        print(f"[CONNECT] {nickname} has joined.")
-        # --- FIX: Corrected utf-g to utf-8 ---
-        broadcast(f"[SERVER] {nickname} joined the chat!\n".encode('utf-8'), client)
-        client.send("[SERVER] Connected successfully.\n".encode('utf-8'))
-        
-        # Notify of existing files
-        for filename in os.listdir(SERVER_FILES_DIR):
-            filesize = os.path.getsize(os.path.join(SERVER_FILES_DIR, filename))
-            client.send(f"CMD:FILE_NEW_AVAILABLE:Server:{filename}:{filesize}\n".encode('utf-8'))
-
-        # Tell client the UDP port
-        client.send(f"CMD:AUDIO_PORT:{UDP_PORT}\n".encode('utf-8'))
 
     except Exception as e:
         print(f"[ERROR] Failed nickname setup: {e}")
-        if client in clients:
-            index = clients.index(client)
-            clients.remove(client)
-            if index < len(nicknames):
-                nicknames.pop(index)
+        sessions.remove(client)
         client.close()
         return
 
-    # 3. Listen for messages (Main TCP Loop)
-    while True:
-        try:
-            message_bytes = client.recv(1024)
-            if not message_bytes:
-                remove_client(client)
-                break
-                
-            message = message_bytes.decode('utf-8').strip()
-            
-            # --- A. FILE UPLOAD (Your working code) ---
-            if message.startswith('CMD:FILE_UPLOAD_START:'):
-                try:
-                    parts = message.split(':', 3)
-                    filename = os.path.basename(parts[2])
-                    filesize = int(parts[3])
-                    filepath = os.path.join(SERVER_FILES_DIR, filename)
-                    print(f"[FILE UPLOAD] {nickname} wants to upload {filename} ({filesize} bytes).")
-                    client.send(f"CMD:FILE_READY_TO_RECV:{filename}\n".encode('utf-8')) # Added \n
-                    bytes_received = 0
-                    with open(filepath, 'wb') as f:
-                        while bytes_received < filesize:
-                            remaining = filesize - bytes_received
-                            chunk_size = min(4096, remaining)
-                            chunk = client.recv(chunk_size)
-                            if not chunk: raise Exception("Client disconnected")
-                            f.write(chunk)
-                            bytes_received += len(chunk)
-                    print(f"[FILE UPLOAD] ✓ Received {filename} from {nickname} successfully.")
-                    broadcast(f"CMD:FILE_NEW_AVAILABLE:{nickname}:{filename}:{filesize}\n".encode('utf-8'), client)
-                except Exception as e:
-                    print(f"[ERROR] File upload failed: {e}")
-                    client.send(f"[SERVER] Error uploading file: {e}\n".encode('utf-8'))
+    # 3. Listen for frames (Main TCP Loop)
+    try:
+        for frame_type, payload in frames:
+            # --- A. FILES / PRESENTER / REPORT / CHAT (shared with the event-loop handler) ---
+            if frame_type == protocol.FRAME_TEXT:
+                process_message(client, nickname, payload.decode('utf-8').strip())
 
-            # --- B. FILE DOWNLOAD (Your working code) ---
-            elif message.startswith('CMD:FILE_DOWNLOAD_REQUEST:'):
+            # --- B. SCREEN DATA ---
+            elif frame_type in (protocol.FRAME_SCREEN, protocol.FRAME_SCREEN_DELTA):
+                relay_screen_frame(client, nickname, frame_type, payload)
+
+            elif frame_type in protocol.FILE_DATA_TYPES:
+                print(f"[WARNING] {nickname} sent file data on the control connection, ignoring it")
+
+    except Exception as e:
+        print(f"[ERROR] {e}")
+    finally:
+        remove_client(client)
+
+# --- NEW: Event-loop (asyncio) server mode ---
+class AsyncClient(ClientConnection):
+    """
+    Event-loop client: the StreamWriter is drained by its own writer task.
+    sendall() may be called from any thread (the UDP threads use it too).
+    """
+    def __init__(self, reader, writer, loop):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.wakeup = asyncio.Event()
+        super().__init__()
+        self.writer_task = loop.create_task(self.writer_loop())
+
+    def _call_in_loop(self, func):
+        if threading.get_ident() == self.loop_thread:
+            func()
+        else:
+            try: self.loop.call_soon_threadsafe(func)
+            except RuntimeError: pass # Loop already closed
+
+    def _wakeup_writer(self):
+        self._call_in_loop(self.wakeup.set)
+
+    async def writer_loop(self):
+        """[TASK] Sends queued frames in order until the queue is closed."""
+        try:
+            while True:
+                self.wakeup.clear()
+                data = self.queue.pop()
+                if data is None:
+                    if self.queue.closed:
+                        break
+                    await self.wakeup.wait()
+                    continue
+                # Event-loop frames are never pooled (payloads are plain bytes), so
+                # the transport may keep referencing them after drain() returns.
                 try:
-                    filename = os.path.basename(message.split(':', 2)[2])
-                    filepath = os.path.join(SERVER_FILES_DIR, filename)
-                    if os.path.exists(filepath):
-                        filesize = os.path.getsize(filepath)
-                        print(f"[FILE DOWNLOAD] {nickname} requesting {filename} ({filesize} bytes).")
-                        client.send(f"CMD:FILE_SEND_START:{filename}:{filesize}\n".encode('utf-8')) # Added \n
-                        with open(filepath, 'rb') as f:
-                            while (chunk := f.read(4096)):
-                                client.send(chunk)
-                        print(f"[FILE DOWNLOAD] ✓ Sent {filename} to {nickname} successfully.")
+                    if isinstance(data, RelayFrame):
+                        self.writer.writelines(data.buffers())
                     else:
-                        client.send(f"[SERVER] Error: File '{filename}' not found.\n".encode('utf-8'))
-                except Exception as e:
-                    print(f"[ERROR] File download failed: {e}")
-
-            # --- C. PRESENTER REQUEST (Your working code) ---
-            elif message == 'CMD:PRESENTER_REQUEST':
-                with presenter_lock:
-                    if current_presenter is None:
-                        current_presenter = client
-                        presenter_nick = nicknames[clients.index(client)]
-                        print(f"[PRESENTER] {presenter_nick} is now presenting.")
-                        broadcast_all(f"CMD:PRESENTER_SET:{presenter_nick}\n".encode('utf-8'))
-                        print(f"[PRESENTER] Broadcast presenter set message to all clients")
-                    else:
-                        existing_presenter = nicknames[clients.index(current_presenter)]
-                        print(f"[PRESENTER] {nickname} denied - {existing_presenter} is already presenting")
-                        client.send("[SERVER] Cannot start presenting, another user is active.\n".encode('utf-8'))
-
-            # --- D. PRESENTER STOP (Your working code) ---
-            elif message == 'CMD:PRESENTER_STOP':
-                with presenter_lock:
-                    if current_presenter == client:
-                        current_presenter = None
-                        print(f"[PRESENTER] {nickname} stopped presenting.")
-                        broadcast_all("CMD:PRESENTER_SET:NONE\n".encode('utf-8'))
-            
-            # --- E. SCREEN DATA (Your working code) ---
-            elif message.startswith('CMD:SCREEN_DATA:'):
-                is_presenter = False
-                with presenter_lock:
-                    is_presenter = (current_presenter == client)
-                
-                if is_presenter:
-                    try:
-                        filesize = int(message.split(':', 2)[2])
-                        print(f"[SCREEN] Receiving {filesize} bytes from {nickname}")
-                        image_data = b''
-                        bytes_received = 0
-                        client.settimeout(5.0)  # 5 second timeout for screen data
-                        
-                        while bytes_received < filesize:
-                            remaining = filesize - bytes_received
-                            chunk_size = min(8192, remaining)  # Larger chunks
-                            chunk = client.recv(chunk_size)
-                            if not chunk: 
-                                raise Exception(f"Presenter disconnected (received {bytes_received}/{filesize} bytes)")
-                            image_data += chunk
-                            bytes_received += len(chunk)
-                        
-                        print(f"[SCREEN] Received complete frame ({bytes_received} bytes), broadcasting...")
-                        client.settimeout(None)  # Reset to blocking
-                        broadcast(message_bytes, client) # Send header
-                        broadcast(image_data, client)     # Send data
-                        print(f"[SCREEN] Frame broadcast complete")
-                    except socket.timeout:
-                        print(f"[ERROR] Screen data timeout from {nickname} (received {bytes_received}/{filesize} bytes)")
-                        client.settimeout(None)
-                    except Exception as e:
-                        print(f"[ERROR] Screen data relay failed from {nickname}: {e}")
-                        client.settimeout(None)
-                        with presenter_lock:
-                            if current_presenter == client:
-                                current_presenter = None
-                                broadcast_all("CMD:PRESENTER_SET:NONE\n".encode('utf-8'))
+                        self.writer.write(data)
+                    await self.writer.drain()
+                finally:
+                    self.queue.task_done(data)
+        except (ConnectionError, OSError):
+            self.queue.close(flush=False)
+        finally:
+            self.writer.close()
+
+    def abort(self):
+        super().abort()
+        self._call_in_loop(self.writer.transport.abort)
+
+async def handle_client_async(reader, writer):
+    """
+    [COROUTINE] Event-loop version of handle_client. Handles nickname setup,
+    chat, files and screen relay without blocking the loop on any one peer.
+    """
+    loop = asyncio.get_running_loop()
+    client = AsyncClient(reader, writer, loop)
+    address = writer.get_extra_info('peername')
+    print(f"[NEW CONNECTION] {address[0]}:{address[1]} connected.")
+
+    # 1. Nickname setup
+    nickname = None
+    frames = protocol.read_frames_async(reader)
+    try:
+        client.sendall(protocol.encode_text('NICK'))
+        frame_type, payload = await anext(frames)
+        if frame_type != protocol.FRAME_TEXT:
+            raise protocol.ProtocolError("Expected nickname")
+        nickname = payload.decode('utf-8').strip()
+        if not admit_client(client, nickname):
+            return
+    except Exception as e:
+        print(f"[ERROR] Failed nickname setup: {e}")
+        sessions.remove(client)
+        client.close()
+        return
+
+    # 2. Listen for frames (Main TCP Loop)
+    try:
+        async for frame_type, payload in frames:
+            # --- A. FILES / PRESENTER / REPORT / CHAT ---
+            if frame_type == protocol.FRAME_TEXT:
+                message = payload.decode('utf-8').strip()
+                if message.startswith('CMD:FILE_UPLOAD_START:'):
+                    # Stats the blob store and may rewrite the file index: not on the loop,
+                    # which would stall every client; awaited, so this client's order holds
+                    await loop.run_in_executor(None, process_message, client, nickname, message)
                 else:
-                    print(f"[WARNING] {nickname} tried to send screen data but is not the presenter")
-            
-            # --- NEW: REPORT USER ---
-            elif message.startswith('CMD:REPORT_USER:'):
-                try:
-                    reported_nickname = message.split(':', 2)[2]
-                    # Simple logging for now. In a real app, write to a file.
-                    print(f"--- [REPORT LOG] ---\n  Reporter: {nickname}\n  Reported: {reported_nickname}\n  Timestamp: {time.ctime()}\n  --------------------")
-                    
-                    # Optional: Notify the reporter their action was logged
-                    client.send(f"[SERVER] Report for {reported_nickname} has been logged.\n".encode('utf-8'))
-                except Exception as e:
-                    print(f"[ERROR] Failed to parse report command: {message} - {e}")
-                    
-            # --- F. CHAT MESSAGE ---
-            else:
-                message_to_broadcast = f"[{nickname}] {message}\n".encode('utf-8')
-                print(f"[MESSAGE] {message_to_broadcast.decode('utf-8').strip()}")
-                broadcast_all(message_to_broadcast)
-            
-        except Exception as e:
-            print(f"[ERROR] {e}")
-            remove_client(client)
-            break
+                    process_message(client, nickname, message)
+
+            # --- B. SCREEN DATA ---
+            elif frame_type in (protocol.FRAME_SCREEN, protocol.FRAME_SCREEN_DELTA):
+                relay_screen_frame(client, nickname, frame_type, payload)
+
+            elif frame_type in protocol.FILE_DATA_TYPES:
+                print(f"[WARNING] {nickname} sent file data on the control connection, ignoring it")
+
+    except Exception as e:
+        print(f"[ERROR] {e}")
+    finally:
+        remove_client(client)
+
+async def shutdown_async_server(server):
+    global server_running
+    server_running = False
+    print("\n[SHUTTING DOWN] Server is closing...")
+    for client in sessions.connected:
+        try:
+            client.sendall(protocol.encode_text("[SERVER] Server is shutting down."))
+            client.close()
+        except: pass
+    with transfer_lock:
+        for conn in active_transfers:
+            conn.abort()
+    server.close()
+
+    # Let the transports flush the goodbye message
+    await asyncio.sleep(0.5)
+    print("[SHUTDOWN COMPLETE] Server has stopped.")
+
+async def serve_async():
+    server = await asyncio.start_server(handle_client_async, HOST, PORT, reuse_address=True)
+    print(f"[LISTENING] TCP Server (event loop) is listening on {HOST}:{PORT}")
+    print("[INFO] Press Ctrl+C to stop the server")
+    try:
+        await server.serve_forever()
+    except asyncio.CancelledError:
+        # asyncio.run() cancels us on Ctrl+C
+        await shutdown_async_server(server)
 
-# --- MODIFIED: Audio/Video Receiver Thread ---
+def start_async_server():
+    """
+    Same as start_server, but all TCP clients are served by one event loop
+    thread instead of one thread per client.
+    """
+    global server_running
+
+    # Start Audio/Video Threads (UDP paths are the same in both modes)
+    threading.Thread(target=audio_server_thread, daemon=True).start()
+    threading.Thread(target=video_server_thread, daemon=True).start()
+    if AUDIO_MODE == "mix": # The SFU has nothing to mix
+        threading.Thread(target=audio_broadcast_thread, daemon=True).start()
+    threading.Thread(target=outbound_monitor_thread, daemon=True).start()
+    threading.Thread(target=data_server_thread, daemon=True).start()
+
+    try:
+        asyncio.run(serve_async())
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(f"[ERROR] Failed to start server: {e}")
+    finally:
+        server_running = False
+
+# --- MODIFIED: Audio Receiver Thread ---
 def audio_server_thread():
     """
-    [THREAD] Listens for UDP packets, DECODES audio, relays video.
+    [THREAD] Listens for audio UDP packets and DECODES them (or forwards
+    them, in SFU mode). Video has its own socket and thread.
     """
-    global audio_clients, latest_audio_chunks, audio_decoders # Add decoders
-    
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_socket.bind((HOST, UDP_PORT))
-    print(f"[AV] UDP Audio/Video server listening on {HOST}:{UDP_PORT}")
+    udp_socket = protocol.open_udp_socket(AUDIO_SOCKET_BUFFER, AUDIO_SOCKET_BUFFER, (HOST, UDP_PORT))
+    print(f"[AV] UDP Audio server listening on {HOST}:{UDP_PORT} ({protocol.socket_buffers(udp_socket)})")
+    if AUDIO_MODE == "sfu":
+        print(f"[AUDIO] SFU mode: forwarding the {SFU_MAX_SPEAKERS} loudest speakers, clients mix")
+    sfu_stats = {'forwarded': 0, 'held back': 0, 'sent': 0}
+    last_stats = time.monotonic()
 
     while server_running:
         try:
-            data, addr = udp_socket.recvfrom(65536) # Large buffer for video
+            data, addr = udp_socket.recvfrom(65536)
             
             # 1. Check for HELLO packet (Handshake)
             if data.startswith(b'HELLO:'):
                 try:
                     nickname = data.decode('utf-8').split(':', 1)[1]
-                    with audio_lock:
-                        audio_clients[nickname] = addr
-                        # --- NEW: Initialize decoder for this client ---
-                        if OPUS_AVAILABLE and addr not in audio_decoders:
-                            try:
-                                audio_decoders[addr] = opuslib.Decoder(RATE, CHANNELS)
-                            except Exception as e:
-                                print(f"[AUDIO] Failed to create Opus decoder for {nickname}: {e}")
-                        # --- End ---
-                        
-                        # Find the TCP client for this user
-                        tcp_client = clients[nicknames.index(nickname)]
-                        
-                        # --- NEW: Tell new user about existing users ---
-                        for nick in audio_clients.keys():
-                            if nick != nickname:
-                                # Send via reliable TCP
-                                tcp_client.send(f"CMD:USER_JOINED:{nick}\n".encode('utf-8'))
-                        
-                        # --- NEW: Tell all *other* users about new user ---
-                        # Send via reliable TCP
-                        broadcast(f"CMD:USER_JOINED:{nickname}\n".encode('utf-8'), tcp_client)
+                    session = sessions.register_udp(nickname, addr)
+                    if session is None:
+                        raise ValueError(f"{nickname} has not joined")
+                    mixer.remove(nickname) # A (re)started client numbers its frames from 0
+                    # --- NEW: Fresh decoder for this client's stream (the SFU never decodes) ---
+                    if OPUS_AVAILABLE and AUDIO_MODE == "mix":
+                        try:
+                            session.decoder = opuslib.Decoder(RATE, CHANNELS)
+                        except Exception as e:
+                            print(f"[AUDIO] Failed to create Opus decoder for {nickname}: {e}")
+                    # --- End ---
+
+                    # --- NEW: Tell new user about existing users ---
+                    for other in sessions.audio_sessions:
+                        if other is not session:
+                            # Send via reliable TCP
+                            session.client.sendall(protocol.encode_text(f"CMD:USER_JOINED:{other.nickname}"))
+                    
+                    # --- NEW: Tell all *other* users about new user ---
+                    # Send via reliable TCP
+                    broadcast(protocol.encode_text(f"CMD:USER_JOINED:{nickname}"), session.client)
 
                     print(f"[AV] Registered {nickname} from {addr}")
                 except Exception as e:
                     print(f"[AV] Failed HELLO packet from {addr}: {e}")
                 continue
             
-            # Find sender's nickname (if registered)
-            sender_nick = None
-            with audio_lock:
-                for nick, a in audio_clients.items():
-                    if a == addr:
-                        sender_nick = nick
-                        break
+            # Find the sender (if registered): one dict lookup
+            session = sessions.at(addr)
+            sender_nick = session.nickname if session else None
             
             if not sender_nick:
                 # print(f"[UDP] Unregistered packet from {addr}. Ignoring.")
                 continue # Ignore packets from unknown sources
 
-            # 2. Check for Video Packet
-            if data.startswith(b'VID:'):
-                # Relay this packet to all *other* clients
-                # We add the sender's nickname so receivers know who's video it is
-                video_packet = f"VID:{sender_nick}:".encode('utf-8') + data[4:]
-                broadcast_udp(video_packet, addr, udp_socket)
-
-            # 3. Check for Audio Packet (Decode it!)
-            elif data.startswith(b'AUD:'):
-                encoded_data = data[4:]
+            # 2. Check for Audio Packet (Decode it into the sender's jitter buffer)
+            if data.startswith(b'AUD:'):
+                packet = audio_mixer.unpack_audio(data)
+                if packet is None:
+                    continue
+                seq, level, opus, encoded_data = packet
+                if AUDIO_MODE == "sfu":
+                    forward_audio(udp_socket, sender_nick, data, level, opus, sfu_stats)
+                    if time.monotonic() - last_stats >= AUDIO_STATS_INTERVAL:
+                        last_stats = time.monotonic()
+                        report_sfu_stats(sfu_stats)
+                    continue
+                decoded_data = encoded_data
                 
-                # Try Opus decoding if available
-                if OPUS_AVAILABLE:
-                    decoder = audio_decoders.get(addr)
+                # Decode Opus frames (the flags byte says which they are)
+                if opus:
+                    decoder = session.decoder
                     if decoder:
                         try:
                             # Decode the received Opus data into raw PCM bytes
                             decoded_data = decoder.decode(encoded_data, CHUNK)
-                            with audio_lock:
-                                # Store the *decoded* raw data for mixing
-                                latest_audio_chunks[addr] = decoded_data
-                        except Exception as e:
-                            # Opus decode failed, treat as raw audio
-                            # print(f"[AUDIO] Opus decode error from {addr}, using raw: {e}")
-                            with audio_lock:
-                                latest_audio_chunks[addr] = encoded_data
-                    else:
-                        # No decoder, treat as raw
-                        with audio_lock:
-                            latest_audio_chunks[addr] = encoded_data
-                else:
-                    # Opus not available, treat as raw audio
-                    with audio_lock:
-                        latest_audio_chunks[addr] = encoded_data
+                        except Exception:
+                            # A corrupt frame is lost; the jitter buffer conceals it
+                            continue
+                mixer.push(sender_nick, seq, decoded_data)
 
         except Exception as e:
             if server_running:
                 print(f"[AV] UDP server error: {e}")
 
     # Clean shutdown
-    with audio_lock:
-        audio_decoders.clear()
     try:
         udp_socket.close()
     except:
         pass
     print("[AV] UDP server shut down.")
 
-# --- (Audio Mixing & Broadcast Thread is identical to your Step 4) ---
-def audio_broadcast_thread():
+# --- NEW: Video Receiver Thread ---
+def video_server_thread():
     """
-    [THREAD] Mixes raw audio chunks and broadcasts raw audio periodically.
-    Adds nickname header.
+    [THREAD] Listens for video UDP packets on VIDEO_PORT, reassembles each
+    sender's frames from their fragments and relays the complete ones to
+    every other client's video socket. Its own socket, so a burst of JPEG
+    frames never sits in front of audio packets.
     """
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    
+    video_socket = protocol.open_udp_socket(VIDEO_SOCKET_BUFFER, VIDEO_SOCKET_BUFFER, (HOST, VIDEO_PORT))
+    print(f"[AV] UDP Video server listening on {HOST}:{VIDEO_PORT} ({protocol.socket_buffers(video_socket)})")
+    relayed = {'frames': 0, 'bytes': 0}
+    last_stats = last_feedback = time.monotonic()
+
     while server_running:
         try:
-            time.sleep(0.01) # ~20ms chunk interval, mix just before next
-            
-            with audio_lock:
-                if not latest_audio_chunks:
-                    continue # No audio to mix
-                
-                # Chunks are now raw PCM bytes
-                chunks_with_addr = list(latest_audio_chunks.items())
-                targets = list(audio_clients.items()) # Get (nick, addr) pairs
-                latest_audio_chunks.clear()
+            data, addr = video_socket.recvfrom(65536) # Large buffer for video
 
-            if not chunks_with_addr:
+            # 1. HELLO:<nickname> from the client's video socket
+            if data.startswith(b'HELLO:'):
+                nickname = data.decode('utf-8').split(':', 1)[1]
+                if sessions.register_udp(nickname, addr, video=True) is None:
+                    print(f"[VIDEO] Failed HELLO packet from {addr}: {nickname} has not joined")
+                else:
+                    print(f"[VIDEO] Registered {nickname} from {addr}")
                 continue
 
-            # --- Audio Mixing (Works on raw PCM bytes) ---
-            decoded_chunks = []
-            chunk_senders = [] # Store nickname corresponding to each chunk
-
-            with audio_lock: # Need lock to map addr back to nickname safely
-                for addr, chunk in chunks_with_addr:
-                    if len(chunk) == CHUNK * CHANNELS * 2: # Check raw size (2 bytes per sample)
-                        decoded_chunks.append(np.frombuffer(chunk, dtype=np.int16))
-                        # Find nickname for this addr
-                        sender_nick = "Unknown"
-                        for nick, a in audio_clients.items():
-                            if a == addr:
-                                sender_nick = nick
-                                break
-                        chunk_senders.append(sender_nick)
-
-            if not decoded_chunks:
-                continue
-                
-            # Mix using numpy (same logic as before)
-            mixed_chunk_np = np.zeros(CHUNK * CHANNELS, dtype=np.float32)
-            for chunk_np in decoded_chunks:
-                mixed_chunk_np += chunk_np.astype(np.float32)
-            
-            mixed_chunk_np /= len(decoded_chunks)
-            mixed_chunk_np = np.clip(mixed_chunk_np, -32768, 32767)
-            mixed_data = mixed_chunk_np.astype(np.int16).tobytes()
-
-            # --- Broadcast ---
-            # Send raw mixed data prefixed by "AUD:<sender_nickname>:"
-            # Note: This sends a mix containing potentially multiple people's audio,
-            # but we'll just label it with the *first* sender in this batch for simplicity.
-            # A more complex approach would be needed for perfect speaker attribution.
-            if chunk_senders:
-                header = f"AUD:{chunk_senders[0]}:".encode('utf-8')
-                packet_to_send = header + mixed_data
-
-                for nick, addr in targets:
-                    udp_socket.sendto(packet_to_send, addr)
+            session = sessions.at_video(addr)
+            if session is None:
+                continue # Ignore packets from unknown sources
+
+            # 2. A fragment (VID:<frame id><index><count><jpeg bytes>): once
+            # its frame is complete, relay it to all *other* clients, with
+            # the sender's nickname so receivers know whose video it is
+            if data.startswith(b'VID:'):
+                fragment = video_packets.unpack(data)
+                if fragment is None:
+                    continue
+                now = time.monotonic()
+                frame = video_frames.add(session.nickname, *fragment, now)
+                if frame is not None:
+                    prefix = f"VID:{session.nickname}:".encode('utf-8')
+                    broadcast_udp(video_packets.packetize(fragment[0], frame, prefix), addr, video_socket)
+                    relayed['frames'] += 1
+                    relayed['bytes'] += len(frame)
+                if now - last_feedback >= video_packets.FEEDBACK_INTERVAL:
+                    last_feedback = now
+                    send_uplink_feedback()
+                if now - last_stats >= VIDEO_STATS_INTERVAL:
+                    last_stats = now
+                    report_video_stats(relayed)
+
+        except Exception as e:
+            if server_running:
+                print(f"[VIDEO] UDP server error: {e}")
+
+    try:
+        video_socket.close()
+    except:
+        pass
+    print("[VIDEO] UDP server shut down.")
+
+def send_uplink_feedback():
+    """
+    Tells each sender how their frames fared on the way in, as a
+    CMD:VIDEO_FEEDBACK with an empty viewer name. We relay each frame in
+    one burst, so a frame that was slow to reach us is only late here.
+    """
+    for sender, (frames, lost, late) in video_frames.take_feedback().items():
+        session = sessions.by_nick.get(sender)
+        if session is not None:
+            try:
+                session.client.sendall(protocol.encode_text(
+                    f"CMD:VIDEO_FEEDBACK:{video_packets.UPLINK}:{frames}:{lost}:{late}:0.0"))
+            except Exception:
+                remove_client(session.client)
+
+def report_video_stats(relayed):
+    """Logs the frames relayed and lost to reassembly since the last report, then resets the counters."""
+    stats = video_frames.take_stats()
+    if relayed['frames'] or stats['incomplete']:
+        print(f"[VIDEO] Relayed {relayed['frames']} frames ({relayed['bytes'] / 1024:.0f} KB), "
+              f"dropped {stats['incomplete']} incomplete frames and {stats['stale']} stale fragments")
+    relayed['frames'] = relayed['bytes'] = 0
+
+# --- NEW: Selective forwarding (AUDIO_MODE = "sfu") ---
+def forward_audio(udp_socket, sender_nick, data, level, opus, sfu_stats):
+    """
+    Relays one AUD: datagram untouched as AUS:<sender>:<seq><flags><payload>
+    to every other listener, if the sender is one of the loudest speakers.
+    Opus packets skip listeners that can only play PCM.
+    """
+    if not speakers.forward(sender_nick, level, time.monotonic()):
+        sfu_stats['held back'] += 1
+        return
+    packet = f"AUS:{sender_nick}:".encode('utf-8') + data[4:]
+    targets = [session.udp_addr for session in sessions.audio_sessions
+               if session.nickname != sender_nick and (not opus or session.audio_format == 'opus')]
+    for addr in targets:
+        udp_socket.sendto(packet, addr)
+    sfu_stats['forwarded'] += 1
+    sfu_stats['sent'] += len(packet) * len(targets)
+
+def report_sfu_stats(sfu_stats):
+    """Logs what the SFU forwarded since the last report, then resets the counters."""
+    print(f"[AUDIO] SFU forwarded {sfu_stats['forwarded']} packets ({sfu_stats['sent'] / 1024:.0f} KB out), "
+          f"held back {sfu_stats['held back']} from quieter senders; speaking: {', '.join(speakers.speaking()) or 'nobody'}")
+    for name in sfu_stats:
+        sfu_stats[name] = 0
+
+# --- MODIFIED: Clock-driven Audio Mixing & Broadcast Thread ---
+def audio_broadcast_thread():
+    """
+    [THREAD] Ticks once per AUDIO_FRAME_DURATION on the monotonic clock,
+    takes one frame from every sender's jitter buffer and sends each
+    listener the mix of the loudest speakers but themselves, Opus-encoded
+    for clients that asked for it. Adds nickname header, and tells every
+    client who is speaking (CMD:SPEAKERS) when that changes.
+    """
+    udp_socket = protocol.open_udp_socket(AUDIO_SOCKET_BUFFER, AUDIO_SOCKET_BUFFER)
+    active_speakers = audio_mixer.ActiveSpeakers()
+    next_tick = time.monotonic()
+    last_stats = next_tick
+    late_ticks = 0
+    mix_seq = 0 # Numbers the mixes by tick, for the clients' playout buffers
+    egress = {'sent': 0, 'raw': 0} # Mix payload bytes sent, and what they would have been as PCM
+
+    while server_running:
+        try:
+            # Sleep until the next frame boundary; sleep() overshoots are made
+            # up on the following ticks instead of adding up
+            next_tick += AUDIO_FRAME_DURATION
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -4 * AUDIO_FRAME_DURATION:
+                late_ticks += 1 # Stalled for several frames: skip them rather than burst
+                next_tick = time.monotonic()
+
+            if time.monotonic() - last_stats >= AUDIO_STATS_INTERVAL:
+                last_stats = time.monotonic()
+                report_audio_stats(late_ticks, egress)
+                late_ticks = 0
+                egress = dict.fromkeys(egress, 0)
+
+            mix = mixer.tick()
+            mix_seq += 1
+            speaking = active_speakers.update(mix.senders if mix else (), time.monotonic())
+            if speaking is not None:
+                broadcast_all(protocol.encode_text(f"CMD:SPEAKERS:{','.join(speaking)}"))
+            if mix is None:
+                continue # Nobody is talking
+
+            targets = [(session.nickname, session.udp_addr, session.audio_format == 'opus')
+                       for session in sessions.audio_sessions]
+
+            # --- Send each listener their mix-minus ---
+            # Mixed data prefixed by "AUD:<sender_nickname>:" (raw PCM) or "AUO:<sender_nickname>:" (Opus),
+            # then the tick's sequence number and flags, as clients send theirs
+            # Note: a mix can hold several people's audio, but it is labelled
+            # with the loudest other speaker (CMD:SPEAKERS has all of them).
+            everyone_packets = {} # Shared by every listener who isn't talking, per format
+            for nick, addr, opus in targets:
+                if nick not in mix.rows:
+                    packet = everyone_packets.get(opus)
+                    if packet is None:
+                        packet = everyone_packets[opus] = mix_packet(mix.senders[0], mix_seq, mix.everyone, opus, mix_encoders.EVERYONE)
+                else:
+                    mixed_data = mix.for_listener(nick)
+                    if mixed_data is None:
+                        continue # Nothing to send to a lone talker
+                    packet = mix_packet(mix.label_for(nick), mix_seq, mixed_data, opus, nick)
+                udp_socket.sendto(packet, addr)
+                egress['sent'] += len(packet) - packet.index(b':', 4) - 1 - audio_mixer.HEADER.size # Minus the AUx:<label>:<seq><flags> header
+                egress['raw'] += len(mix.everyone)
                 
         except Exception as e:
             if server_running:
@@ -484,16 +1825,42 @@ def audio_broadcast_thread():
         pass
     print("[AUDIO] Broadcast thread shut down.")
 
+def mix_packet(label, seq, pcm, opus, encoder_key):
+    """
+    AUO:<label>:<seq><flags><Opus packet> for Opus listeners (the AUD: form
+    if encoding fails), else AUD:<label>:<seq><flags><pcm>.
+    """
+    if opus:
+        try:
+            return audio_mixer.pack_audio(seq, mix_encoders.encode(encoder_key, pcm), opus=True,
+                                          prefix=f"AUO:{label}:".encode('utf-8'))
+        except Exception as e:
+            print(f"[AUDIO] Opus encode failed, sending raw PCM: {e}")
+    return audio_mixer.pack_audio(seq, pcm, prefix=f"AUD:{label}:".encode('utf-8'))
+
+def report_audio_stats(late_ticks, egress):
+    """Logs each sender's jitter buffer counters and the mix bandwidth since the last report."""
+    for sender, counts in mixer.take_stats().items():
+        print(f"[AUDIO] {sender}: " + ", ".join(f"{count} {name}" for name, count in counts.items()))
+    if late_ticks:
+        print(f"[AUDIO] Mixer fell behind the clock {late_ticks} times")
+    if egress['sent']:
+        saving = f", {egress['raw'] / egress['sent']:.1f}x smaller than raw PCM" if egress['sent'] < egress['raw'] else ""
+        print(f"[AUDIO] Sent {egress['sent'] / 1024:.0f} KB of mixed audio since the last report{saving}")
+
 # --- (shutdown_server is identical to your Step 4) ---
 def shutdown_server(server):
     global server_running
     server_running = False
     print("\n[SHUTTING DOWN] Server is closing...")
-    for client in clients[:]: 
+    for client in sessions.connected: 
         try:
-            client.send("[SERVER] Server is shutting down.\n".encode('utf-8'))
+            client.sendall(protocol.encode_text("[SERVER] Server is shutting down."))
             client.close()
         except: pass
+    with transfer_lock:
+        for conn in active_transfers:
+            conn.abort()
     try:
         server.close()
     except: pass
@@ -511,8 +1878,12 @@ def start_server():
     
     # Start Audio/Video Threads
     threading.Thread(target=audio_server_thread, daemon=True).start()
+    threading.Thread(target=video_server_thread, daemon=True).start()
     # --- FIX: Corrected typo from auto_ to audio_ ---
-    threading.Thread(target=audio_broadcast_thread, daemon=True).start()
+    if AUDIO_MODE == "mix": # The SFU has nothing to mix
+        threading.Thread(target=audio_broadcast_thread, daemon=True).start()
+    threading.Thread(target=outbound_monitor_thread, daemon=True).start()
+    threading.Thread(target=data_server_thread, daemon=True).start()
 
     # (The rest of the function is identical to your code)
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -526,11 +1897,12 @@ def start_server():
         
         while server_running:
             try:
-                client, address = server.accept()
+                sock, address = server.accept()
                 if not server_running:
-                    client.close()
+                    sock.close()
                     break
                 print(f"[NEW CONNECTION] {address[0]}:{address[1]} connected.")
+                client = ThreadedClient(sock)
                 thread = threading.Thread(target=handle_client, args=(client,))
                 thread.daemon = True 
                 thread.start()
@@ -550,8 +1922,18 @@ def start_server():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LAN Collaboration Tool server")
+    parser.add_argument("--mode", choices=["threaded", "async"], default=SERVER_MODE,
+                        help="threaded = one thread per client, async = single event loop")
+    parser.add_argument("--audio", choices=["mix", "sfu"], default=AUDIO_MODE,
+                        help="mix = server mixes audio for everyone, sfu = server forwards the loudest speakers and clients mix")
+    args = parser.parse_args()
+    AUDIO_MODE = args.audio
     try:
-        start_server()
+        if args.mode == "async":
+            start_async_server()
+        else:
+            start_server()
     except KeyboardInterrupt:
         print("\n[INTERRUPTED] Server stopped by user.")
     except Exception as e:
@@ -0,0 +1,372 @@
+# transfer.py
+"""
+Resumable, verified file transfers (shared by server.py and client.py).
+
+Files travel in CHUNK_SIZE chunks. After the last FILE_DATA frame of each
+chunk the sender sends
+
+    CMD:FILE_CHUNK_HASH:<chunk index>:<sha256 hex>
+
+and the receiver checks the chunk it just wrote. Incoming data goes to
+<name>.part with an append-only manifest, <name>.part.manifest:
+
+    {"name": ..., "size": ..., "chunk_size": ...}     <- first line
+    <sha256 of chunk 0>
+    <sha256 of chunk 1>
+    ...
+
+Only verified chunks are listed, so after a disconnect the transfer resumes
+from the first unverified byte instead of byte zero. Before resuming, the
+sender checks the hash of the last verified chunk against its own copy of
+the file, so a partial file never gets completed with different content.
+
+FILE_DATA frames never straddle a chunk (upload and download frame sizes
+divide CHUNK_SIZE).
+
+A whole file is identified by its content hash: the SHA-256 of its chunk
+digests (the raw 32-byte digests, concatenated). The server stores files
+under that hash, and an uploader announces it up front so content the
+server already has is never sent twice.
+
+File data can be compressed on the wire. Both sides list the codecs they
+have when the client joins (CMD:CAPS:compress=zstd,zlib,lzma;...); the sender
+of each file picks one of the shared codecs, or none for media and
+archives that won't shrink (see pick_codec), and names it when the
+transfer starts. Each FILE_DATA frame is then compressed on its own and
+sent as FILE_DATA_COMPRESSED, or left as plain FILE_DATA when compressing
+didn't make it smaller. Chunk hashes are always over the original bytes.
+"""
+import hashlib
+import json
+import lzma
+import os
+import zlib
+
+import protocol
+
+try:
+    import zstandard # Optional, the fastest of the three
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+CHUNK_SIZE = 4 * 1024 * 1024
+HASH_NAME = 'sha256'
+NO_HASH = '-' # "Nothing verified yet" in resume messages
+NO_CODEC = '-' # "Uncompressed" in FILE_SEND_START / FILE_UPLOAD_RESUME
+READ_SIZE = 1024 * 1024
+
+
+class TransferError(Exception):
+    """A chunk failed verification or the peer broke the transfer protocol."""
+
+
+# --- Compression ---
+COMPRESSION_PREFERENCE = ('zstd', 'zlib', 'lzma') # Best first: fast enough to beat the network, then ratio
+COMPRESSION_SAMPLE_SIZE = 128 * 1024 # Bytes of a file test-compressed by pick_codec
+COMPRESSION_MIN_SAVING = 0.10 # Files that don't shrink by this much are sent as they are
+COMPRESSION_MIN_FILE_SIZE = 16 * 1024
+# Already compressed formats, not worth a sample
+INCOMPRESSIBLE_EXTENSIONS = {
+    '.7z', '.aac', '.apk', '.avi', '.bz2', '.docx', '.flac', '.gif', '.gz', '.heic', '.jar', '.jpeg', '.jpg',
+    '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.ogg', '.opus', '.png', '.pptx', '.rar', '.tgz', '.webm', '.webp',
+    '.xlsx', '.xz', '.zip', '.zst',
+}
+
+
+class Codec:
+    """One-shot compress/decompress of a FILE_DATA frame payload."""
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self._decompress = decompress
+
+    def decompress(self, data, max_size):
+        """Decompresses one frame, refusing to produce more than max_size bytes."""
+        try:
+            raw = self._decompress(data, max_size)
+        except (zlib.error, lzma.LZMAError, ValueError) as e:
+            raise TransferError(f"Corrupt {self.name} frame: {e}")
+        if len(raw) > max_size:
+            raise TransferError(f"{self.name} frame inflates past the current chunk")
+        return raw
+
+
+def _zlib_decompress(data, max_size):
+    d = zlib.decompressobj()
+    raw = d.decompress(data, max_size + 1)
+    if not d.eof:
+        raise ValueError("truncated stream or trailing data")
+    return raw
+
+
+def _lzma_decompress(data, max_size):
+    d = lzma.LZMADecompressor()
+    raw = d.decompress(data, max_size + 1)
+    if not d.eof:
+        raise ValueError("truncated stream or trailing data")
+    return raw
+
+
+def _zstd_decompress(data, max_size):
+    if zstandard.frame_content_size(data) > max_size:
+        raise ValueError("frame header announces too much data")
+    return zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size + 1)
+
+
+CODECS = {
+    'zlib': Codec('zlib', lambda data: zlib.compress(data, 1), _zlib_decompress),
+    'lzma': Codec('lzma', lambda data: lzma.compress(data, preset=0), _lzma_decompress),
+}
+if ZSTD_AVAILABLE:
+    CODECS['zstd'] = Codec('zstd', lambda data: zstandard.ZstdCompressor(level=3).compress(data), _zstd_decompress)
+
+
+def capabilities(codecs=None):
+    """The payload of CMD:CAPS: the codecs we can use, best first."""
+    names = codecs if codecs is not None else [name for name in COMPRESSION_PREFERENCE if name in CODECS]
+    return 'compress=' + ','.join(names)
+
+
+def parse_capabilities(payload):
+    """CMD:CAPS payload -> codecs we share with the peer, in our order of preference."""
+    offered = set(protocol.parse_capabilities(payload).get('compress', []))
+    return tuple(name for name in COMPRESSION_PREFERENCE if name in CODECS and name in offered)
+
+
+def pick_codec(path, codecs, name=None):
+    """
+    The codec to send this file with (None = uncompressed): the first of
+    `codecs` unless the file is small, has a media/archive extension (of
+    `name`, if the file is stored under another one), or a sample of it
+    doesn't compress.
+    """
+    if not codecs:
+        return None
+    try:
+        size = os.path.getsize(path)
+        if size < COMPRESSION_MIN_FILE_SIZE or os.path.splitext(name or path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+            return None
+        with open(path, 'rb') as f:
+            f.seek(max(0, size // 2 - COMPRESSION_SAMPLE_SIZE // 2)) # The middle, past any header
+            sample = f.read(COMPRESSION_SAMPLE_SIZE)
+    except OSError:
+        return None
+    if len(zlib.compress(sample, 1)) > len(sample) * (1 - COMPRESSION_MIN_SAVING):
+        return None
+    return codecs[0]
+
+
+def parse_codec(name):
+    """Codec named in FILE_SEND_START / FILE_UPLOAD_RESUME -> codec or None; one we don't have is a protocol error."""
+    if name == NO_CODEC:
+        return None
+    if name not in CODECS:
+        raise TransferError(f"Unsupported compression {name!r}")
+    return name
+
+
+def pack_file_data(data, codec):
+    """(frame type, payload) for one FILE_DATA frame, compressed with `codec` if that makes it smaller."""
+    if codec:
+        packed = CODECS[codec].compress(data)
+        if len(packed) < len(data):
+            return protocol.FRAME_FILE_DATA_COMPRESSED, packed
+    return protocol.FRAME_FILE_DATA, data
+
+
+def unpack_file_data(frame_type, payload, codec, partial):
+    """The original bytes of a FILE_DATA / FILE_DATA_COMPRESSED frame about to be written to `partial`."""
+    if frame_type == protocol.FRAME_FILE_DATA:
+        return payload
+    if not codec:
+        raise TransferError("Compressed data in an uncompressed transfer")
+    return CODECS[codec].decompress(payload, partial.chunk_room)
+
+
+def describe_rate(raw_bytes, wire_bytes, elapsed, codec):
+    """e.g. '48.2 MB/s, 5.3x zlib' for the status bar and logs."""
+    rate = f"{raw_bytes / max(elapsed, 1e-6) / (1024 * 1024):.1f} MB/s"
+    if not codec:
+        return rate
+    return f"{rate}, {raw_bytes / max(wire_bytes, 1):.1f}x {codec}"
+
+
+def chunk_count(size):
+    return -(-size // CHUNK_SIZE)
+
+
+def hash_file_chunks(path):
+    """Hashes of every chunk of a local file."""
+    hashes = []
+    with open(path, 'rb') as f:
+        while True:
+            digest = hashlib.new(HASH_NAME)
+            remaining = CHUNK_SIZE
+            while remaining and (data := f.read(min(READ_SIZE, remaining))):
+                digest.update(data)
+                remaining -= len(data)
+            if remaining == CHUNK_SIZE:
+                return hashes
+            hashes.append(digest.hexdigest())
+
+
+def content_hash(chunk_hashes):
+    """Content hash of a file from its chunk hashes (hex, as hash_file_chunks returns them)."""
+    return hashlib.new(HASH_NAME, b''.join(bytes.fromhex(h) for h in chunk_hashes)).hexdigest()
+
+
+def is_content_hash(value):
+    """True for a well-formed hex digest (content hashes end up in file paths)."""
+    return len(value) == hashlib.new(HASH_NAME).digest_size * 2 and all(c in '0123456789abcdef' for c in value)
+
+
+def cached_file_hashes(path, cache_dir):
+    """
+    Chunk hashes of a complete file, from <cache_dir>/<name>.hashes when it
+    still matches the file's size and mtime, otherwise computed and cached.
+    """
+    stat = os.stat(path)
+    key = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'chunk_size': CHUNK_SIZE}
+    cache_path = os.path.join(cache_dir, os.path.basename(path) + '.hashes')
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            if json.loads(f.readline()) == key:
+                hashes = f.read().split()
+                if len(hashes) == chunk_count(stat.st_size):
+                    return hashes
+    except (OSError, ValueError):
+        pass
+    hashes = hash_file_chunks(path)
+    save_file_hashes(path, cache_dir, hashes)
+    return hashes
+
+
+def save_file_hashes(path, cache_dir, hashes):
+    """Records already-known chunk hashes (e.g. from a verified upload) in the cache."""
+    stat = os.stat(path)
+    key = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'chunk_size': CHUNK_SIZE}
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, os.path.basename(path) + '.hashes'), 'w', encoding='utf-8') as f:
+        f.write(json.dumps(key) + '\n' + ''.join(h + '\n' for h in hashes))
+
+
+class PartialFile:
+    """
+    Receiving side of a resumable transfer into `path`. Data is written to
+    <partial_dir>/<name>.part and moved to `path` once every chunk verified.
+    """
+    def __init__(self, path, name, size, partial_dir=None):
+        self.path = path
+        self.name = name
+        self.size = size
+        partial_dir = partial_dir or os.path.dirname(path)
+        self.part_path = os.path.join(partial_dir, os.path.basename(path) + '.part')
+        self.manifest_path = self.part_path + '.manifest'
+        self.hashes = [] # Verified chunks
+        self.file = None
+        self.manifest = None
+        self.digest = None
+        self.written = 0
+        self._load()
+
+    def _header(self):
+        return {'name': self.name, 'size': self.size, 'chunk_size': CHUNK_SIZE}
+
+    def _load(self):
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                if json.loads(f.readline()) != self._header():
+                    return # A different file (or size) under the same name: start over
+                hashes = [line.strip() for line in f]
+            on_disk = os.path.getsize(self.part_path)
+        except (OSError, ValueError):
+            return
+        # A hash line is only written after its chunk was flushed, but an
+        # interrupted write can leave a truncated last line
+        hashes = [h for h in hashes if len(h) == hashlib.new(HASH_NAME).digest_size * 2]
+        complete_chunks = on_disk // CHUNK_SIZE + (1 if on_disk == self.size else 0)
+        self.hashes = hashes[:min(complete_chunks, chunk_count(self.size))]
+
+    @property
+    def chunk_room(self):
+        """Bytes the next write can add before the current chunk has to be verified."""
+        return min(CHUNK_SIZE - self.written % CHUNK_SIZE, self.size - self.written)
+
+    @property
+    def verified_bytes(self):
+        return min(len(self.hashes) * CHUNK_SIZE, self.size)
+
+    def resume_point(self):
+        """(offset, hash of the chunk just before it) to offer the sender."""
+        return self.verified_bytes, (self.hashes[-1] if self.hashes else NO_HASH)
+
+    def start(self, offset):
+        """Opens the part file, keeping the first `offset` verified bytes."""
+        if offset % CHUNK_SIZE and offset != self.size or offset > self.verified_bytes:
+            raise TransferError(f"Cannot resume {self.name} at byte {offset}")
+        self.close()
+        self.hashes = self.hashes[:chunk_count(offset)]
+        os.makedirs(os.path.dirname(self.part_path) or '.', exist_ok=True)
+        self.file = open(self.part_path, 'r+b' if os.path.exists(self.part_path) else 'wb')
+        self.file.truncate(offset)
+        self.file.seek(offset)
+        self.written = offset
+        self.digest = hashlib.new(HASH_NAME)
+        with open(self.manifest_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self._header()) + '\n' + ''.join(h + '\n' for h in self.hashes))
+        self.manifest = open(self.manifest_path, 'a', encoding='utf-8')
+
+    def write(self, data):
+        if self.written + len(data) > self.size:
+            raise TransferError("Peer sent more data than announced")
+        self.file.write(data)
+        self.digest.update(data)
+        self.written += len(data)
+
+    def verify_chunk(self, index, expected):
+        """Checks the chunk just written against the sender's hash; records it if it matches."""
+        chunk_end = min((index + 1) * CHUNK_SIZE, self.size)
+        if index != len(self.hashes) or self.written != chunk_end:
+            raise TransferError(f"Unexpected hash for chunk {index} of {self.name}")
+        actual = self.digest.hexdigest()
+        self.digest = hashlib.new(HASH_NAME)
+        if actual != expected:
+            # Drop the bad chunk so a resume re-fetches it
+            self.file.truncate(self.verified_bytes)
+            self.file.seek(self.verified_bytes)
+            self.written = self.verified_bytes
+            raise TransferError(f"Chunk {index} of {self.name} is corrupt (hash mismatch)")
+        self.file.flush() # Data before its hash, so the manifest never runs ahead of the file
+        self.hashes.append(actual)
+        self.manifest.write(actual + '\n')
+        self.manifest.flush()
+
+    @property
+    def complete(self):
+        return self.verified_bytes == self.size
+
+    def finish(self):
+        """Moves the verified file into place and removes the manifest."""
+        if self.file is None:
+            self.start(0) # Empty file: nothing was ever sent
+        self.close()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        os.replace(self.part_path, self.path)
+        try: os.remove(self.manifest_path)
+        except OSError: pass
+
+    def discard(self):
+        """Closes and deletes the part file and its manifest."""
+        self.close()
+        for path in (self.part_path, self.manifest_path):
+            try: os.remove(path)
+            except OSError: pass
+
+    def close(self):
+        """Closes without deleting anything, so the transfer can be resumed."""
+        for f in (self.file, self.manifest):
+            if f:
+                try: f.close()
+                except OSError: pass
+        self.file = self.manifest = None
@@ -0,0 +1,224 @@
+# video_packets.py
+"""
+Webcam frames over UDP (used by client.py and server.py).
+
+A JPEG frame is split into fragments of at most FRAGMENT_SIZE bytes, so
+every datagram fits in one Ethernet frame: nothing is left to IP
+fragmentation, which loses the whole datagram with any one of its pieces
+and fails outright above 64 KB. Each fragment carries its frame's number
+and where it goes:
+
+    +------+----------+----------------+----------------+--------------------+
+    | VID: | frame id | fragment index | fragment count | JPEG bytes         |
+    | 4 B  | 4 bytes  | 2 bytes        | 2 bytes        | <= FRAGMENT_SIZE   |
+    +------+----------+----------------+----------------+--------------------+
+
+The server puts each sender's frames back together before relaying them as
+VID:<nickname>:<frame id><index><count><bytes>, so a frame that lost a
+fragment on the way in costs the viewers nothing; the client reassembles
+again, since the way out can lose fragments too. A Reassembler gives up on
+a frame after REASSEMBLY_TIMEOUT, or as soon as a newer frame from the
+same sender is complete: an old frame is not worth showing any more.
+
+Every FEEDBACK_INTERVAL each viewer tells each sender, over TCP, how their
+frames fared: CMD:VIDEO_FEEDBACK:<sender>:<frames>:<lost>:<late>:<decode ms>
+(the server swaps in the viewer's name on the way). The server reports on
+the frames it reassembles itself too, with an empty viewer name (UPLINK).
+A frame is lost when it never completes: the frame ids skipped between two
+complete frames. It is late when its fragments took more than LATE_SPREAD
+to arrive, which is queues building up before anything is lost; the
+server's report covers the way in, the viewers' the way out.
+
+The sender's RateController moves along a ladder of (size, JPEG quality,
+frame rate) rungs: down at once when any report shows lost, late or slowly
+decoded frames, or when the video times its viewers would take more than
+the budget; up one rung at a time while every report is clean. Audio shares the LAN, so
+video backs off at a few percent of loss, before audio would notice.
+"""
+import struct
+import threading
+
+HEADER = struct.Struct('!IHH') # Frame id, fragment index, fragment count
+FRAGMENT_SIZE = 1200 # JPEG bytes per datagram: with the headers, well under a 1500-byte MTU
+REASSEMBLY_TIMEOUT = 0.5 # Seconds a frame may take to arrive in full
+MAX_PENDING_FRAMES = 4 # Incomplete frames kept per sender; the oldest goes first
+RESYNC_FRAMES = 100 # A frame id this far behind is a restarted sender, not a late frame
+LATE_SPREAD = 0.1 # Seconds between a frame's first and last fragment that make it late
+UPLINK = '' # Viewer name of the server's own report: nicknames can't be empty
+
+# --- Rate control (sender side, from the viewers' feedback) ---
+FEEDBACK_INTERVAL = 1.0 # Seconds between a viewer's reports, and between the sender's decisions
+LOSS_BACKOFF = 0.02 # A viewer losing more than this share of frames makes the sender step down...
+LATE_BACKOFF = 0.1 # ...or getting more than this share late...
+DECODE_BACKOFF = 0.5 # ...or taking more than this share of the frame interval to decode one
+LOSS_CLEAN = 0.005 # Step up only while every viewer loses less than this, and gets nothing late
+STEP_UP_INTERVAL = 3.0 # Seconds of good reports between steps up
+BACKOFF_HOLD = 10.0 # Seconds without stepping up after stepping down
+BUDGET_HEADROOM = 0.5 # Step up only while the video takes less than this share of the budget
+
+
+def packetize(frame_id, data, prefix=b'VID:', fragment_size=FRAGMENT_SIZE):
+    """The datagrams carrying one frame, each `prefix` + header + fragment."""
+    count = max(1, -(-len(data) // fragment_size))
+    view = memoryview(data)
+    return [prefix + HEADER.pack(frame_id & 0xFFFFFFFF, index, count)
+            + view[index * fragment_size:(index + 1) * fragment_size]
+            for index in range(count)]
+
+
+def unpack(data, offset=4):
+    """
+    A fragment datagram (from `offset`, after VID: or VID:<nickname>:) ->
+    (frame id, index, count, bytes), or None if it is malformed.
+    """
+    if len(data) < offset + HEADER.size:
+        return None
+    frame_id, index, count = HEADER.unpack_from(data, offset)
+    if index >= count:
+        return None
+    return frame_id, index, count, data[offset + HEADER.size:]
+
+
+class Reassembler:
+    """
+    Every sender's incomplete frames. add() is called by the thread
+    receiving fragments; remove() by whoever sees the sender leave.
+    """
+    def __init__(self, timeout=REASSEMBLY_TIMEOUT, max_pending=MAX_PENDING_FRAMES):
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pending = {} # sender -> {frame id: [fragments, fragments missing, first seen]}
+        self.latest = {} # sender -> id of their last complete frame
+        self.stats = dict.fromkeys(('completed', 'incomplete', 'stale'), 0)
+        self.feedback = {} # sender -> [frames, lost, late] since the last take_feedback()
+
+    def add(self, sender, frame_id, index, count, fragment, now):
+        """Stores one fragment; returns the whole frame (bytes) if this completed it, else None."""
+        with self.lock:
+            latest = self.latest.get(sender)
+            if latest is not None:
+                behind = (latest - frame_id) % 2**32
+                if behind < 2**31: # Not newer than the last frame shown
+                    if behind <= RESYNC_FRAMES:
+                        self.stats['stale'] += 1
+                        return None
+                    del self.latest[sender] # The sender started counting again
+            frames = self.pending.setdefault(sender, {})
+            self._expire(frames, now)
+            frame = frames.get(frame_id)
+            if frame is None:
+                if len(frames) >= self.max_pending:
+                    del frames[next(iter(frames))] # The oldest
+                    self.stats['incomplete'] += 1
+                frame = frames[frame_id] = [[None] * count, count, now]
+            parts = frame[0]
+            if len(parts) != count or parts[index] is not None:
+                return None # Duplicate, or not the frame we think
+            parts[index] = fragment
+            frame[1] -= 1
+            if frame[1]:
+                return None
+            del frames[frame_id]
+            # Frames older than this one will never be shown now
+            for older in [fid for fid in frames if (frame_id - fid) % 2**32 < 2**31]:
+                del frames[older]
+                self.stats['incomplete'] += 1
+            counts = self.feedback.setdefault(sender, [0, 0, 0])
+            if latest is not None and sender in self.latest:
+                # Every frame id skipped since the last complete frame is lost,
+                # including frames none of whose fragments got here
+                counts[1] += min((frame_id - latest - 1) % 2**32, RESYNC_FRAMES)
+            self.latest[sender] = frame_id
+            self.stats['completed'] += 1
+            counts[0] += 1
+            if now - frame[2] > LATE_SPREAD:
+                counts[2] += 1
+            return b''.join(parts)
+
+    def _expire(self, frames, now):
+        for frame_id in [fid for fid, frame in frames.items() if now - frame[2] > self.timeout]:
+            del frames[frame_id]
+            self.stats['incomplete'] += 1
+
+    def remove(self, sender):
+        with self.lock:
+            self.pending.pop(sender, None)
+            self.latest.pop(sender, None)
+            self.feedback.pop(sender, None)
+
+    def take_stats(self):
+        """The counters since the last call, then resets them."""
+        with self.lock:
+            stats = self.stats
+            self.stats = dict.fromkeys(stats, 0)
+            return stats
+
+    def take_feedback(self):
+        """{sender: (frames, lost, late)} since the last call, for CMD:VIDEO_FEEDBACK, then resets them."""
+        with self.lock:
+            feedback = self.feedback
+            self.feedback = {}
+            return {sender: tuple(counts) for sender, counts in feedback.items()}
+
+
+class RateController:
+    """
+    Sender side: which rung of `ladder` to send at. Rungs are
+    ((width, height), JPEG quality, frames per second), cheapest first.
+    report() is called by the TCP thread with each viewer's feedback (and
+    the server's, as UPLINK), sent() and rung() by the video send loop.
+    """
+    def __init__(self, ladder, start, budget):
+        self.ladder = ladder
+        self.level = start
+        self.budget = budget # Bits/s the video may take times its viewers
+        self.lock = threading.Lock()
+        self.reports = {} # viewer -> (frames, lost, late, decode ms, when)
+        self.sent_bytes = 0
+        self.started = self.decided_at = None
+        self.hold_until = 0.0 # No stepping up before this
+
+    def report(self, viewer, frames, lost, late, decode_ms, now):
+        with self.lock:
+            self.reports[viewer] = (frames, lost, late, decode_ms, now)
+
+    def sent(self, nbytes):
+        self.sent_bytes += nbytes
+
+    def rung(self, now):
+        """The rung for the next frame, deciding again every FEEDBACK_INTERVAL."""
+        if self.decided_at is None:
+            self.started = self.decided_at = now
+            self.hold_until = now + STEP_UP_INTERVAL
+        elif now - self.decided_at >= FEEDBACK_INTERVAL:
+            self._decide(now)
+        return self.ladder[self.level]
+
+    def _decide(self, now):
+        bitrate = 8 * self.sent_bytes / (now - self.decided_at)
+        self.sent_bytes = 0
+        self.decided_at = now
+        with self.lock:
+            # Viewers who reported lately; one who stopped (left, or gets nothing) drops out
+            recent = [r for r in self.reports.values() if now - r[4] <= 3 * FEEDBACK_INTERVAL]
+            self.reports = {v: r for v, r in self.reports.items() if now - r[4] <= 3 * FEEDBACK_INTERVAL}
+            viewers = sum(viewer != UPLINK for viewer in self.reports)
+        if not viewers:
+            if now - self.started > 3 * FEEDBACK_INTERVAL:
+                self.level = 0 # Nobody is watching (or nothing gets through)
+            return
+        frame_ms = 1000 / self.ladder[self.level][2]
+        loss = max(lost / (frames + lost) if frames + lost else 0.0 for frames, lost, _, _, _ in recent)
+        late = max(late / frames if frames else 0.0 for frames, _, late, _, _ in recent)
+        decode_ms = max(r[3] for r in recent)
+        load = bitrate * viewers
+        if (loss > LOSS_BACKOFF or late > LATE_BACKOFF or decode_ms > DECODE_BACKOFF * frame_ms
+                or load > self.budget):
+            if self.level > 0:
+                self.level -= 1
+            self.hold_until = now + BACKOFF_HOLD
+        elif (now >= self.hold_until and loss < LOSS_CLEAN and not late
+                and load < BUDGET_HEADROOM * self.budget and self.level < len(self.ladder) - 1):
+            self.level += 1
+            self.hold_until = now + STEP_UP_INTERVAL